@@ -6,7 +6,11 @@ from builtins import str
 import sys, os, re
 import argparse
 from utils.labeler import read_attack_file, ip2int, int2ip, checkIPsEqual
-from utils.time_functions import datetime_to_tstamp
+from utils.labeler import AttackIndex
+from utils.alerts import Alerts
+from utils.formatter import format_ips, format_floats
+from utils.time_functions import datetime_to_tstamp, tstamps_to_datetime
+from utils.time_functions import tstamps_to_seconds
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
@@ -15,30 +19,96 @@ import matplotlib.pyplot as plt
 def check_results(results_file, attacks_file, threshold, make_plots, table_thresh):
     threshold_vals = parse_threshold(threshold)
     attack_list, num_unique_attacks = read_attack_file(attacks_file)
-    raw_results = read_results(results_file)
-    final_results = get_final_results(raw_results, attack_list)
-    pc_attacks_detected = []
-    num_TP_per_day = []
-    num_FP = []
-    num_FP_per_day = []
-    f1s = []
-    for thresh in threshold_vals:
-        total_unique_TP, total_TP_per_day, total_FP, total_FP_per_day = classify_results(
-            final_results, thresh
+    try:
+        alerts = Alerts.load(results_file)
+    except ValueError:
+        # not an alerts file, so a results.csv file
+        raw_results = read_results(results_file)
+        final_results, data = evaluate_results(
+            raw_results, attack_list, num_unique_attacks, threshold_vals
         )
-        pc_attacks_detected.append(
-            float(total_unique_TP) / float(num_unique_attacks) * 100
+    else:
+        final, matches, data = evaluate_alerts(
+            alerts, attack_list, num_unique_attacks, threshold_vals
         )
-        num_FP.append(total_FP)
-        num_FP_per_day.append(total_FP_per_day)
-        num_TP_per_day.append(total_TP_per_day)
-        recall = total_unique_TP / num_unique_attacks
-        total_pos = total_unique_TP + total_FP
-        precision = total_unique_TP / total_pos if total_pos > 0 else 0
-        if (recall + precision) > 0:
-            f1s.append(2 * (recall * precision) / (recall + precision))
-        else:
-            f1s.append(0.0)
+        final_results = results_from_alerts(final, matches, attack_list)
+
+    if make_plots:
+        plot_results(data)
+    print_results(final_results, data, table_thresh)
+
+    return data
+
+
+def evaluate_results(raw_results, attack_list, num_unique_attacks, threshold_vals):
+    """
+    Inputs:
+      - raw_results : list of dictionaries, as returned by read_results
+      - attack_list : list of dictionaries of all attacks from attack file
+      - num_unique_attacks : number of unique attacks in the attack file
+      - threshold_vals : numpy array of threshold values
+
+    Returns:
+      - final_results : see get_final_results
+      - data : dictionary of the detection results at each threshold
+    """
+    final_results = get_final_results(raw_results, attack_list)
+    swept = sweep_results(final_results, threshold_vals)
+    return final_results, detection_data(swept, num_unique_attacks, threshold_vals)
+
+
+def evaluate_alerts(alerts, attack_list, num_unique_attacks, threshold_vals):
+    """Evaluate alerts held in memory, without a results file.
+
+    Inputs:
+      - alerts : Alerts raised by a detector
+      - attack_list : list of dictionaries of all attacks from attack file
+      - num_unique_attacks : number of unique attacks in the attack file
+      - threshold_vals : numpy array of threshold values
+
+    Returns:
+      - final : the Alerts left by get_final_alerts, from high to low score
+      - matches : index into attack_list of the attack of each final alert,
+          -1 if it is not an attack
+      - data : dictionary of the detection results at each threshold
+    """
+    rows, matches = get_final_alerts(alerts, attack_list)
+    final = alerts.take(rows)
+    swept = sweep_scores(
+        final.scores,
+        matches >= 0,
+        tstamps_to_datetime(final.times)[0],
+        threshold_vals,
+    )
+    return final, matches, detection_data(swept, num_unique_attacks, threshold_vals)
+
+
+def detection_data(swept, num_unique_attacks, threshold_vals):
+    """
+    Inputs:
+      - swept : output of sweep_results
+      - num_unique_attacks : number of unique attacks in the attack file
+      - threshold_vals : numpy array of threshold values
+
+    Returns:
+      - data : dictionary of the detection results at each threshold
+    """
+    total_unique_TP, num_TP_per_day, num_FP, num_FP_per_day = swept
+    total_unique_TP = np.array(total_unique_TP, dtype=float)
+    total_pos = total_unique_TP + np.array(num_FP)
+    pc_attacks_detected = total_unique_TP / float(num_unique_attacks) * 100
+    recall = total_unique_TP / num_unique_attacks
+    precision = np.zeros(len(threshold_vals))
+    np.divide(total_unique_TP, total_pos, out=precision, where=total_pos > 0)
+    f1s = np.zeros(len(threshold_vals))
+    np.divide(
+        2 * (recall * precision),
+        recall + precision,
+        out=f1s,
+        where=(recall + precision) > 0,
+    )
+    pc_attacks_detected = pc_attacks_detected.tolist()
+    f1s = f1s.tolist()
 
     data = {}
     data["threshold_vals"] = threshold_vals
@@ -48,10 +118,6 @@ def check_results(results_file, attacks_file, threshold, make_plots, table_thres
     data["num_TP_per_day"] = num_TP_per_day
     data["f1s"] = f1s
 
-    if make_plots:
-        plot_results(data)
-    print_results(final_results, data, table_thresh)
-
     return data
 
 
@@ -116,19 +182,28 @@ def get_final_results(raw_results, attack_list):
       - final_results : raw_results appended with attack info and pruned so that
           results that detect duplicate attacks are removed
     """
-    detected_attackIDs = []
+    detected_attackIDs = set()
     final_results = []
     # sort the raw_results by score from high to low so that only the
     # highest scoring of any duplicate attacks will appear in the final_results
     raw_results = sorted(raw_results, key=getScoreVal)
-    for result in raw_results:
-        isAttack, attackID, attackName = get_attack_info(result, attack_list)
+    # match every result against the attacks at once, as get_attack_info would
+    matches = AttackIndex(attack_list).match(
+        [np.nan if r["timestamp"] is None else r["timestamp"] for r in raw_results],
+        [ip2int(r["dstIP"]) for r in raw_results],
+    )
+    for result, match in zip(raw_results, matches):
+        if match < 0:
+            isAttack, attackID, attackName = False, "", ""
+        else:
+            attack = attack_list[match]
+            isAttack, attackID, attackName = True, attack["ID"], attack["name"]
         result["attackID"] = attackID
         result["isAttack"] = isAttack
         result["attack_name"] = attackName
         if isAttack and attackID not in detected_attackIDs:
             # record this attack ID so that we know we've seen it before
-            detected_attackIDs.append(attackID)
+            detected_attackIDs.add(attackID)
             # don't include any duplicate attack detections in the final results
             final_results.append(result)
         elif not isAttack:
@@ -137,6 +212,35 @@ def get_final_results(raw_results, attack_list):
     return final_results
 
 
+def get_final_alerts(alerts, attack_list):
+    """The same as get_final_results, for Alerts
+
+    Inputs:
+      - alerts : Alerts raised by a detector
+      - attack_list : list of dictionaries of all attacks from attack file
+
+    Returns:
+      - rows : the alerts left once duplicate detections of an attack are
+          removed, from high to low score
+      - matches : index into attack_list of the attack of each row, -1 if
+          it is not an attack
+    """
+    # a stable sort, like sorted, so ties keep the order of the alerts
+    order = np.argsort(-alerts.scores, kind="mergesort")
+    # results files hold whole seconds and write results without a
+    # destination IP as 0.0.0.0, so match the alerts as they would be read
+    # back from one
+    matches = AttackIndex(attack_list).match(
+        tstamps_to_seconds(alerts.times[order]), np.maximum(alerts.dstIPs[order], 0)
+    )
+    # keep the first, highest scoring, detection of each attack ID
+    attackIDs = np.array([attack["ID"] for attack in attack_list] + [""])
+    _, first = np.unique(attackIDs[matches], return_index=True)
+    keep = matches < 0
+    keep[first] = True
+    return order[keep], matches[keep]
+
+
 def classify_results(final_results, threshold):
     """
     Inputs:
@@ -168,6 +272,72 @@ def classify_results(final_results, threshold):
     return total_unique_TP, total_TP_per_day, total_FP, total_FP_per_day
 
 
+def sweep_results(final_results, threshold_vals):
+    """Classify the results at every threshold at once.
+
+    The scores of the attacks and of the false alarms, overall and on each
+    day, are sorted once. The number of them above each threshold is then a
+    binary search into the sorted scores, so the cost hardly grows with the
+    number of thresholds.
+
+    Inputs:
+      - final_results : list of dictionaries of results, that contain info as to whether or not
+          this is an actual attack
+      - threshold_vals : numpy array of threshold values
+
+    Returns:
+      - lists with the values classify_results returns for each threshold:
+          total_unique_TP, total_TP_per_day, total_FP and total_FP_per_day
+    """
+    return sweep_scores(
+        [result["score"] for result in final_results],
+        [bool(result["isAttack"]) for result in final_results],
+        [result["date"] for result in final_results],
+        threshold_vals,
+    )
+
+
+def sweep_scores(scores, isAttack, dates, threshold_vals):
+    """The same as sweep_results, for the columns of the final results
+
+    Inputs:
+      - scores : score of each final result
+      - isAttack : whether each final result is an actual attack
+      - dates : date string of each final result
+      - threshold_vals : numpy array of threshold values
+
+    Returns:
+      - see sweep_results
+    """
+    threshold_vals = np.asarray(threshold_vals, dtype=float)
+    scores = np.asarray(scores, dtype=float)
+    isAttack = np.asarray(isAttack, dtype=bool)
+    dates = np.asarray(dates)
+    days = sorted(set(dates.tolist()))
+    day_ids = np.searchsorted(np.array(days), dates).astype(int)
+    # NaN scores are never above a threshold
+    scored = ~np.isnan(scores)
+
+    def count_above(mask):
+        # Number of the masked results with a score above each threshold
+        ordered = np.sort(scores[mask & scored])
+        return len(ordered) - np.searchsorted(ordered, threshold_vals, "right")
+
+    total_unique_TP = count_above(isAttack).tolist()
+    total_FP = count_above(~isAttack).tolist()
+    total_TP_per_day = [{} for _ in threshold_vals]
+    total_FP_per_day = [{} for _ in threshold_vals]
+    for day_id, date in enumerate(days):
+        on_day = day_ids == day_id
+        for counts, per_day in [
+            (count_above(on_day & isAttack), total_TP_per_day),
+            (count_above(on_day & ~isAttack), total_FP_per_day),
+        ]:
+            for i in np.flatnonzero(counts):
+                per_day[i][date] = int(counts[i])
+    return total_unique_TP, total_TP_per_day, total_FP, total_FP_per_day
+
+
 def get_attack_info(result_dic, attack_list, leeway=60):
     """
     Inputs:
@@ -277,7 +447,7 @@ def print_results(final_results, data, pthresh):
 
 
 def read_results(results_file):
-    result_fmat = r"(?P<date>.*),(?P<time>.*),(?P<dstIP>.*),(?P<score>.*),(?P<anom_field>.*),(?P<anom_field_pc>[\d\.]*)[\r\n$]"
+    result_fmat = r"(?P<date>.*),(?P<time>.*),(?P<dstIP>.*),(?P<score>.*),(?P<anom_field>.*),(?P<anom_field_pc>[\d\.eE+-]*)[\r\n$]"
     #  result_fmat = r'(?P<date>.*),(?P<time>.*),(?P<dstIP>.*),(?P<score>.*)[\r\n$]'
     with open(results_file) as f:
         contents = f.read()
@@ -289,10 +459,53 @@ def read_results(results_file):
     return results
 
 
+def results_from_alerts(final, matches, attack_list):
+    """Build the final results that get_final_results would return for the
+    output of evaluate_alerts, for printing.
+
+    Inputs:
+      - final, matches : output of evaluate_alerts
+      - attack_list : list of dictionaries of all attacks from attack file
+
+    Returns:
+      - list of dictionaries, as returned by get_final_results
+    """
+    results = []
+    dates, times = tstamps_to_datetime(final.times)
+    for date, time, dstIP, score, anom_field, anom_field_pc, tstamp, match in zip(
+        dates.tolist(),
+        times.tolist(),
+        format_ips(final.dstIPs),
+        final.scores.tolist(),
+        final.field_names(),
+        format_floats(final.shares),
+        tstamps_to_seconds(final.times).tolist(),
+        matches,
+    ):
+        attack = attack_list[match] if match >= 0 else {"ID": "", "name": ""}
+        results.append(
+            {
+                "date": date,
+                "time": time,
+                "dstIP": dstIP,
+                "score": score,
+                "anom_field": anom_field,
+                "anom_field_pc": anom_field_pc,
+                "timestamp": tstamp,
+                "attackID": attack["ID"],
+                "isAttack": bool(match >= 0),
+                "attack_name": attack["name"],
+            }
+        )
+    return results
+
+
 def main():
     """Check the resulting csv file of packet classifications to see if actual attacks were detected"""
     parser = argparse.ArgumentParser()
-    parser.add_argument("results_file", type=str, help="the results.csv file")
+    parser.add_argument(
+        "results_file", type=str, help="the results.csv file, or a binary alerts file"
+    )
     parser.add_argument("attacks_file", type=str, help="the actual attacks file")
     parser.add_argument(
         "--thresh",
@@ -1,103 +1,46 @@
 #!/usr/bin/env python
 """Network intrusion detection using a GMM."""
 from __future__ import print_function, division
+import argparse
 import cPickle as pickle
-import csv
 import numpy as np
-from utils import np_parse_pcap, FEATURES
-from utils import tstamp_to_datetime
-import socket
-import struct
+from utils import FEATURES, open_packet_store
+from utils import TRAINING_DAYS, TRAINING_FILES, TESTING_DAYS, TESTING_FILES
+from utils import write_alerts_csv
+from utils import save_gmm_model, load_gmm_model, GMM_MODEL
+from utils import Alerts
 from sklearn.mixture import GaussianMixture
 from sklearn import preprocessing
 
+# The alerts, read by check_results.py, and the optional csv export of them
+ALERTS_FILE = "data/gmm_alerts.bin"
+RESULTS_CSV = "data/gmm_results_max.csv"
 
-def _parseTrainingData():
-    """Parse the week 3 training data."""
-    try:
-        allData = np.load(open("data/train_data.npy", "rb"))
-        print("Loading pre-parsed training data...", end='')
-    except IOError:
-        print("Parsing the training data...", end='')
-        # Parse the Training Data
-        trainingFiles = [
-            "data/training/week3_monday_inside",
-            "data/training/week3_monday_extra_inside",
-            "data/training/week3_tuesday_inside",
-            "data/training/week3_tuesday_extra_inside",
-            "data/training/week3_wednesday_inside",
-            "data/training/week3_wednesday_extra_inside",
-            "data/training/week3_thursday_inside",
-            "data/training/week3_friday_inside",
-        ]
-        allDays = np_parse_pcap(trainingFiles)
-        # Create a single matrix of packets x features
-        trainData = np.vstack([pkts for (pkts, times) in allDays])
-        # Create a single matrix of packets x features
-        trainTimes = np.vstack([times for (pkts, times) in allDays])
-
-        allData = np.hstack((trainTimes, trainData))
-        np.save(open("data/train_data.npy", "wb"), allData)
-
-    print("Done!")
-    return allData
-
-def _parseTestingData():
-    """Parse week 4 and 5 of testing data."""
-    try:
-        allData = np.load(open("data/test_data.npy", "rb"))
-        print("Loading pre-parsed training data...", end='')
-    except IOError:
-        print("Parsing the testing data...", end='')
-        # Parse the Training Data
-        testingFiles = [
-            "data/testing/week4_monday_inside",
-            #  "data/testing/week4_tuesday_inside",  <-- doesn't exist
-            "data/testing/week4_wednesday_inside",
-            "data/testing/week4_thursday_inside",
-            "data/testing/week4_friday_inside",
-            "data/testing/week5_monday_inside",
-            "data/testing/week5_tuesday_inside",
-            "data/testing/week5_wednesday_inside",
-            "data/testing/week5_thursday_inside",
-            "data/testing/week5_friday_inside",
-        ]
-
-        allDays = np_parse_pcap(testingFiles)
-        # Create a single matrix of packets x features
-        testData = np.vstack([pkts for (pkts, times) in allDays])
-        # Create a single matrix of packets x features
-        testTimes = np.vstack([times for (pkts, times) in allDays])
-        allData = np.hstack((testTimes, testData))
-
-        np.save(open("data/test_data.npy", "wb"), allData)
-
-    print("Done!")
-    return allData
-
-
-def _outputToCSV(results, filename, threshold=1e-8):
-    """Classify all attacks with a score above threshold as an attack."""
-
-    outfile = open(filename, "wb")
-    writer = csv.writer(outfile)
-
-    for packet in results:
-        datetime = tstamp_to_datetime(packet[0])
-
-        if packet[16] != -1:
-            destIP = socket.inet_ntoa(struct.pack('!L', packet[16]))
-        else:
-            destIP = "0.0.0.0"
-
-        # Only write the most improbable packets
-        if packet[-1] < (1.0 - threshold):
-            writer.writerow([datetime[0],
-                             datetime[1],
-                             destIP,
-                             1. - packet[-1]])
-
-    outfile.close()
+
+def _alerts(table, scores, threshold=1e-8):
+    """Classify all packets with a score above threshold as an attack.
+
+    Inputs:
+      - table : PacketTable of a block of test packets
+      - scores : score of each packet of the table
+      - threshold : packets scoring below 1 - threshold are attacks
+
+    Returns:
+      - Alerts of the attacks, 0.0.0.0 where the destination IP is not
+        present
+    """
+
+    # Only keep the most improbable packets
+    rows = np.flatnonzero(scores < (1.0 - threshold))
+    attacks = table.take(rows)
+    return Alerts(attacks.times(), attacks.column('IPv4_dst'),
+                  1. - scores[rows])
+
+
+def _outputToCSV(alerts, filename):
+    """Export the alerts as rows of a results file."""
+    # The GMM does not point at an anomalous field
+    write_alerts_csv(alerts, filename, fields=False)
     print("Output results to file!")
 
 
@@ -113,40 +56,48 @@ def _score(probs):
 
 def main():
     """Run the IDS using GMM experiment."""
-    week3Data = _parseTrainingData()
-
-    # Scale the training data (ignore the timestamp column)
-    scaler = preprocessing.RobustScaler().fit(week3Data[:, 1:])
-    X_train = scaler.transform(week3Data[:, 1:])
-    del week3Data
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--csv", action="store_true",
+                        help="also export the alerts to " + RESULTS_CSV)
+    args = parser.parse_args()
 
+    store = open_packet_store(TRAINING_FILES + TESTING_FILES)
     try:
-        gmm = pickle.load(open("data/gmm.pkl", "rb"))
+        gmm, scaler = load_gmm_model(GMM_MODEL)
         print("Loading pre-trained GMM...")
-    except IOError:
-        print("Training the Gaussian Mixture...")
-        gmm = GaussianMixture(n_components=16,
-                              covariance_type='full',
-                              #  reg_covar=1,
-                              verbose=1,
-                              verbose_interval=2).fit(X_train)
-        pickle.dump(gmm, open("data/gmm.pkl", "wb"))
-    del X_train
-
-    X_orig = _parseTestingData()
-    print("Scaling the test data...")
-    X_test = scaler.transform(X_orig[:, 1:])
-
+    except (IOError, ValueError):
+        week3Data, _ = store.read(TRAINING_DAYS)
+
+        # Scale the training data
+        scaler = preprocessing.RobustScaler().fit(week3Data)
+        X_train = scaler.transform(week3Data)
+        del week3Data
+
+        try:
+            gmm = pickle.load(open("data/gmm.pkl", "rb"))
+            print("Converting pre-trained GMM...")
+        except IOError:
+            print("Training the Gaussian Mixture...")
+            gmm = GaussianMixture(n_components=16,
+                                  covariance_type='full',
+                                  #  reg_covar=1,
+                                  verbose=1,
+                                  verbose_interval=2).fit(X_train)
+        del X_train
+        save_gmm_model(GMM_MODEL, gmm, scaler)
+
+    # Score the test data a block at a time so it never sits in memory whole
     print("Calculating prosterior probabilies of test data...")
-    probs = gmm.predict_proba(X_test)
-    del X_test
-
-    scores = _score(probs)
-    del probs
-
-    results = np.hstack((X_orig, scores.reshape((scores.shape[0], 1))))
-
-    _outputToCSV(results, "data/gmm_results_max.csv")
+    alerts = []
+    for table in store.iter_tables(TESTING_DAYS):
+        X_test = scaler.transform(table.to_design_matrix())
+        scores = _score(gmm.predict_proba(X_test))
+        alerts.append(_alerts(table, scores))
+
+    alerts = Alerts.concatenate(alerts)
+    alerts.save(ALERTS_FILE)
+    if args.csv:
+        _outputToCSV(alerts, RESULTS_CSV)
 
 
 if __name__ == '__main__':
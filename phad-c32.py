@@ -2,40 +2,35 @@
 
 """This code recreates the PHAD-C32 experiments in the original PHAD paper."""
 from __future__ import print_function, division
-import cPickle as pickle
-import csv
+import argparse
 from math import log10
 import numpy as np
 from sklearn.preprocessing import MinMaxScaler
-import socket
-import struct
-from utils import Clusterer
-from utils import np_parse_pcap, FEATURES
-from utils import tstamp_to_datetime
+from utils import train_clusters, score_packets, FieldScores, Alerts
+from utils import save_phad_model, load_phad_model, PHAD_MODEL
+from utils import FEATURES, open_packet_store
+from utils import TRAINING_DAYS, TRAINING_FILES, TESTING_DAYS, TESTING_FILES
+from utils import write_alerts_csv
 
+# The alerts, read by check_results.py, and the optional csv export of them
+ALERTS_FILE = "data/phad_alerts.bin"
+RESULTS_CSV = "data/phad_results.csv"
 
-def _clusterTraining(trainingData, verbose=False):
+
+def _clusterTraining(store, trainingDays, verbose=False):
 
     try:
-        features = pickle.load(open("data/phad_clusters.pkl", "rb"))
+        features = load_phad_model(PHAD_MODEL)
         print("Loading pre-parsed cluster data...", end='')
-    except IOError:
+    except (IOError, ValueError):
+        # No model yet, or one written by an incompatible version
         print("Clustering the header fields...", end='')
-        features = {key: Clusterer() for key in FEATURES}
-
-        # First column of training data is the timestamp, which we ignore
-        for packetHdrs in trainingData[:, 1:]:
-            # Iterate over FEATURES so indexes are the correct order
-            for i, feature in enumerate(FEATURES):
-                if packetHdrs[i] != -1:
-                    # NOTE(lwhsiao): Right now we're just doing this all
-                    # together. One potential way to parallelize is to
-                    # instead update each Clusterer in parallel, providing
-                    # a single column of packet headers to each, rather
-                    # than processing them all together.
-                    features[feature].add(packetHdrs[i])
-
-        pickle.dump(features, open("data/phad_clusters.pkl", "wb"))
+        # Each Clusterer only sees the values of its own column, so the
+        # features are trained in parallel, skipping packets without the
+        # field.
+        features = train_clusters(store, trainingDays)
+
+        save_phad_model(PHAD_MODEL, features)
 
     print("Done!")
 
@@ -49,71 +44,6 @@ def _clusterTraining(trainingData, verbose=False):
     return features
 
 
-def _parseTestingData():
-    """Parse week 4 and 5 of testing data."""
-    try:
-        allData = np.load(open("data/test_data.npy", "rb"))
-        print("Loading pre-parsed training data...", end='')
-    except IOError:
-        print("Parsing the testing data...", end='')
-        # Parse the Training Data
-        testingFiles = [
-            "data/testing/week4_monday_inside",
-            #  "data/testing/week4_tuesday_inside",  <-- doesn't exist
-            "data/testing/week4_wednesday_inside",
-            "data/testing/week4_thursday_inside",
-            "data/testing/week4_friday_inside",
-            "data/testing/week5_monday_inside",
-            "data/testing/week5_tuesday_inside",
-            "data/testing/week5_wednesday_inside",
-            "data/testing/week5_thursday_inside",
-            "data/testing/week5_friday_inside",
-        ]
-
-        allDays = np_parse_pcap(testingFiles)
-        # Create a single matrix of packets x features
-        testData = np.vstack([pkts for (pkts, times) in allDays])
-        # Create a single matrix of packets x features
-        testTimes = np.vstack([times for (pkts, times) in allDays])
-        allData = np.hstack((testTimes, testData))
-
-        np.save(open("data/test_data.npy", "wb"), allData)
-
-    print("Done!")
-    return allData
-
-
-def _parseTrainingData():
-    """Parse the week 3 training data."""
-    try:
-        allData = np.load(open("data/train_data.npy", "rb"))
-        print("Loading pre-parsed training data...", end='')
-    except IOError:
-        print("Parsing the training data...", end='')
-        # Parse the Training Data
-        trainingFiles = [
-            "data/training/week3_monday_inside",
-            "data/training/week3_monday_extra_inside",
-            "data/training/week3_tuesday_inside",
-            "data/training/week3_tuesday_extra_inside",
-            "data/training/week3_wednesday_inside",
-            "data/training/week3_wednesday_extra_inside",
-            "data/training/week3_thursday_inside",
-            "data/training/week3_friday_inside",
-        ]
-        allDays = np_parse_pcap(trainingFiles)
-        # Create a single matrix of packets x features
-        trainData = np.vstack([pkts for (pkts, times) in allDays])
-        # Create a single matrix of packets x features
-        trainTimes = np.vstack([times for (pkts, times) in allDays])
-
-        allData = np.hstack((trainTimes, trainData))
-        np.save(open("data/train_data.npy", "wb"), allData)
-
-    print("Done!")
-    return allData
-
-
 def _normalizeScore(score):
     """Normalize score on log scale as done in paper."""
     # NOTE: This function is deprecated. This is the equation used in the
@@ -122,101 +52,95 @@ def _normalizeScore(score):
     return (0.1 * log10(score) - 0.6)
 
 
-def _runScoring(clusters, testData):
-    """Run attack detection on test data using clusters from train data."""
+def _runScoring(clusters, store, testDays):
+    """Run attack detection on test data using clusters from train data.
+
+    Returns:
+      - float timestamp of each packet
+      - destination IP of each packet, 0 where not present
+      - FieldScores of the packets
+    """
 
     try:
-        results = np.load(open("data/phad_results.npy", "rb"))
+        scores, packets = FieldScores.load("data/phad_results.npz")
+        results = (packets['time'], packets['dst'], scores)
         print("Loading cached results...", end='')
     except IOError:
         print("Running attack detection...", end='')
         # Initialize last anomaly time to 1 sec before time of first packet.
-        # The first column of testData is the timestamp.
-        lastAnomaly = {key: testData[0][0] - 1 for key in FEATURES}
-        nr = {key: (clusters[key].getTotal(), clusters[key].getDistinct()) for
-              key in FEATURES}
-
-        scores = np.zeros(testData.shape)
-        for packetNum, packet in enumerate(testData):
-            packetHdrs = packet[1:]
-            timestamp = packet[0]
-
-            # Score each field
-            for i, feature in enumerate(FEATURES):
-                # If not anomalous, don't score
-                if clusters[feature].contains(packetHdrs[i]):
-                    continue
-                if packet[i] != -1:
-                    t = timestamp - lastAnomaly[feature]
-                    scores[packetNum][i] = (t * nr[feature][0] /
-                                            nr[feature][1])
-                    lastAnomaly[feature] = timestamp
-
-        # Score the packet and store as last element
-        scores[:, -1] = np.sum(scores[:, 0:-1], axis=1)
-
-        # If the total score of the packet is very small, set it to one so
-        # that the resulting normalization doesn't fail.
-        scores[:, -1][scores[:, -1] < 1] = 1
-
-        results = np.hstack((testData, scores))
-        np.save(open("data/phad_results.npy", "wb"), results)
+        lastAnomaly = np.full(len(FEATURES),
+                              store.times(testDays[0], 0, 1)[0] - 1)
+
+        # The first feature is always scored, and each of the others only
+        # when the previous feature is present, as in the original
+        # experiments. Chunks of each day are read from the store and scored
+        # in parallel, and only the anomalous fields are kept.
+        scores = score_packets(clusters, FEATURES, store, testDays,
+                               lastAnomaly,
+                               checkFeatures=[None] + FEATURES[:-1])
+
+        times = np.concatenate([store.times(day) for day in testDays])
+        destIPs = np.concatenate([store.column(day, 'IPv4_dst')
+                                  for day in testDays])
+        scores.save("data/phad_results.npz", time=times, dst=destIPs)
+        results = (times, destIPs, scores)
 
     print("Done!")
 
     return results
 
 
-def _outputToCSV(results, filename, threshold=0.5):
-    """Classify all attacks with a score above threshold as an attack."""
+def _normalizedAlerts(results, threshold=0.5):
+    """Normalize the packet scores and keep the packets above threshold.
+
+    Inputs:
+      - results : output of _runScoring
+      - threshold : minimum normalized score of an alert
+
+    Returns:
+      - Alerts of the packets above threshold
+    """
+    times, destIPs, scores = results
 
-    outfile = open(filename, "wb")
-    writer = csv.writer(outfile)
+    # If the total score of the packet is very small, set it to one so that
+    # the resulting normalization doesn't fail.
+    total = scores.total.copy()
+    total[total < 1] = 1
 
     # Normalize Scores:
     scaler = MinMaxScaler()
-    origScores = results[:, -1].reshape(-1, 1)
+    origScores = total.reshape(-1, 1)
     logScores = np.log10(origScores)
     scaler.fit(logScores)
-    scaledScores = scaler.transform(logScores)
-    for packet, scaledScore in zip(results, scaledScores):
-        #  for packet in results:
-        datetime = tstamp_to_datetime(packet[0])
-        scores = packet[34:]
-
-        if packet[16] != -1:
-            destIP = socket.inet_ntoa(struct.pack('!L', packet[16]))
-        else:
-            destIP = "0.0.0.0"
-
-        mostAnomalous = FEATURES[scores[0:-1].argmax()]
-        percentage = scores[0:-1].max() / scores[-1]
-        #  score = _normalizeScore(scores[-1])
-
-        if scaledScore >= threshold:
-            writer.writerow([datetime[0],
-                             datetime[1],
-                             destIP,
-                             scaledScore[0],
-                             #  score,
-                             mostAnomalous,
-                             percentage])
-
-    outfile.close()
+    scaledScores = scaler.transform(logScores)[:, 0]
+
+    alerts = np.flatnonzero(scaledScores >= threshold)
+    mostAnomalous, maxScores = scores.take(alerts).most_anomalous()
+    return Alerts(times[alerts], destIPs[alerts], scaledScores[alerts],
+                  mostAnomalous, maxScores / total[alerts], FEATURES)
+
+
+def _outputToCSV(alerts, filename):
+    """Export the alerts as rows of a results file."""
+    write_alerts_csv(alerts, filename)
     print("Output results to file!")
 
 
 def main():
     """Run the PHAD-C32 experiment."""
-    trainData = _parseTrainingData()
-    # Clustering header data
-    clusters = _clusterTraining(trainData)
-    del trainData
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--csv", action="store_true",
+                        help="also export the alerts to " + RESULTS_CSV)
+    args = parser.parse_args()
 
-    testData = _parseTestingData()
-    results = _runScoring(clusters, testData)
-    del testData
-    _outputToCSV(results, "data/phad_results.csv", threshold=0.5)
+    store = open_packet_store(TRAINING_FILES + TESTING_FILES)
+    # Clustering header data
+    clusters = _clusterTraining(store, TRAINING_DAYS)
+    results = _runScoring(clusters, store, TESTING_DAYS)
+    alerts = _normalizedAlerts(results, threshold=0.5)
+    alerts.save(ALERTS_FILE)
+    if args.csv:
+        _outputToCSV(alerts, RESULTS_CSV)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from utils import Alerts, FEATURES
+
+
+class TestAlerts(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "alerts.bin")
+        rs = np.random.RandomState(0)
+        self.alerts = Alerts(9.2e8 + rs.rand(20) * 1e5,
+                             rs.randint(-1, 2 ** 32, 20), rs.rand(20),
+                             rs.randint(0, len(FEATURES), 20), rs.rand(20),
+                             FEATURES)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertAlertsEqual(self, expected, alerts):
+        self.assertEqual(expected.features, alerts.features)
+        for name in ['times', 'dstIPs', 'scores', 'fields', 'shares']:
+            np.testing.assert_array_equal(getattr(expected, name),
+                                          getattr(alerts, name))
+
+    def test_round_trip(self):
+        self.alerts.save(self.filename)
+        self.assertAlertsEqual(self.alerts, Alerts.load(self.filename))
+
+        # Alerts without fields, as raised by the GMM
+        alerts = Alerts([1.5, 2.5], [-1, 7], [0.9, 0.8])
+        alerts.save(self.filename)
+        loaded = Alerts.load(self.filename)
+        self.assertAlertsEqual(alerts, loaded)
+        self.assertEqual(['', ''], loaded.field_names().tolist())
+
+    def test_rejects_csv(self):
+        with open(self.filename, 'w') as f:
+            f.write("04/01/1999,08:00:01,172.16.112.50,0.9,IPv4_ttl,1.0\n")
+        with self.assertRaises(ValueError):
+            Alerts.load(self.filename)
+
+    def test_take_and_concatenate(self):
+        first = self.alerts.take(np.arange(5))
+        rest = self.alerts.take(np.arange(5, 20))
+        self.assertEqual(5, len(first))
+        self.assertEqual([FEATURES[i] for i in self.alerts.fields[:5]],
+                         first.field_names().tolist())
+        self.assertAlertsEqual(self.alerts, Alerts.concatenate([first, rest]))
+        self.assertEqual(0, len(Alerts.concatenate([])))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from check_results import classify_results, evaluate_results, sweep_results
+from check_results import get_attack_info, get_final_results
+from check_results import evaluate_alerts, results_from_alerts, read_results
+from utils import Alerts, FEATURES, tstamp_to_datetime, write_alerts_csv
+from utils.labeler import AttackIndex, int2ip
+
+
+class TestCheckResults(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        dates = ["04/01/1999", "04/02/1999", "04/05/1999"]
+        self.final_results = [
+            {"score": score, "isAttack": isAttack, "date": dates[day]}
+            for score, isAttack, day in zip(
+                np.round(rs.rand(300), 2).tolist(),
+                (rs.rand(300) < 0.2).tolist(),
+                rs.randint(0, 3, 300).tolist(),
+            )
+        ]
+        # Thresholds on and between the scores
+        self.threshold_vals = np.linspace(0, 1, 101)
+
+    def test_sweep_results(self):
+        swept = sweep_results(self.final_results, self.threshold_vals)
+        for i, thresh in enumerate(self.threshold_vals):
+            expected = classify_results(self.final_results, thresh)
+            self.assertEqual(expected, tuple(values[i] for values in swept))
+
+    def test_evaluate_results(self):
+        # No attacks are matched, so only the false positives count
+        num_unique_attacks = 7
+        raw_results = [
+            {"score": r["score"], "date": r["date"], "timestamp": 0.0, "dstIP": "1.2.3.4"}
+            for r in self.final_results
+        ]
+        final_results, data = evaluate_results(
+            raw_results, [], num_unique_attacks, self.threshold_vals
+        )
+        self.assertEqual(len(raw_results), len(final_results))
+        for i, thresh in enumerate(self.threshold_vals):
+            TP, TP_per_day, FP, FP_per_day = classify_results(final_results, thresh)
+            self.assertEqual(FP, data["num_FP"][i])
+            self.assertEqual(FP_per_day, data["num_FP_per_day"][i])
+            self.assertEqual({}, data["num_TP_per_day"][i])
+            self.assertEqual(0.0, data["pc_attacks_detected"][i])
+            self.assertEqual(0.0, data["f1s"][i])
+
+    def test_attack_index(self):
+        rs = np.random.RandomState(1)
+        attack_list = []
+        for i in range(40):
+            start = float(rs.randint(0, 5000))
+            last = "*" if i % 5 == 0 else "%03d" % rs.randint(1, 4)
+            attack_list.append(
+                {
+                    "range": (start, start + rs.randint(0, 300)),
+                    "dstIP": "172.016.%03d.%s" % (rs.randint(0, 2), last),
+                    "name": "attack%d" % i,
+                    "ID": "%d.000000" % (i // 2),
+                }
+            )
+        raw_results = [
+            {
+                "timestamp": float(t),
+                "dstIP": "172.16.%d.%d" % (rs.randint(0, 2), rs.randint(1, 4)),
+                "score": score,
+            }
+            for t, score in zip(rs.randint(-100, 5500, 2000), rs.rand(2000))
+        ]
+        matches = AttackIndex(attack_list).match(
+            [r["timestamp"] for r in raw_results],
+            [(172 << 24) + (16 << 16) + int(r["dstIP"].split(".")[2]) * 256
+             + int(r["dstIP"].split(".")[3]) for r in raw_results],
+        )
+        self.assertTrue(0 < np.sum(matches >= 0) < len(raw_results))
+        for result, match in zip(raw_results, matches):
+            isAttack, attackID, attackName = get_attack_info(result, attack_list)
+            self.assertEqual(isAttack, match >= 0)
+            if isAttack:
+                self.assertEqual(attack_list[match]["name"], attackName)
+
+        # Only the highest scoring result of each attack is kept
+        final_results = get_final_results(raw_results, attack_list)
+        attackIDs = [r["attackID"] for r in final_results if r["isAttack"]]
+        self.assertEqual(len(set(attackIDs)), len(attackIDs))
+        for result in final_results:
+            best = max(
+                r["score"] for r in raw_results if r["attackID"] == result["attackID"]
+            )
+            if result["isAttack"]:
+                self.assertEqual(best, result["score"])
+
+    def test_evaluate_alerts(self):
+        rs = np.random.RandomState(2)
+        attack_list = [
+            {
+                "range": (923058000.0 + 600 * i, 923058000.0 + 600 * i + 30),
+                "dstIP": "172.016.112.%s" % ("*" if i == 3 else "%03d" % i),
+                "name": "attack%d" % i,
+                "ID": "%d.000000" % (i // 2),
+            }
+            for i in range(10)
+        ]
+        # Whole second timestamps, as read back from a results file
+        alerts = Alerts(
+            923058000.0 + rs.randint(-100, 6100, 500),
+            (172 << 24) + (16 << 16) + (112 << 8) + rs.randint(0, 12, 500),
+            np.round(rs.rand(500), 2),
+            rs.randint(0, len(FEATURES), 500),
+            np.round(rs.rand(500), 2),
+            FEATURES,
+        )
+        raw_results = []
+        for i in range(len(alerts)):
+            date, time = tstamp_to_datetime(alerts.times[i])
+            raw_results.append(
+                {
+                    "date": date,
+                    "time": time,
+                    "dstIP": int2ip(alerts.dstIPs[i]),
+                    "score": alerts.scores[i],
+                    "anom_field": FEATURES[alerts.fields[i]],
+                    "anom_field_pc": repr(alerts.shares[i]),
+                    "timestamp": alerts.times[i],
+                }
+            )
+        expected, expectedData = evaluate_results(
+            raw_results, attack_list, 5, self.threshold_vals
+        )
+        final, matches, data = evaluate_alerts(
+            alerts, attack_list, 5, self.threshold_vals
+        )
+        self.assertTrue(0 < np.sum(matches >= 0) < len(final))
+        for key in expectedData:
+            self.assertEqual(list(expectedData[key]), list(data[key]))
+        self.assertEqual(expected, results_from_alerts(final, matches, attack_list))
+
+    def test_alerts_match_results_file(self):
+        rs = np.random.RandomState(3)
+        attack_list = [
+            {
+                "range": (923058000.0 + 600 * i, 923058000.0 + 600 * i + 30),
+                "dstIP": "172.016.112.%03d" % i,
+                "name": "attack%d" % i,
+                "ID": "%d.000000" % i,
+            }
+            for i in range(10)
+        ]
+        # Fractional times within a second of the edges of the attack
+        # windows, some close enough to the next second to be written as it
+        n = 2000
+        edges = 923058000.0 + 600 * rs.randint(0, 10, n) + rs.choice([-60, 90], n)
+        offsets = rs.randint(-2, 2, n) + np.where(
+            rs.rand(n) < 0.2, 1 - rs.rand(n) * 1e-6, rs.rand(n)
+        )
+        alerts = Alerts(
+            edges + offsets,
+            np.where(
+                rs.rand(n) < 0.1, -1, (172 << 24) + (16 << 16) + (112 << 8) + rs.randint(0, 10, n)
+            ),
+            rs.rand(n),
+            rs.randint(0, len(FEATURES), n),
+            rs.rand(n) * 10.0 ** rs.randint(-8, 1, n),
+            FEATURES,
+        )
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "results.csv")
+            write_alerts_csv(alerts, filename)
+            raw_results = read_results(filename)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(len(alerts), len(raw_results))
+        expected, expectedData = evaluate_results(
+            raw_results, attack_list, 10, self.threshold_vals
+        )
+        final, matches, data = evaluate_alerts(
+            alerts, attack_list, 10, self.threshold_vals
+        )
+        self.assertTrue(0 < np.sum(matches >= 0) < len(final))
+        for key in expectedData:
+            self.assertEqual(list(expectedData[key]), list(data[key]))
+        self.assertEqual(expected, results_from_alerts(final, matches, attack_list))
+
+    def test_empty(self):
+        swept = sweep_results([], self.threshold_vals[:3])
+        self.assertEqual(([0] * 3, [{}] * 3, [0] * 3, [{}] * 3), swept)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,6 @@
+import cPickle as pickle
 import unittest
+import numpy as np
 from utils import Clusterer
 
 
@@ -56,6 +58,72 @@ class TestClusterer(unittest.TestCase):
         self.assertTrue(C.contains(6))
         self.assertFalse(C.contains(10))
 
+    def test_merge_ties(self):
+        # Equal gaps merge the leftmost pair, as the list version did
+        C = Clusterer(C=3)
+        for value in [30, 10, 20, 40]:
+            C.add(value)
+        self.assertEqual([[10, 20], [30, 30], [40, 40]], C.getClusters())
+        C.add(50)
+        self.assertEqual([[10, 30], [40, 40], [50, 50]], C.getClusters())
+
+    def test_pickle(self):
+        C = Clusterer(C=2)
+        for value in [1, 2, 8, 3]:
+            C.add(value)
+        loaded = pickle.loads(pickle.dumps(C))
+        self.assertEqual(C.getClusters(), loaded.getClusters())
+
+        # Pickles of the old list of ranges still load
+        old = Clusterer.__new__(Clusterer)
+        old.__setstate__({'C': 2, 'R': 4, 'N': 4,
+                          'clusters': [[1, 3], [8, 8]]})
+        self.assertEqual(C.getClusters(), old.getClusters())
+        self.assertTrue(old.contains(2))
+        old.add(100)
+        self.assertEqual([[1, 8], [100, 100]], old.getClusters())
+
+    def test_add_many(self):
+        values = np.random.RandomState(0).randint(0, 5000, 2000)
+        for C in [2, 32]:
+            one = Clusterer(C=C)
+            for value in values.tolist():
+                one.add(value)
+            many = Clusterer(C=C)
+            many.add_many(values[:500])
+            many.add_many(values[500:])
+            self.assertEqual(one.getClusters(), many.getClusters())
+            self.assertEqual(one.getTotal(), many.getTotal())
+            self.assertEqual(one.getDistinct(), many.getDistinct())
+
+    def test_contains_many(self):
+        C = Clusterer(C=2)
+        self.assertFalse(C.contains_many([1, 2]).any())
+        C.add_many(np.array([1, 2, 8, 3, 2, 9, 100, 7]))
+        values = np.array([0, 1, 6, 9.5, 10, 100, 101])
+        np.testing.assert_array_equal([C.contains(v) for v in values],
+                                      C.contains_many(values))
+
+    def test_merge_shards(self):
+        a = Clusterer(C=3)
+        a.add_many(np.array([1, 2, 3, 20, 21]))
+        b = Clusterer(C=3)
+        b.add_many(np.array([3, 4, 50]))
+        # [3, 3] joins [1, 3], then the closest ranges merge down to C
+        self.assertIs(a, a.merge(b))
+        self.assertEqual([[1, 4], [20, 21], [50, 50]], a.getClusters())
+        self.assertEqual(8, a.getTotal())
+        self.assertEqual(7, a.getDistinct())
+
+    def test_merge_self(self):
+        C = Clusterer(C=4)
+        C.add_many(np.array([1, 5, 9, 30, 31, 70, 2]))
+        clusters, distinct = C.getClusters(), C.getDistinct()
+        C.merge(C)
+        self.assertEqual(clusters, C.getClusters())
+        self.assertEqual(distinct, C.getDistinct())
+        self.assertEqual(14, C.getTotal())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from utils import FieldScores
+
+
+class TestFieldScores(unittest.TestCase):
+
+    def setUp(self):
+        self.features = ['a', 'b', 'c', 'd']
+        self.dense = np.array([[0, 0, 0, 0],
+                               [0, 2.5, 0, 2.5],
+                               [1, 0, 3, 0],
+                               [0, 0, np.nan, 4],
+                               [0, 0, 0, 0.5]])
+        self.scores = FieldScores.from_dense(self.features, self.dense)
+
+    def test_from_dense(self):
+        self.assertEqual(5, len(self.scores))
+        self.assertEqual(7, len(self.scores.scores))
+        np.testing.assert_array_equal(self.dense, self.scores.dense())
+        np.testing.assert_array_equal(self.dense[[1, 3]],
+                                      self.scores.dense([1, 3]))
+        np.testing.assert_array_equal(self.dense.sum(axis=1),
+                                      self.scores.total)
+        np.testing.assert_array_equal(self.dense[:, 2],
+                                      self.scores.column('c'))
+
+    def test_most_anomalous(self):
+        ids, best = self.scores.most_anomalous()
+        np.testing.assert_array_equal(self.dense.argmax(axis=1), ids)
+        np.testing.assert_array_equal(self.dense.max(axis=1), best)
+
+    def test_take(self):
+        for rows in [[0, 2, 3], np.array([False, True, False, True, True]),
+                     []]:
+            taken = self.scores.take(rows)
+            np.testing.assert_array_equal(self.dense[rows], taken.dense())
+            np.testing.assert_array_equal(self.scores.total[rows],
+                                          taken.total)
+
+    def test_without(self):
+        dropped = self.scores.without(['b', 'c'])
+        np.testing.assert_array_equal(
+            self.scores.total - self.dense[:, 1] - self.dense[:, 2],
+            dropped.total)
+        expected = self.dense.copy()
+        expected[:, 1:3] = 0
+        np.testing.assert_array_equal(expected, dropped.dense())
+        self.assertEqual(self.features, dropped.features)
+
+    def test_concatenate(self):
+        parts = [FieldScores.from_dense(self.features, self.dense[:2]),
+                 FieldScores.from_dense(self.features, self.dense[2:2]),
+                 FieldScores.from_dense(self.features, self.dense[2:])]
+        joined = FieldScores.concatenate(parts)
+        np.testing.assert_array_equal(self.dense, joined.dense())
+        np.testing.assert_array_equal(self.scores.total, joined.total)
+
+    def test_save(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "scores.npz")
+            self.scores.save(filename, time=np.arange(5.0))
+            loaded, columns = FieldScores.load(filename)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(self.features, loaded.features)
+        np.testing.assert_array_equal(self.dense, loaded.dense())
+        np.testing.assert_array_equal(self.scores.total, loaded.total)
+        self.assertEqual(['time'], list(columns.keys()))
+        np.testing.assert_array_equal(np.arange(5.0), columns['time'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import csv
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import unittest
+import numpy as np
+from utils import Alerts, FEATURES, write_alerts_csv
+from utils import tstamp_to_datetime, tstamps_to_datetime
+from utils.formatter import format_ips, format_floats
+
+
+class TestFormatter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        rs = np.random.RandomState(0)
+        n = 1000
+        self.alerts = Alerts(9.22e8 + rs.rand(n) * 2e6,
+                             np.where(rs.rand(n) < 0.1, -1,
+                                      rs.randint(0, 2 ** 32, n)),
+                             rs.rand(n), rs.randint(0, len(FEATURES), n),
+                             rs.rand(n) * 10.0 ** rs.randint(-8, 1, n),
+                             FEATURES)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_tstamps_to_datetime(self):
+        # Includes timestamps that round up into the next second
+        tstamps = np.r_[self.alerts.times, np.floor(self.alerts.times[:10])
+                        + 0.9999996, 0.0]
+        dates, times = tstamps_to_datetime(tstamps)
+        self.assertEqual([tstamp_to_datetime(t) for t in tstamps],
+                         [[d, t] for d, t in zip(dates.tolist(),
+                                                 times.tolist())])
+        dates, times = tstamps_to_datetime([])
+        self.assertEqual((0, 0), (len(dates), len(times)))
+
+    def test_format(self):
+        self.assertEqual(["0.0.0.0", "172.16.112.50", "255.255.255.255"],
+                         format_ips([-1, 2886758450, 2 ** 32 - 1]))
+        ips = self.alerts.dstIPs
+        self.assertEqual([socket.inet_ntoa(struct.pack('!L', max(ip, 0)))
+                          for ip in ips], format_ips(ips))
+        values = np.r_[self.alerts.shares, np.nan, 1e16, 1e-5]
+        self.assertEqual([repr(v) for v in values], format_floats(values))
+
+    def test_write_alerts_csv(self):
+        for fields in [True, False]:
+            expected = os.path.join(self.tmpdir, "expected.csv")
+            with open(expected, 'wb') as f:
+                writer = csv.writer(f)
+                for i in range(len(self.alerts)):
+                    dstIP = max(self.alerts.dstIPs[i], 0)
+                    row = (tstamp_to_datetime(self.alerts.times[i]) +
+                           [socket.inet_ntoa(struct.pack('!L', dstIP)),
+                            self.alerts.scores[i]])
+                    if fields:
+                        row += [FEATURES[self.alerts.fields[i]],
+                                self.alerts.shares[i]]
+                    writer.writerow(row)
+
+            filename = os.path.join(self.tmpdir, "results.csv")
+            write_alerts_csv(self.alerts, filename, fields, chunk_size=300)
+            with open(expected, 'rb') as f, open(filename, 'rb') as g:
+                self.assertEqual(f.read(), g.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import numpy as np
+from sklearn.mixture import GaussianMixture
+from sklearn.preprocessing import RobustScaler
+from utils import Clusterer, FEATURES
+from utils import save_phad_model, load_phad_model
+from utils import save_gmm_model, load_gmm_model
+from utils.model_io import write_model_file, read_model_file
+
+
+class TestModelIO(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "model.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_phad_round_trip(self):
+        rs = np.random.RandomState(0)
+        model = {}
+        for feature in FEATURES:
+            model[feature] = Clusterer(C=8)
+            model[feature].add_many(rs.randint(0, 1000, rs.randint(0, 50)))
+        model['IPv4_ttl'].add(0.5)
+        save_phad_model(self.filename, model)
+
+        loaded = load_phad_model(self.filename)
+        self.assertEqual(sorted(model), sorted(loaded))
+        for feature in FEATURES:
+            self.assertEqual(model[feature].getClusters(),
+                             loaded[feature].getClusters())
+            self.assertEqual(model[feature].counts, loaded[feature].counts)
+            self.assertEqual(model[feature].getTotal(),
+                             loaded[feature].getTotal())
+            self.assertEqual(model[feature].getDistinct(),
+                             loaded[feature].getDistinct())
+            self.assertEqual(model[feature].C, loaded[feature].C)
+
+        # Loaded models keep training like the original
+        for clusterer in [model['IPv4_ttl'], loaded['IPv4_ttl']]:
+            clusterer.add_many(np.array([2000, 3000, 5]))
+        self.assertEqual(model['IPv4_ttl'].getClusters(),
+                         loaded['IPv4_ttl'].getClusters())
+
+    def test_phad_features(self):
+        model = {'IPv4_ttl': Clusterer()}
+        model['IPv4_ttl'].add_many(np.array([64, 128]))
+        save_phad_model(self.filename, model)
+        loaded = load_phad_model(self.filename, ['IPv4_ttl'])
+        self.assertEqual([[64, 64], [128, 128]],
+                         loaded['IPv4_ttl'].getClusters())
+        with self.assertRaises(ValueError):
+            load_phad_model(self.filename, FEATURES)
+
+    def test_rejects_other_files(self):
+        write_model_file(self.filename, 'gmm', FEATURES,
+                         {'x': np.arange(3)})
+        with self.assertRaises(ValueError):
+            load_phad_model(self.filename)
+        arrays, _, _ = read_model_file(self.filename, 'gmm')
+        np.testing.assert_array_equal(np.arange(3), arrays['x'])
+
+        # Newer versions of the format are not read
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+        with open(self.filename, 'wb') as f:
+            f.write(data.replace(b'"version": 1', b'"version": 9'))
+        with self.assertRaises(ValueError):
+            read_model_file(self.filename, 'gmm')
+
+        with open(self.filename, 'wb') as f:
+            f.write(b'not a model' + struct.pack('<I', 0))
+        with self.assertRaises(ValueError):
+            read_model_file(self.filename, 'gmm')
+
+    def test_gmm_round_trip(self):
+        rs = np.random.RandomState(0)
+        packets = rs.randint(0, 100, (200, len(FEATURES))).astype(float)
+        scaler = RobustScaler().fit(packets)
+        X = scaler.transform(packets)
+        gmm = GaussianMixture(n_components=2, covariance_type='full',
+                              random_state=0).fit(X)
+        save_gmm_model(self.filename, gmm, scaler)
+
+        loaded, loadedScaler = load_gmm_model(self.filename)
+        np.testing.assert_array_equal(X, loadedScaler.transform(packets))
+        np.testing.assert_allclose(gmm.predict_proba(X),
+                                   loaded.predict_proba(X))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from utils import PacketStore, PacketTable, np_parse_pcap, np_parse_pcap_iter
+from utils import FEATURES
+
+
+class TestPacketStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pcaps = []
+        for day in ["day1", "day2"]:
+            pcap = os.path.join(self.tmpdir, day)
+            shutil.copy("tests/http.cap", pcap)
+            self.pcaps.append(pcap)
+        self.root = os.path.join(self.tmpdir, "store")
+        self.store = PacketStore(self.root)
+        self.store.add_pcaps(self.pcaps)
+        self.data = np_parse_pcap(["tests/http.cap"])[0]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read(self):
+        packets, times = PacketStore(self.root).read(["day1"])
+        np.testing.assert_array_equal(self.data[0], packets)
+        np.testing.assert_array_equal(self.data[1], times)
+
+    def test_parallel_add_pcaps(self):
+        # The days are parsed in parallel into the same columns as one at a
+        # time, and a day listed twice is only parsed once
+        store = PacketStore(os.path.join(self.tmpdir, "parallel"))
+        store.add_pcaps(self.pcaps + self.pcaps[:1], processes=2)
+        self.assertEqual(["day1", "day2"], store.days())
+        for day in ["day1", "day2"]:
+            self.assertEqual(self.store.manifest['days'][day],
+                             store.manifest['days'][day])
+            for name in FEATURES + ['time', 'valid']:
+                np.testing.assert_array_equal(self.store.column(day, name),
+                                              store.column(day, name))
+        reopened = PacketStore(os.path.join(self.tmpdir, "parallel"))
+        self.assertEqual(store.manifest, reopened.manifest)
+
+    def test_narrow_encoded_columns(self):
+        columns = self.store.manifest['days']['day1']['columns']
+        self.assertEqual('uint8', columns['IPv4_ihl']['dtype'])
+        self.assertEqual('uint8', columns['IPv4_ttl']['dtype'])
+        self.assertEqual('uint8', columns['TCP_dataOffset']['dtype'])
+        self.assertNotEqual('plain', columns['Ethernet_dstHi']['encoding'])
+        self.assertNotEqual('plain', columns['UDP_sport']['encoding'])
+
+    def test_column_slices(self):
+        table = PacketTable.from_pcap("tests/http.cap")
+        for feature in FEATURES:
+            for start, stop in [(0, 43), (5, 6), (7, 30), (42, 43)]:
+                np.testing.assert_array_equal(
+                    table.column(feature)[start:stop],
+                    self.store.column("day1", feature, start, stop))
+
+    def test_read_table(self):
+        table = self.store.read_table(["day1"], ['IPv4_ttl', 'UDP_sport'])
+        self.assertEqual(['IPv4_ttl', 'UDP_sport'], table.features())
+        self.assertEqual(np.uint16, table.column('UDP_sport').dtype)
+        np.testing.assert_array_equal(self.data[0][:, [11, 29]],
+                                      table.to_design_matrix())
+
+    def test_projected_blocks(self):
+        columns = ['IPv4_dst', 'IPv4_ttl']
+        expected = list(np_parse_pcap_iter(self.pcaps, block_size=10))
+        blocks = list(self.store.iter_blocks(["day1", "day2"], columns,
+                                             block_size=10))
+        self.assertEqual(len(expected), len(blocks))
+        idx = [FEATURES.index(c) for c in columns]
+        for (exp_pkts, exp_times), (pkts, times) in zip(expected, blocks):
+            np.testing.assert_array_equal(exp_pkts[:, idx], pkts)
+            np.testing.assert_array_equal(exp_times, times)
+
+
+if __name__ == '__main__':
+    unittest.main()
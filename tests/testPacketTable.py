@@ -0,0 +1,46 @@
+import unittest
+import numpy as np
+from utils import PacketTable, np_parse_pcap, FEATURES
+
+
+class TestPacketTable(unittest.TestCase):
+
+    def setUp(self):
+        self.packets, self.times = np_parse_pcap(["tests/http.cap"])[0]
+        self.table = PacketTable.from_pcap("tests/http.cap")
+
+    def test_natural_widths(self):
+        self.assertEqual(np.uint8, self.table.column('IPv4_ttl').dtype)
+        self.assertEqual(np.uint16, self.table.column('TCP_dport').dtype)
+        self.assertEqual(np.uint32, self.table.column('IPv4_dst').dtype)
+        self.assertEqual(np.int64, self.table.time.dtype)
+        self.assertLess(self.table.nbytes * 2,
+                        self.packets.nbytes + self.times.nbytes)
+
+    def test_matches_design_matrix(self):
+        np.testing.assert_array_equal(self.packets,
+                                      self.table.to_design_matrix())
+        np.testing.assert_array_equal(self.times[:, 0], self.table.times())
+
+    def test_present(self):
+        udp = self.packets[:, FEATURES.index('UDP_sport')] != -1
+        np.testing.assert_array_equal(udp, self.table.present('UDP_sport'))
+        self.assertTrue(self.table.present('Ethernet_size').all())
+
+    def test_from_design_matrix(self):
+        table = PacketTable.from_design_matrix(self.packets, self.times)
+        np.testing.assert_array_equal(self.table.time, table.time)
+        np.testing.assert_array_equal(self.table.valid, table.valid)
+        for feature in FEATURES:
+            np.testing.assert_array_equal(self.table.column(feature),
+                                          table.column(feature))
+
+    def test_take_and_concatenate(self):
+        halves = [self.table.take(slice(0, 20)),
+                  self.table.take(slice(20, None))]
+        table = PacketTable.concatenate(halves)
+        np.testing.assert_array_equal(self.packets, table.to_design_matrix())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,62 @@
+import gzip
+import os
+import struct
+import tempfile
 import unittest
-from utils import np_parse_pcap
+import numpy as np
+from utils import np_parse_pcap, np_parse_pcap_iter, np_decode_headers
+from utils import FEATURES
+from utils.pcap_parser import parse_pcap, parse_pkt, split_records
+from utils.diagnostics import ParseDiagnostics
+from utils.predicates import AllOf, AnyOf, FieldIn, InSubnet, Protocol
+from utils.scapy_patch import rdpcap_raw
+
+
+def _reference_design_mat(pkt_list, diagnostics=None):
+    """Build the design matrix one packet at a time with parse_pkt."""
+    design_mat = -1*np.ones((len(pkt_list), len(FEATURES)), dtype=int)
+    for row, (pkt_bytes, wirelen) in enumerate(pkt_list):
+        design_mat[row, FEATURES.index('Ethernet_size')] = wirelen
+        pkt = parse_pkt(pkt_bytes, diagnostics)
+        for header in pkt.keys():
+            for field in pkt[header].keys():
+                col = FEATURES.index(header + '_' + field)
+                design_mat[row, col] = pkt[header][field]
+    return design_mat
+
+
+def _decode(pkt_list, diagnostics=None):
+    """Run np_decode_headers over a list of (bytes, wirelen) tuples."""
+    caplens = np.array([len(b) for b, _ in pkt_list], dtype=int)
+    buf = np.frombuffer(b''.join(b for b, _ in pkt_list), dtype=np.uint8)
+    return np_decode_headers(buf, np.cumsum(caplens) - caplens, caplens,
+                             [w for _, w in pkt_list], diagnostics)
+
+
+def _synthetic_packets():
+    """Packets covering each branch of parse_pkt."""
+    eth = b'\x00\x11\x22\x33\x44\x55\x66\x77\x88\x99\xaa\xbb'
+
+    def ipv4(proto, payload, ihl=5):
+        hdr = struct.pack('>BBHHHBBHLL', 0x40 | ihl, 0x10, 20 + len(payload),
+                          0x1234, 0xE005, 64, proto, 0xBEEF, 0xC0A80001,
+                          0xAC10FFFE)
+        return eth + b'\x08\x00' + hdr + payload
+
+    tcp = struct.pack('>HHLLBBHHH', 1234, 80, 0xDEADBEEF, 0xFEEDF00D, 0x50,
+                      0x12, 512, 0xABCD, 7)
+    tcp_opts = struct.pack('>HHLLBBHHHL', 1234, 25, 1, 2, 0x60, 0x02, 512,
+                           0xABCD, 0, 0x020405B4)
+    pkts = [
+        ipv4(6, tcp + b'payload'),
+        ipv4(6, tcp_opts),
+        ipv4(6, tcp, ihl=6),
+        ipv4(17, struct.pack('>HHHH', 53, 3009, 8, 0x10AF)),
+        ipv4(1, struct.pack('>BBH', 8, 0, 0xF7FF) + b'ping'),
+        ipv4(47, b'\x00' * 8),
+        eth + b'\x08\x06' + b'\x00' * 28,
+    ]
+    return [(p, len(p) + 4) for p in pkts]
 
 
 class TestPcapParser(unittest.TestCase):
@@ -79,5 +136,162 @@ class TestPcapParser(unittest.TestCase):
         self.assertEqual(udpPacket[31], 55)          # UDP Len
         self.assertEqual(udpPacket[32], 0x10AF)      # UDP Checksum
 
+    def test_matches_reference(self):
+        pkts = [(b, m[2]) for b, m in rdpcap_raw("tests/http.cap")]
+        np.testing.assert_array_equal(self.data[0][0],
+                                      _reference_design_mat(pkts))
+
+    def test_parse_pcap(self):
+        pkts = rdpcap_raw("tests/http.cap")
+        parsed = parse_pcap("tests/http.cap")
+        self.assertEqual(len(pkts), len(parsed))
+        self.assertEqual([parse_pkt(b) for b, _ in pkts], parsed)
+
+    def test_decode_synthetic(self):
+        pkts = _synthetic_packets()
+        np.testing.assert_array_equal(_decode(pkts),
+                                      _reference_design_mat(pkts))
+
+    def test_decode_truncated(self):
+        pkts = _synthetic_packets()
+        # Cut the TCP options word and the whole UDP header short
+        truncated = _decode([(pkts[1][0][:56], 100), (pkts[3][0][:36], 100)])
+        self.assertEqual(truncated[0][FEATURES.index('TCP_dataOffset')], 6)
+        self.assertEqual(truncated[0][FEATURES.index('TCP_options')], -1)
+        self.assertEqual(truncated[1][FEATURES.index('IPv4_proto')], 17)
+        self.assertEqual(truncated[1][FEATURES.index('UDP_sport')], -1)
+
+    def test_diagnostics(self):
+        pkts = _synthetic_packets()
+        pkts.append((pkts[3][0][:36], 100))
+        expected = ParseDiagnostics()
+        _reference_design_mat(pkts, expected)
+        actual = ParseDiagnostics()
+        _decode(pkts, actual)
+        self.assertEqual(expected.counts, actual.counts)
+
+        # parse_pkt can't handle truncated Ethernet or IPv4 headers
+        pkts += [(pkts[0][0][:30], 100), (pkts[0][0][:10], 100)]
+        actual = ParseDiagnostics()
+        _decode(pkts, actual)
+        self.assertEqual(1, actual.counts['ipv4_options'])
+        self.assertEqual([2], actual.samples['ipv4_options'])
+        self.assertEqual([7, 8, 9], sorted(
+            actual.samples['truncated_ipv4'] +
+            actual.samples['truncated_udp'] +
+            actual.samples['truncated_ethernet']))
+        self.assertIn("ipv4 options in 1 packets", actual.summary())
+
+        merged = ParseDiagnostics().update(actual).update(actual)
+        self.assertEqual(2, merged.counts['ipv4_options'])
+        self.assertEqual([2], merged.samples['ipv4_options'])
+
+    def test_parse_diagnostics(self):
+        data, diags = np_parse_pcap(["tests/http.cap"] * 2, chunks_per_cpu=7,
+                                    diagnostics=True)
+        self.assertEqual(2, len(data))
+        self.assertEqual([0, 0], [d.total() for d in diags])
+
+    def test_split_records(self):
+        chunks = split_records(["a", "b", "c"], [10, 3, 0], 4)
+        self.assertEqual([("a", 0, 4), ("a", 4, 8), ("a", 8, 10),
+                          ("b", 0, 3), ("c", 0, 0)], chunks)
+
+    def test_chunked_files(self):
+        data = np_parse_pcap(["tests/http.cap"] * 3, chunks_per_cpu=7)
+        self.assertEqual(3, len(data))
+        for packets, times in data:
+            np.testing.assert_array_equal(self.data[0][0], packets)
+            np.testing.assert_array_equal(self.data[0][1], times)
+
+    def test_columns(self):
+        columns = ['IPv4_ttl', 'IPv4_dst']
+        packets, times = np_parse_pcap(["tests/http.cap"],
+                                       columns=columns)[0]
+        idx = [FEATURES.index(c) for c in columns]
+        np.testing.assert_array_equal(self.data[0][0][:, idx], packets)
+        np.testing.assert_array_equal(self.data[0][1], times)
+
+    def test_predicate(self):
+        packets, times = self.data[0]
+        col = {f: packets[:, FEATURES.index(f)] for f in FEATURES}
+        dst = col['IPv4_dst']
+        predicates = [
+            (Protocol('UDP'), col['IPv4_proto'] == 17),
+            (AllOf(Protocol('TCP'), FieldIn('TCP_dport', [80, 25])),
+             np.in1d(col['TCP_dport'], [80, 25])),
+            (InSubnet('145.254.0.0/16'), dst >> 16 == 0x91FE),
+            (AnyOf(InSubnet('65.208.228.223/32', 'IPv4_src'),
+                   FieldIn('UDP_dport', [53])),
+             (col['IPv4_src'] == 0x41D0E4DF) | (col['UDP_dport'] == 53)),
+            (FieldIn('TCP_dport', [12345]), np.zeros(len(dst), dtype=bool)),
+        ]
+        for predicate, expected in predicates:
+            data = np_parse_pcap(["tests/http.cap"] * 2, chunks_per_cpu=7,
+                                 columns=['IPv4_dst'], predicate=predicate)
+            for kept, kept_times in data:
+                np.testing.assert_array_equal(dst[expected].reshape(-1, 1),
+                                              kept)
+                np.testing.assert_array_equal(times[expected], kept_times)
+
+    def test_pushdown_mixed_files(self):
+        # Columns and a predicate together, over split and streamed files
+        packets, times = self.data[0]
+        col = {f: packets[:, FEATURES.index(f)] for f in FEATURES}
+        expected = (col['IPv4_proto'] == 6) & (col['IPv4_dst'] >> 16 == 0x91FE)
+        columns = ['IPv4_ttl', 'IPv4_dst']
+        idx = [FEATURES.index(c) for c in columns]
+        fd, gz = tempfile.mkstemp(suffix='.gz')
+        os.close(fd)
+        try:
+            with open("tests/http.cap", "rb") as src:
+                with gzip.open(gz, 'wb') as dst:
+                    dst.write(src.read())
+            data = np_parse_pcap(["tests/http.cap", gz, "tests/http.cap"],
+                                 chunks_per_cpu=5, columns=columns,
+                                 predicate=AllOf(Protocol('TCP'),
+                                                 InSubnet('145.254.0.0/16')))
+        finally:
+            os.remove(gz)
+        self.assertTrue(expected.any() and not expected.all())
+        for kept, kept_times in data:
+            np.testing.assert_array_equal(packets[expected][:, idx], kept)
+            np.testing.assert_array_equal(times[expected], kept_times)
+
+    def test_empty_file(self):
+        fd, empty = tempfile.mkstemp()
+        with open("tests/http.cap", "rb") as f:
+            os.write(fd, f.read(24))
+        os.close(fd)
+        try:
+            data = np_parse_pcap([empty, "tests/http.cap"])
+        finally:
+            os.remove(empty)
+            os.remove(empty + ".idx.npz")
+        self.assertEqual((0, len(FEATURES)), data[0][0].shape)
+        self.assertEqual((0, 1), data[0][1].shape)
+        np.testing.assert_array_equal(self.data[0][0], data[1][0])
+
+    def test_iter_blocks(self):
+        blocks = list(np_parse_pcap_iter("tests/http.cap", block_size=10))
+        self.assertEqual([10, 10, 10, 10, 3], [len(b[0]) for b in blocks])
+        np.testing.assert_array_equal(self.data[0][0],
+                                      np.vstack([b[0] for b in blocks]))
+        np.testing.assert_array_equal(self.data[0][1],
+                                      np.vstack([b[1] for b in blocks]))
+
+    def test_iter_merges_files(self):
+        blocks = list(np_parse_pcap_iter(["tests/http.cap"] * 2,
+                                         block_size=16))
+        times = np.vstack([b[1] for b in blocks])
+        packets = np.vstack([b[0] for b in blocks])
+        self.assertTrue(np.all(np.diff(times[:, 0]) >= 0))
+        # Ties in time keep the order of the file list
+        both = np.vstack([self.data[0][1]] * 2)[:, 0]
+        order = np.argsort(both, kind='mergesort')
+        np.testing.assert_array_equal(packets,
+                                      np.vstack([self.data[0][0]] * 2)[order])
+
+
 if __name__ == '__main__':
     unittest.main()
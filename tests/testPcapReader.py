@@ -0,0 +1,122 @@
+import gzip
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import numpy as np
+from utils import PcapReader, PacketTable, np_parse_pcap
+from utils.pcap_reader import iter_records
+from utils.scapy_patch import rdpcap_raw
+
+
+class TestPcapReader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pcap = os.path.join(self.tmpdir, "http.cap")
+        shutil.copy("tests/http.cap", self.pcap)
+        self.pkts = rdpcap_raw(self.pcap)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_index(self):
+        reader = PcapReader(self.pcap)
+        self.assertEqual(len(self.pkts), len(reader))
+        for i, (pkt_bytes, (sec, usec, wirelen, caplen)) in \
+                enumerate(self.pkts):
+            self.assertEqual(pkt_bytes, reader.packet(i).tobytes())
+            self.assertEqual(sec, reader.sec[i])
+            self.assertEqual(usec, reader.usec[i])
+            self.assertEqual(wirelen, reader.wirelens[i])
+            self.assertEqual(caplen, reader.caplens[i])
+
+    def test_cached_index(self):
+        reader = PcapReader(self.pcap)
+        self.assertTrue(os.path.exists(self.pcap + '.idx.npz'))
+        cached = PcapReader(self.pcap)
+        np.testing.assert_array_equal(reader.offsets, cached.offsets)
+        np.testing.assert_array_equal(reader.times(), cached.times())
+
+    def test_read_only_dir_index(self):
+        # The index can't be written next to the capture, so it goes to the
+        # cache under the temp dir and is read back from there
+        os.mkdir(self.pcap + '.idx.npz')
+        tempdir = tempfile.tempdir
+        tempfile.tempdir = self.tmpdir
+        try:
+            reader = PcapReader(self.pcap)
+            cache = os.path.join(self.tmpdir, 'pcap_index')
+            self.assertEqual(1, len(os.listdir(cache)))
+            self.assertIsNotNone(reader._load_index())
+            cached = PcapReader(self.pcap)
+            np.testing.assert_array_equal(reader.offsets, cached.offsets)
+        finally:
+            tempfile.tempdir = tempdir
+
+    def test_between(self):
+        reader = PcapReader(self.pcap)
+        times = reader.times()
+        t0, t1 = times[5], times[20]
+        expected = np.nonzero((times >= t0) & (times < t1))[0]
+        np.testing.assert_array_equal(expected, reader.between(t0, t1))
+        self.assertEqual(len(reader), len(reader.between()))
+        self.assertEqual(0, len(reader.between(times[-1] + 1)))
+
+    def test_gzip_stream(self):
+        gz = self.pcap + '.gz'
+        with open(self.pcap, 'rb') as src:
+            with gzip.open(gz, 'wb') as dst:
+                dst.write(src.read())
+        self._assert_same_records(gz)
+
+    def test_pcapng_stream(self):
+        ng = os.path.join(self.tmpdir, "http.pcapng")
+        _write_pcapng(ng, self.pkts)
+        self._assert_same_records(ng)
+
+    def _assert_same_records(self, filename):
+        reader = PcapReader(self.pcap)
+        # A small read size makes records straddle the read boundaries
+        blocks = list(iter_records(filename, read_size=100))
+        self.assertTrue(len(blocks) > 1)
+        self.assertEqual(len(reader), sum(len(b.offsets) for b in blocks))
+        packets = [b.buf[o:o + c].tobytes() for b in blocks
+                   for o, c in zip(b.offsets, b.caplens)]
+        self.assertEqual([reader.packet(i).tobytes()
+                          for i in range(len(reader))], packets)
+        for field in ['caplens', 'wirelens', 'sec', 'usec']:
+            np.testing.assert_array_equal(
+                getattr(reader, field),
+                np.concatenate([getattr(b, field) for b in blocks]))
+
+        expected = np_parse_pcap([self.pcap])[0]
+        actual = np_parse_pcap([filename])[0]
+        np.testing.assert_array_equal(expected[0], actual[0])
+        np.testing.assert_array_equal(expected[1], actual[1])
+        np.testing.assert_array_equal(
+            PacketTable.from_pcap(self.pcap).to_design_matrix(),
+            PacketTable.from_pcap(filename).to_design_matrix())
+
+
+def _write_pcapng(filename, pkts):
+    """Write (bytes, metadata) packets as a microsecond pcapng file."""
+    def block(block_type, body):
+        body += b'\x00' * (-len(body) % 4)
+        length = len(body) + 12
+        return (struct.pack('<II', block_type, length) + body +
+                struct.pack('<I', length))
+
+    with open(filename, 'wb') as f:
+        f.write(block(0x0A0D0D0A, struct.pack('<IHHq', 0x1A2B3C4D, 1, 0, -1)))
+        f.write(block(0x00000001, struct.pack('<HHI', 1, 0, 65535)))
+        for pkt_bytes, (sec, usec, wirelen, caplen) in pkts:
+            ts = sec * 1000000 + usec
+            f.write(block(0x00000006, struct.pack(
+                '<IIIII', 0, ts >> 32, ts & 0xffffffff, caplen, wirelen) +
+                pkt_bytes))
+
+
+if __name__ == '__main__':
+    unittest.main()
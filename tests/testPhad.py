@@ -0,0 +1,238 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import numpy as np
+from utils import Clusterer, PacketStore, FEATURES, train_clusters
+from utils import train_day_models, merge_models, compile_model
+from utils import score_fields
+from utils import score_packets
+from utils.packet_table import FEATURE_BITS
+from utils.phad import BoundsIndex, TableIndex
+
+
+class TestPhad(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        pcaps = []
+        for day in ["day1", "day2"]:
+            pcap = os.path.join(self.tmpdir, day)
+            shutil.copy("tests/http.cap", pcap)
+            pcaps.append(pcap)
+        # The packets of http.cap in reverse, so stored order is not time
+        # order
+        with open("tests/http.cap", "rb") as f:
+            raw = f.read()
+        records = []
+        offset = 24
+        while offset < len(raw):
+            caplen = struct.unpack('<I', raw[offset + 8:offset + 12])[0]
+            records.append(raw[offset:offset + 16 + caplen])
+            offset += 16 + caplen
+        pcaps.append(os.path.join(self.tmpdir, "reversed"))
+        with open(pcaps[-1], "wb") as f:
+            f.write(raw[:24] + b''.join(records[::-1]))
+        self.store = PacketStore(os.path.join(self.tmpdir, "store"))
+        self.store.add_pcaps(pcaps)
+        self.days = ["day2", "day1"]
+
+        # Scoring must not divide by zero or produce NaN anywhere
+        self.errors = np.seterr(all='raise')
+
+    def tearDown(self):
+        np.seterr(**self.errors)
+        shutil.rmtree(self.tmpdir)
+
+    def _sequential(self, C, days):
+        """Train every feature one packet at a time, one day at a time."""
+        clusters = {feature: Clusterer(C) for feature in FEATURES}
+        for day in days:
+            valid = self.store.column(day, 'valid')
+            for feature in FEATURES:
+                present = (valid & FEATURE_BITS[feature]) != 0
+                values = self.store.column(day, feature)[present]
+                for value in values.tolist():
+                    clusters[feature].add(value)
+        return clusters
+
+    def _reference_scores(self, model, testData, lastAnomaly):
+        """Score a block one packet at a time, as the scripts used to."""
+        scores = np.zeros(testData.shape)
+        for packetNum, packet in enumerate(testData):
+            timestamp = packet[0]
+            for i, feature in enumerate(FEATURES):
+                if model[feature].contains(packet[i + 1]):
+                    continue
+                if packet[i] != -1:
+                    t = timestamp - lastAnomaly[feature]
+                    # A feature trained on no values scores 0
+                    if model[feature].getDistinct() > 0:
+                        scores[packetNum][i] = (
+                            t * model[feature].getTotal() /
+                            model[feature].getDistinct())
+                    lastAnomaly[feature] = timestamp
+        return scores[:, :-1]
+
+    def test_train_clusters(self):
+        days = ["reversed"] + self.days
+        for C in [4, 32]:
+            expected = self._sequential(C, days)
+            clusters = train_clusters(self.store, days, C=C, processes=3)
+            self.assertEqual(sorted(FEATURES), sorted(clusters.keys()))
+            for feature in FEATURES:
+                self.assertEqual(expected[feature].getClusters(),
+                                 clusters[feature].getClusters())
+                self.assertEqual(expected[feature].getTotal(),
+                                 clusters[feature].getTotal())
+                self.assertEqual(expected[feature].getDistinct(),
+                                 clusters[feature].getDistinct())
+
+    def test_train_in_stored_order(self):
+        # Adding the reversed day in time order gives another model
+        model = train_clusters(self.store, ["reversed"], C=4)['IPv4_id']
+        expected = self._sequential(4, ["reversed"])['IPv4_id']
+        timeOrder = Clusterer(4)
+        for table in self.store.iter_tables(["reversed"]):
+            timeOrder.add_many(table.column('IPv4_id')[
+                table.present('IPv4_id')])
+        self.assertEqual((expected.getClusters(), expected.getDistinct()),
+                         (model.getClusters(), model.getDistinct()))
+        self.assertNotEqual(timeOrder.getDistinct(), model.getDistinct())
+
+    def test_train_subset(self):
+        clusters = train_clusters(self.store, self.days, ['IPv4_ttl'])
+        self.assertEqual(['IPv4_ttl'], list(clusters.keys()))
+        self.assertEqual(86, clusters['IPv4_ttl'].getTotal())
+
+    def test_merge_day_models(self):
+        models = train_day_models(self.store, self.days)
+        self.assertEqual(sorted(self.days), sorted(models.keys()))
+        whole = train_clusters(self.store, ["day1"])
+        merged = merge_models([models["day1"], models["day2"]])
+        for feature in FEATURES:
+            # Both days hold the same packets
+            self.assertEqual(whole[feature].getClusters(),
+                             merged[feature].getClusters())
+            self.assertEqual(whole[feature].getDistinct(),
+                             merged[feature].getDistinct())
+            self.assertEqual(2 * whole[feature].getTotal(),
+                             merged[feature].getTotal())
+            self.assertEqual(32, merged[feature].C)
+        self.assertTrue(all(len(c.getClusters()) <= 4 for c in
+                            merge_models(models.values(), C=4).values()))
+
+    def test_compile_model(self):
+        model = train_clusters(self.store, self.days, C=4)
+        index = compile_model(model)
+        self.assertIsInstance(index['IPv4_ttl'], TableIndex)
+        self.assertIsInstance(index['TCP_sport'], TableIndex)
+        self.assertIsInstance(index['IPv4_dst'], BoundsIndex)
+        for table in self.store.iter_tables(self.days):
+            for feature in FEATURES:
+                design = table.to_design_matrix([feature])[:, 0]
+                expected = [model[feature].contains(v) for v in design]
+                np.testing.assert_array_equal(
+                    expected, index[feature].contains_many(design))
+                np.testing.assert_array_equal(
+                    expected, index[feature].contains_many(design * 1.0))
+                present = table.present(feature)
+                np.testing.assert_array_equal(
+                    np.array(expected)[present],
+                    index[feature].contains_many(
+                        table.column(feature))[present])
+
+    def test_score_fields(self):
+        model = train_clusters(self.store, ["day1"], C=4)
+        index = compile_model(model)
+        tables = list(self.store.iter_tables(self.days, block_size=30))
+        # Repeated timestamps must score like the loop too
+        times = np.repeat(tables[0].times()[:10], 3)
+        expected = {f: times[0] - 1 for f in FEATURES}
+        lastAnomaly = np.full(len(FEATURES), times[0] - 1)
+        for table in tables:
+            testData = np.hstack((table.times().reshape(-1, 1),
+                                  table.to_design_matrix()))
+            if table is tables[0]:
+                testData[:len(times), 0] = times
+            known = np.column_stack([
+                index[feature].contains_many(testData[:, i + 1])
+                for i, feature in enumerate(FEATURES)])
+            scores = score_fields(model, FEATURES, testData[:, 0],
+                                  ~known & (testData[:, :-1] != -1),
+                                  lastAnomaly)
+            reference = self._reference_scores(model, testData, expected)
+            np.testing.assert_array_equal(reference, scores)
+            self.assertTrue((scores > 0).any())
+            np.testing.assert_array_equal(
+                [expected[f] for f in FEATURES], lastAnomaly)
+        empty = score_fields(model, FEATURES, [],
+                             np.zeros((0, len(FEATURES)), dtype=bool),
+                             lastAnomaly)
+        self.assertEqual((0, len(FEATURES)), empty.shape)
+
+    def test_score_unseen_feature(self):
+        # http.cap has no ICMP packets, so the ICMP features have R == 0
+        # and every ICMP field is anomalous, but scores 0
+        model = train_clusters(self.store, ["day1"], C=4)
+        icmp = [i for i, f in enumerate(FEATURES) if f.startswith('ICMP')]
+        self.assertEqual([0] * len(icmp),
+                         [model[FEATURES[i]].getDistinct() for i in icmp])
+        table = self.store.read_table(["day1"])
+        anomalous = np.zeros((len(table), len(FEATURES)), dtype=bool)
+        anomalous[:, icmp] = True
+        anomalous[::5, FEATURES.index('IPv4_ttl')] = True
+        lastAnomaly = np.full(len(FEATURES), table.times()[0] - 1)
+        scores = score_fields(model, FEATURES, table.times(), anomalous,
+                              lastAnomaly)
+        self.assertTrue((scores[:, icmp] == 0).all())
+        self.assertTrue((scores[::5, FEATURES.index('IPv4_ttl')] > 0).all())
+        totals = []
+        for processes in [1, 3]:
+            scores = score_packets(model, FEATURES, self.store, self.days,
+                                   np.full(len(FEATURES), 0.),
+                                   [None] * len(FEATURES),
+                                   processes=processes, chunk_size=7)
+            self.assertTrue(np.isfinite(scores.total).all())
+            self.assertFalse(np.in1d(scores.ids, icmp).any())
+            totals.append(scores.total)
+        np.testing.assert_array_equal(totals[0], totals[1])
+
+    def test_score_packets(self):
+        model = train_clusters(self.store, ["day1"], C=4)
+        # The days are scored one after another
+        testData = np.vstack([
+            np.hstack((table.times().reshape(-1, 1),
+                       table.to_design_matrix()))
+            for table in [self.store.read_table([day]) for day in self.days]])
+        known = np.column_stack([
+            compile_model(model)[feature].contains_many(testData[:, i + 1])
+            for i, feature in enumerate(FEATURES)])
+        start = np.full(len(FEATURES), testData[0][0] - 1)
+        # Check each feature against the previous one, as the scripts do,
+        # or against itself by default
+        for checkFeatures, checked in [
+                ([None] + FEATURES[:-1], testData[:, :-1] != -1),
+                (None, testData[:, 1:] != -1)]:
+            dense = score_fields(model, FEATURES, testData[:, 0],
+                                 ~known & checked, start.copy())
+            for kwargs in [{'processes': 1},
+                           {'processes': 1, 'chunk_size': 9},
+                           {'processes': 3, 'chunk_size': 7},
+                           {'processes': 3, 'chunk_size': 50}]:
+                lastAnomaly = start.copy()
+                scores = score_packets(model, FEATURES, self.store,
+                                       self.days, lastAnomaly, checkFeatures,
+                                       **kwargs)
+                np.testing.assert_array_equal(dense, scores.dense())
+                # The totals are summed like the rows of the dense matrix
+                np.testing.assert_array_equal(dense.sum(axis=1),
+                                              scores.total)
+                self.assertFalse((scores.scores == 0).any())
+                if kwargs == {'processes': 1}:
+                    expected = lastAnomaly
+                np.testing.assert_array_equal(expected, lastAnomaly)
+
+if __name__ == '__main__':
+    unittest.main()
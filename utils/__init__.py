@@ -1,4 +1,18 @@
 from clusterer import Clusterer
-from pcap_parser import np_parse_pcap, FEATURES
-from time_functions import tstamp_to_datetime
+from pcap_parser import np_parse_pcap, np_parse_pcap_iter, np_decode_headers
+from pcap_parser import FEATURES
+from pcap_reader import PcapReader
+from diagnostics import ParseDiagnostics
+from packet_table import PacketTable
+from time_functions import tstamp_to_datetime, tstamps_to_datetime
+from time_functions import tstamps_to_seconds
 from kdd_parser import Kdd_Parser, Kdd_Schema
+from packet_store import PacketStore, open_packet_store
+from datasets import TRAINING_DAYS, TRAINING_FILES, TESTING_DAYS, TESTING_FILES
+from phad import train_clusters, train_day_models, merge_models
+from phad import compile_model, score_fields, score_packets
+from field_scores import FieldScores
+from model_io import save_phad_model, load_phad_model, PHAD_MODEL
+from model_io import save_gmm_model, load_gmm_model, GMM_MODEL
+from alerts import Alerts
+from formatter import write_alerts_csv
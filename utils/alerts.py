@@ -0,0 +1,73 @@
+"""Alerts raised by the detectors, kept as arrays rather than result rows."""
+import numpy as np
+from model_io import write_model_file, read_model_file
+
+
+class Alerts(object):
+    """The packets a detector flagged, one entry per packet.
+
+    Attributes:
+      - times : float timestamp of each alert
+      - dstIPs : int64 destination IP, 0 or -1 where not present
+      - scores : float normalized score
+      - fields : int16 id of the most anomalous feature, -1 when unknown
+      - shares : float share of the total score held by that feature
+      - features : list of the feature names, indexed by the field ids
+    """
+
+    def __init__(self, times, dstIPs, scores, fields=None, shares=None,
+                 features=()):
+        self.times = np.asarray(times, dtype=float)
+        self.dstIPs = np.asarray(dstIPs, dtype=np.int64)
+        self.scores = np.asarray(scores, dtype=float)
+        if fields is None:
+            fields = np.full(len(self.times), -1)
+        if shares is None:
+            shares = np.zeros(len(self.times))
+        self.fields = np.asarray(fields, dtype=np.int16)
+        self.shares = np.asarray(shares, dtype=float)
+        self.features = list(features)
+
+    def __len__(self):
+        return len(self.times)
+
+    def take(self, rows):
+        """Return new alerts with only the selected rows, in their order."""
+        return Alerts(self.times[rows], self.dstIPs[rows], self.scores[rows],
+                      self.fields[rows], self.shares[rows], self.features)
+
+    def field_names(self):
+        """Return the name of the most anomalous feature of each alert."""
+        names = np.array(self.features + [''], dtype=object)
+        return names[self.fields]
+
+    def save(self, filename):
+        """Save the alerts to a binary file that check_results can read."""
+        write_model_file(filename, 'alerts', self.features,
+                         {'times': self.times, 'dstIPs': self.dstIPs,
+                          'scores': self.scores, 'fields': self.fields,
+                          'shares': self.shares})
+
+    @classmethod
+    def load(cls, filename):
+        """Load alerts written by save.
+
+        Raises:
+          - ValueError if the file does not hold alerts
+        """
+        arrays, _, features = read_model_file(filename, 'alerts')
+        return cls(arrays['times'], arrays['dstIPs'], arrays['scores'],
+                   arrays['fields'], arrays['shares'],
+                   [str(f) for f in features])
+
+    @staticmethod
+    def concatenate(parts, features=()):
+        """Stack several sets of alerts on the same features."""
+        if parts:
+            features = parts[0].features
+        return Alerts(np.concatenate([[]] + [p.times for p in parts]),
+                      np.concatenate([[]] + [p.dstIPs for p in parts]),
+                      np.concatenate([[]] + [p.scores for p in parts]),
+                      np.concatenate([[]] + [p.fields for p in parts]),
+                      np.concatenate([[]] + [p.shares for p in parts]),
+                      features)
@@ -1,39 +1,60 @@
-class Clusterer:
+from bisect import bisect_left, bisect_right
+import heapq
+import numpy as np
+
+# Number of new values add_many adds one at a time before it drops the rest
+# of the column that the grown ranges now cover
+ADD_BATCH = 1024
+
+
+class Clusterer(object):
     """Data structure for clustering continuous data.
 
     Data structure for use in PHAD-C. Stores a list of ranges or clusters up to
     a maximum of C (32 by default). If C is exceeded during training, then we
     find the two closest ranges and merge them.
+
+    The ranges are kept as sorted lists of low and high bounds, so lookups
+    are a binary search, and the gaps between neighbouring ranges are kept
+    in a heap so the closest pair is found without rescanning every range.
+    Each range also counts the distinct values that created it, which lets
+    Clusterers trained on separate shards be merged.
     """
     def __init__(self, C=32):
         """Initialize the Clusterer."""
         self.C = C   # Maximum number of clusters
         self.R = 0   # Approximation of distinct values added
         self.N = 0   # Total number of values added
-        self.clusters = []
+        self.lows = []
+        self.highs = []
+        self.counts = []  # Distinct values added to each range
+        # (gap, left low, left high, right low) of neighbouring ranges.
+        # Entries go stale as ranges change and are skipped when popped.
+        self._gaps = []
 
     def add(self, value):
         """Add a new value to the cluster."""
         # Increment total values counter
         self.N += 1
+        self._insert(value)
 
-        if self.contains(value):
-            return
-
-        # Add item to list and inc distinct value counter
-        self.clusters.append([value, value])
-        self.clusters.sort()
-        self.R += 1
-
-        # Merge clusters if necessary to maintain maximum C
-        if len(self.clusters) > self.C:
-            # Compute distances between each range (ignoring first wraparound)
-            distances = [self.clusters[i][0] - self.clusters[i-1][1]
-                         for i in range(len(self.clusters))][1:]
-            minIndex = distances.index(min(distances))
+    def add_many(self, values):
+        """Add every value of a numpy array, in order.
 
-            self.clusters[minIndex][1] = self.clusters[minIndex + 1][1]
-            self.clusters.remove(self.clusters[minIndex + 1])
+        This gives the same ranges and counts as calling add on each value.
+        Ranges only ever grow, so once a value is covered every later copy
+        of it is too: only the first copy of each value matters, and values
+        that the ranges already cover are dropped a batch at a time.
+        """
+        values = np.asarray(values).ravel()
+        self.N += len(values)
+        _, first = np.unique(values, return_index=True)
+        pending = values[np.sort(first)]
+        while len(pending) > 0:
+            pending = pending[~self.contains_many(pending)]
+            for value in pending[:ADD_BATCH].tolist():
+                self._insert(value)
+            pending = pending[ADD_BATCH:]
 
     def getDistinct(self):
         """Return the approximation of distinct values seen."""
@@ -45,18 +66,136 @@ class Clusterer:
 
     def getClusters(self):
         """Return the list of ranges."""
-        return self.clusters
+        return [[low, high] for low, high in zip(self.lows, self.highs)]
 
     def clear(self):
         """Clear the contents of the Clusterer."""
         self.R = 0
         self.N = 0
-        self.clusters = []
+        self.lows = []
+        self.highs = []
+        self.counts = []
+        self._gaps = []
+
+    def merge(self, other):
+        """Merge the ranges and counts of another Clusterer into this one.
+
+        Overlapping ranges are joined, then the closest ranges are merged
+        until at most C are left. N is the total of both. Values that fall
+        in ranges of both Clusterers may have been seen by both, so each
+        group of overlapping ranges counts the distinct values of whichever
+        side saw more of them, and merging a Clusterer with itself leaves
+        R unchanged.
+
+        Returns:
+          - this Clusterer
+        """
+        ranges = sorted(zip(self.lows, self.highs, self.counts,
+                            [0] * len(self.lows)) +
+                        zip(other.lows, other.highs, other.counts,
+                            [1] * len(other.lows)))
+        lows, highs, counts = [], [], []
+        for low, high, count, side in ranges:
+            if highs and low <= highs[-1]:
+                highs[-1] = max(highs[-1], high)
+                group[side] += count
+                counts[-1] = max(group)
+            else:
+                group = [0, 0]
+                group[side] = count
+                lows.append(low)
+                highs.append(high)
+                counts.append(count)
+
+        self.N += other.N
+        self.R = sum(counts)
+        self.lows, self.highs, self.counts = lows, highs, counts
+        self._rebuildGaps()
+        while len(self.lows) > self.C:
+            self._mergeClosest()
+        return self
 
     def contains(self, value):
         """Check if the value falls into any existing cluster."""
-        for low, high in self.clusters:
-            if value >= low and value <= high:
-                return True
+        i = bisect_right(self.lows, value)
+        return i > 0 and value <= self.highs[i - 1]
+
+    def contains_many(self, values):
+        """Return a boolean mask of the values that fall into a cluster."""
+        values = np.asarray(values)
+        if not self.lows:
+            return np.zeros(values.shape, dtype=bool)
+        i = np.searchsorted(np.array(self.lows), values, 'right')
+        return (i > 0) & (values <= np.array(self.highs)[i - 1])
+
+    def _insert(self, value):
+        """Add a value that has already been counted in N."""
+        i = bisect_right(self.lows, value)
+        if i > 0 and value <= self.highs[i - 1]:
+            return
+
+        # Add item to list and inc distinct value counter
+        self.lows.insert(i, value)
+        self.highs.insert(i, value)
+        self.counts.insert(i, 1)
+        self.R += 1
+        if i > 0:
+            self._pushGap(i - 1)
+        if i + 1 < len(self.lows):
+            self._pushGap(i)
+
+        # Merge clusters if necessary to maintain maximum C
+        if len(self.lows) > self.C:
+            self._mergeClosest()
+
+    def _pushGap(self, i):
+        """Record the gap between range i and range i + 1."""
+        heapq.heappush(self._gaps, (self.lows[i + 1] - self.highs[i],
+                                    self.lows[i], self.highs[i],
+                                    self.lows[i + 1]))
+
+    def _mergeClosest(self):
+        """Merge the two closest neighbouring ranges.
+
+        Ties go to the leftmost pair. Heap entries sort by gap and then by
+        the low of the left range, which is the same order.
+        """
+        while True:
+            _, low, high, nextLow = heapq.heappop(self._gaps)
+            i = bisect_left(self.lows, low)
+            if (i + 1 < len(self.lows) and self.lows[i] == low and
+                    self.highs[i] == high and self.lows[i + 1] == nextLow):
+                break
+
+        self.highs[i] = self.highs[i + 1]
+        self.counts[i] += self.counts[i + 1]
+        del self.lows[i + 1]
+        del self.highs[i + 1]
+        del self.counts[i + 1]
+        if i + 1 < len(self.lows):
+            self._pushGap(i)
+
+        # Drop stale entries once they outnumber the live gaps
+        if len(self._gaps) > 4 * len(self.lows):
+            self._rebuildGaps()
+
+    def _rebuildGaps(self):
+        """Rebuild the gap heap from the current ranges."""
+        self._gaps = []
+        for j in range(len(self.lows) - 1):
+            self._pushGap(j)
 
-        return False
+    def __setstate__(self, state):
+        """Load both this layout and pickles of the old list of ranges."""
+        if 'clusters' in state:
+            clusters = state.pop('clusters')
+            state['lows'] = [low for low, _ in clusters]
+            state['highs'] = [high for _, high in clusters]
+        if 'counts' not in state:
+            # Older pickles don't know which range each value went into
+            state['counts'] = [1] * len(state['lows'])
+            if state['counts']:
+                state['counts'][0] += state['R'] - len(state['lows'])
+        self.__dict__.update(state)
+        if '_gaps' not in state:
+            self._rebuildGaps()
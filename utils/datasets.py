@@ -0,0 +1,32 @@
+"""Days of the 1999 DARPA inside tcpdump data used by the experiments."""
+import os
+
+TRAINING_DIR = "data/training"
+TESTING_DIR = "data/testing"
+
+TRAINING_DAYS = [
+    "week3_monday_inside",
+    "week3_monday_extra_inside",
+    "week3_tuesday_inside",
+    "week3_tuesday_extra_inside",
+    "week3_wednesday_inside",
+    "week3_wednesday_extra_inside",
+    "week3_thursday_inside",
+    "week3_friday_inside",
+]
+
+TESTING_DAYS = [
+    "week4_monday_inside",
+    #  "week4_tuesday_inside",  <-- doesn't exist
+    "week4_wednesday_inside",
+    "week4_thursday_inside",
+    "week4_friday_inside",
+    "week5_monday_inside",
+    "week5_tuesday_inside",
+    "week5_wednesday_inside",
+    "week5_thursday_inside",
+    "week5_friday_inside",
+]
+
+TRAINING_FILES = [os.path.join(TRAINING_DIR, day) for day in TRAINING_DAYS]
+TESTING_FILES = [os.path.join(TESTING_DIR, day) for day in TESTING_DAYS]
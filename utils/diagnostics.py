@@ -0,0 +1,101 @@
+"""Counts of the packets the parser could not fully decode.
+
+Instead of printing a line per bad packet, the parsers record each
+condition in a ParseDiagnostics object, which keeps a counter and the
+packet indices of the first few packets per condition and is summarized once
+per run. A packet index is the 0-based position of the packet's record in
+its capture file, not a byte offset.
+"""
+import numpy as np
+
+# Condition -> description, in the order conditions are summarized
+CONDITIONS = [
+    ('truncated_ethernet', "not enough bytes to parse Ethernet header"),
+    ('truncated_ipv4', "not enough bytes to parse IPv4 header"),
+    ('ipv4_options', "did not parse ipv4 options"),
+    ('truncated_icmp', "not enough bytes to parse ICMP header"),
+    ('truncated_tcp', "not enough bytes to parse TCP header"),
+    ('truncated_tcp_options', "not enough bytes to parse TCP options"),
+    ('truncated_udp', "not enough bytes to parse UDP header"),
+]
+
+# Number of sample packet indices kept per condition
+MAX_SAMPLES = 5
+
+
+class ParseDiagnostics(object):
+    """Per condition counts of packets that were not fully parsed.
+
+    Attributes:
+      - counts : dictionary of condition -> number of packets
+      - samples : dictionary of condition -> sorted list of the first
+        MAX_SAMPLES packet indices (0-based record index within the file)
+    """
+
+    def __init__(self, counts=None, samples=None):
+        self.counts = {name: 0 for name, _ in CONDITIONS}
+        self.samples = {name: [] for name, _ in CONDITIONS}
+        self.counts.update(counts or {})
+        self.samples.update(samples or {})
+
+    def add(self, condition, packet=None):
+        """Count one packet, e.g. from the per packet parse_* functions."""
+        self.counts[condition] += 1
+        if packet is not None:
+            self._add_samples(condition, [packet])
+
+    def record(self, condition, mask, first=0):
+        """Count every packet of a block that has the condition.
+
+        Inputs:
+          - condition : one of the CONDITIONS
+          - mask : boolean array, True for the packets with the condition
+          - first : packet index of the first row of the block
+        """
+        rows = np.flatnonzero(mask)
+        if len(rows) > 0:
+            self.counts[condition] += len(rows)
+            self._add_samples(condition, first + rows[:MAX_SAMPLES])
+
+    def update(self, other):
+        """Add the counts and samples of another ParseDiagnostics."""
+        for name, _ in CONDITIONS:
+            self.counts[name] += other.counts[name]
+            self._add_samples(name, other.samples[name])
+        return self
+
+    def total(self):
+        """Return the number of conditions recorded."""
+        return sum(self.counts.values())
+
+    def summary(self, name=None):
+        """Return one line per condition that was seen.
+
+        Inputs:
+          - name : optional file name to prefix each line with
+        """
+        prefix = "" if name is None else "{}: ".format(name)
+        lines = []
+        for condition, description in CONDITIONS:
+            if self.counts[condition] == 0:
+                continue
+            line = "WARNING: {}{} in {} packets".format(
+                prefix, description, self.counts[condition])
+            if self.samples[condition]:
+                line += " (e.g. packet indices {})".format(
+                    ", ".join(str(p) for p in self.samples[condition]))
+            lines.append(line)
+        return "\n".join(lines)
+
+    def to_dict(self):
+        """Return the diagnostics as a JSON-serializable dictionary."""
+        return {'counts': dict(self.counts), 'samples': dict(self.samples)}
+
+    @classmethod
+    def from_dict(cls, d):
+        """Rebuild diagnostics saved with to_dict."""
+        return cls(d['counts'], d['samples'])
+
+    def _add_samples(self, condition, packets):
+        merged = set(self.samples[condition]) | set(int(p) for p in packets)
+        self.samples[condition] = sorted(merged)[:MAX_SAMPLES]
@@ -0,0 +1,177 @@
+"""Sparse storage for the field scores of PHAD test packets."""
+import numpy as np
+
+
+class FieldScores(object):
+    """Anomaly scores of the fields of a set of packets.
+
+    Most fields of most packets are not anomalous, so only the nonzero
+    field scores are kept, as (row, feature id, score) triples sorted by row
+    and then feature, along with the dense total score of each packet.
+
+    Attributes:
+      - features : list of the scored features, indexed by the feature ids
+      - total : float sum of the field scores of each packet
+      - rows : int64 packet of each nonzero score
+      - ids : int16 feature id of each nonzero score
+      - scores : float64 value of each nonzero score
+    """
+
+    def __init__(self, features, total, rows, ids, scores):
+        self.features = list(features)
+        self.total = np.asarray(total, dtype=float)
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.ids = np.asarray(ids, dtype=np.int16)
+        self.scores = np.asarray(scores, dtype=float)
+
+    def __len__(self):
+        return len(self.total)
+
+    @property
+    def nbytes(self):
+        """Total number of bytes held by the arrays."""
+        return (self.total.nbytes + self.rows.nbytes + self.ids.nbytes +
+                self.scores.nbytes)
+
+    @classmethod
+    def from_dense(cls, features, dense):
+        """Build from a matrix with a row per packet and a column per feature.
+
+        The totals are summed over the rows of the dense matrix, so they are
+        exactly the row sums of the matrix.
+        """
+        dense = np.ascontiguousarray(dense, dtype=float)
+        rows, ids = np.nonzero(dense)
+        return cls(features, _row_totals(dense), rows, ids, dense[rows, ids])
+
+    def dense(self, rows=None):
+        """Return the dense score matrix, or only the given rows of it.
+
+        Inputs:
+          - rows : sorted array of unique packet rows, defaults to all of them
+        """
+        if rows is None:
+            out = np.zeros((len(self), len(self.features)))
+            out[self.rows, self.ids] = self.scores
+            return out
+        rows = np.asarray(rows, dtype=np.int64)
+        out = np.zeros((len(rows), len(self.features)))
+        lo = np.searchsorted(self.rows, rows, 'left')
+        hi = np.searchsorted(self.rows, rows, 'right')
+        entries = _ranges(lo, hi)
+        out[np.repeat(np.arange(len(rows)), hi - lo),
+            self.ids[entries]] = self.scores[entries]
+        return out
+
+    def take(self, rows):
+        """Return new scores with only the selected packets.
+
+        Inputs:
+          - rows : boolean mask of the packets, or sorted array of unique
+            packet rows
+        """
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        rows = rows.astype(np.int64)
+        lo = np.searchsorted(self.rows, rows, 'left')
+        hi = np.searchsorted(self.rows, rows, 'right')
+        entries = _ranges(lo, hi)
+        return FieldScores(self.features, self.total[rows],
+                           np.repeat(np.arange(len(rows)), hi - lo),
+                           self.ids[entries], self.scores[entries])
+
+    def column(self, feature):
+        """Return the dense scores of one feature."""
+        out = np.zeros(len(self))
+        mask = self.ids == self.features.index(feature)
+        out[self.rows[mask]] = self.scores[mask]
+        return out
+
+    def most_anomalous(self):
+        """Return the highest scoring field of each packet.
+
+        Ties go to the first feature, like argmax over a dense row, so
+        packets without any anomalous field get feature id 0.
+
+        Returns:
+          - int feature id of the highest score of each packet
+          - the highest score of each packet, 0 when none is anomalous
+        """
+        ids = np.zeros(len(self), dtype=int)
+        best = np.zeros(len(self))
+        # NaN beats every score, as with argmax and max
+        key = np.where(np.isnan(self.scores), np.inf, self.scores)
+        order = np.lexsort((self.ids, -key, self.rows))
+        rows = self.rows[order]
+        first = order[np.r_[True, rows[1:] != rows[:-1]][:len(rows)]]
+        with np.errstate(invalid='ignore'):
+            keep = ~(self.scores[first] <= 0)
+        ids[self.rows[first][keep]] = self.ids[first][keep]
+        best[self.rows[first][keep]] = self.scores[first][keep]
+        return ids, best
+
+    def without(self, features):
+        """Return the scores with some features dropped.
+
+        The dropped features' scores are subtracted from the totals one
+        feature at a time.
+        """
+        drop = [self.features.index(f) for f in features]
+        total = self.total.copy()
+        for i in drop:
+            total -= self.column(self.features[i])
+        keep = ~np.in1d(self.ids, drop)
+        return FieldScores(self.features, total, self.rows[keep],
+                           self.ids[keep], self.scores[keep])
+
+    def save(self, filename, **columns):
+        """Save the scores, and any per-packet columns, to an .npz file."""
+        np.savez(filename, features=np.array(self.features),
+                 total=self.total, rows=self.rows, ids=self.ids,
+                 scores=self.scores, **columns)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a file written by save.
+
+        Returns:
+          - the FieldScores
+          - dictionary of the other per-packet columns saved with them
+        """
+        data = np.load(filename)
+        names = ['features', 'total', 'rows', 'ids', 'scores']
+        scores = cls([str(f) for f in data['features']],
+                     *[data[name] for name in names[1:]])
+        return scores, {name: data[name] for name in data.files
+                        if name not in names}
+
+    @staticmethod
+    def concatenate(parts):
+        """Stack the packets of several FieldScores of the same features."""
+        offsets = np.cumsum([0] + [len(p) for p in parts])
+        return FieldScores(
+            parts[0].features,
+            np.concatenate([p.total for p in parts]),
+            np.concatenate([p.rows + offset
+                            for p, offset in zip(parts, offsets)]),
+            np.concatenate([p.ids for p in parts]),
+            np.concatenate([p.scores for p in parts]))
+
+
+def _row_totals(dense):
+    """Sum the rows of a C-ordered score matrix.
+
+    The order of the additions matters for the last bits of the totals, so
+    totals are always summed over rows laid out like this.
+    """
+    return np.ascontiguousarray(dense).sum(axis=1)
+
+
+def _ranges(lo, hi):
+    """Return the concatenation of arange(lo[i], hi[i]) for every i."""
+    lengths = hi - lo
+    if lengths.sum() == 0:
+        return np.zeros(0, dtype=np.int64)
+    starts = np.repeat(lo - np.cumsum(np.r_[0, lengths[:-1]]), lengths)
+    return starts + np.arange(lengths.sum())
@@ -0,0 +1,56 @@
+"""Bulk formatting of alerts into the rows of a results file."""
+import numpy as np
+from time_functions import tstamps_to_datetime
+
+# Rows of the alerts formatted and written at a time
+WRITE_CHUNK = 1 << 16
+
+_OCTETS = np.array([str(i) for i in range(256)], dtype=object)
+
+
+def format_ips(ips):
+    """Format integer IP addresses as dotted quads.
+
+    Inputs:
+      - ips : array of integer IP addresses, -1 where not present
+
+    Returns:
+      - list of dotted quad strings, "0.0.0.0" where not present
+    """
+    # Alerts repeat a few addresses many times, so only format each once
+    unique, inverse = np.unique(np.maximum(np.asarray(ips, dtype=np.int64), 0),
+                                return_inverse=True)
+    octets = [_OCTETS[(unique >> shift) & 255] for shift in (24, 16, 8, 0)]
+    quads = octets[0] + '.' + octets[1] + '.' + octets[2] + '.' + octets[3]
+    return quads[inverse].tolist()
+
+
+def format_floats(values):
+    """Format floats as repr, the way the csv module writes them."""
+    return [repr(v) for v in np.asarray(values, dtype=float).tolist()]
+
+
+def write_alerts_csv(alerts, filename, fields=True, chunk_size=WRITE_CHUNK):
+    """Write alerts as the rows of a results file.
+
+    Each row is the date, time, destination IP and score of an alert, and
+    then its most anomalous feature and that feature's share of the score,
+    exactly as csv.writer would write them. The rows are formatted a chunk
+    at a time and written with one call per chunk.
+
+    Inputs:
+      - alerts : Alerts to write, already filtered by their threshold
+      - filename : results file to write
+      - fields : False to leave out the most anomalous feature and its share
+      - chunk_size : number of rows formatted at a time
+    """
+    with open(filename, 'wb') as f:
+        for start in range(0, len(alerts), chunk_size):
+            chunk = alerts.take(slice(start, start + chunk_size))
+            dates, times = tstamps_to_datetime(chunk.times)
+            columns = [dates.tolist(), times.tolist(),
+                       format_ips(chunk.dstIPs), format_floats(chunk.scores)]
+            if fields:
+                columns += [chunk.field_names().tolist(),
+                            format_floats(chunk.shares)]
+            f.write('\r\n'.join(map(','.join, zip(*columns))) + '\r\n')
@@ -111,6 +111,73 @@ def make_attack_list(matches):
     return result, len(attackIDs)
 
 
+class AttackIndex(object):
+    """The attacks of an attack file, indexed to match many results at once.
+
+    Attacks on a single host are keyed by their integer destination IP, and
+    attacks on a whole /24 (a "*" last byte) by the first three bytes of it.
+    The time window of every attack is widened by the leeway once, when the
+    index is built.
+    """
+
+    def __init__(self, attack_list, leeway=60):
+        """
+        Inputs:
+          - attack_list : list of attacks, as returned by read_attack_file
+          - leeway : seconds a result may fall before or after an attack
+        """
+        self.attack_list = attack_list
+        self.exact = []
+        self.wildcard = []
+        for i, attack in enumerate(attack_list):
+            octets = attack["dstIP"].split(".")
+            entry = (
+                attack["range"][0] - leeway,
+                attack["range"][1] + leeway,
+                i,
+            )
+            if octets[3] == "*":
+                key = ip2int(".".join(octets[:3] + ["0"])) >> 8
+                self.wildcard.append((key,) + entry)
+            else:
+                self.exact.append((ip2int(attack["dstIP"]),) + entry)
+
+    def match(self, timestamps, dstIPs):
+        """Find the attack each result belongs to.
+
+        A result belongs to the first attack of the list on its destination
+        IP whose window holds its timestamp, as checkIPsEqual would match it.
+
+        Inputs:
+          - timestamps : float timestamp of each result, NaN when unknown
+          - dstIPs : integer destination IP of each result
+
+        Returns:
+          - int index into attack_list of each result's attack, -1 if none
+        """
+        timestamps = np.asarray(timestamps, dtype=float)
+        dstIPs = np.asarray(dstIPs, dtype=np.int64)
+        none = len(self.attack_list)
+        found = np.full(len(timestamps), none, dtype=np.int64)
+        for keys, entries in [(dstIPs, self.exact), (dstIPs >> 8, self.wildcard)]:
+            if not entries:
+                continue
+            # Sorted by key and then time, the results of one attack are a
+            # contiguous run found by binary search
+            order = np.lexsort((timestamps, keys))
+            keys = keys[order]
+            times = timestamps[order]
+            for key, start, end, i in entries:
+                lo = np.searchsorted(keys, key, "left")
+                hi = np.searchsorted(keys, key, "right")
+                first = lo + np.searchsorted(times[lo:hi], start, "left")
+                last = lo + np.searchsorted(times[lo:hi], end, "right")
+                hits = order[first:last]
+                found[hits] = np.minimum(found[hits], i)
+        found[found == none] = -1
+        return found
+
+
 def ip2int(addr):
     nums = addr.split(".")
     nums = list(map(int, nums))
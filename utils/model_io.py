@@ -0,0 +1,205 @@
+"""Versioned binary files for trained PHAD and GMM models, and their alerts.
+
+A model file is the magic bytes, the length of a JSON header, the header
+itself and then the raw model arrays, each aligned to ALIGN bytes:
+
+    MAGIC | uint32 header length | header | padding | array | padding | ...
+
+The header records the format version, the kind of model, the features the
+model was trained on and the dtype, shape and offset of every array, so the
+arrays are memory mapped straight out of the file on load.
+"""
+import json
+import struct
+import numpy as np
+from clusterer import Clusterer
+from pcap_parser import FEATURES
+
+MAGIC = b'MLIDSMDL'
+MODEL_VERSION = 1
+ALIGN = 64
+
+PHAD_MODEL = "data/phad_model.bin"
+GMM_MODEL = "data/gmm_model.bin"
+
+
+def write_model_file(filename, kind, features, arrays, meta=None):
+    """Write named arrays and a small metadata dictionary to a model file.
+
+    Inputs:
+      - filename : file to write
+      - kind : name of the type of model, checked when the file is read
+      - features : list of the FEATURES the model uses
+      - arrays : dictionary of name -> numpy array
+      - meta : optional JSON-serializable dictionary
+    """
+    arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+    header = {'version': MODEL_VERSION, 'kind': kind,
+              'features': list(features), 'meta': meta or {}, 'arrays': {}}
+    # The arrays start after the header, whose length depends on the
+    # offsets, so grow the start until the header fits in front of it
+    start = 0
+    while True:
+        offset = start
+        for name in sorted(arrays):
+            header['arrays'][name] = {'dtype': arrays[name].dtype.str,
+                                      'shape': list(arrays[name].shape),
+                                      'offset': offset}
+            offset += _aligned(arrays[name].nbytes)
+        encoded = json.dumps(header, sort_keys=True).encode('utf-8')
+        if len(MAGIC) + 4 + len(encoded) <= start:
+            break
+        start = _aligned(len(MAGIC) + 4 + len(encoded))
+
+    with open(filename, 'wb') as f:
+        f.write(MAGIC + struct.pack('<I', len(encoded)) + encoded)
+        for name in sorted(arrays):
+            f.write(b'\0' * (header['arrays'][name]['offset'] - f.tell()))
+            f.write(arrays[name].tobytes())
+
+
+def read_model_file(filename, kind, features=None):
+    """Memory map the arrays of a model file.
+
+    Inputs:
+      - filename : file to read
+      - kind : the kind of model expected
+      - features : if given, the list of features the model must use
+
+    Returns:
+      - dictionary of name -> read-only numpy array
+      - the metadata dictionary
+      - the list of features of the model
+
+    Raises:
+      - ValueError if the file is not a model of the expected kind, version
+        and features
+    """
+    with open(filename, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError("{} is not a model file".format(filename))
+        length, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(length).decode('utf-8'))
+    if header['version'] != MODEL_VERSION:
+        raise ValueError("unsupported model version {}".format(
+            header['version']))
+    if header['kind'] != kind:
+        raise ValueError("{} holds a {} model, not {}".format(
+            filename, header['kind'], kind))
+    if [f for f in header['features'] if f not in FEATURES]:
+        raise ValueError("model features do not match FEATURES")
+    if features is not None and header['features'] != list(features):
+        raise ValueError("model features do not match {}".format(features))
+
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        shape = tuple(spec['shape'])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.zeros(shape, dtype=spec['dtype'])
+        else:
+            arrays[name] = np.memmap(filename, dtype=spec['dtype'], mode='r',
+                                     offset=spec['offset'], shape=shape)
+    return arrays, header['meta'], header['features']
+
+
+def save_phad_model(filename, model):
+    """Save a dictionary of feature -> Clusterer.
+
+    The ranges of every feature are stored back to back in flat arrays,
+    with offsets marking where each feature's ranges start.
+    """
+    features = [f for f in FEATURES if f in model]
+    clusterers = [model[f] for f in features]
+    sizes = [len(c.lows) for c in clusterers]
+    arrays = {
+        'offsets': np.cumsum([0] + sizes).astype(np.int64),
+        'lows': np.array(sum([c.lows for c in clusterers], []), dtype=float),
+        'highs': np.array(sum([c.highs for c in clusterers], []),
+                          dtype=float),
+        'counts': np.array(sum([c.counts for c in clusterers], []),
+                           dtype=np.int64),
+        'N': np.array([c.N for c in clusterers], dtype=np.int64),
+        'R': np.array([c.R for c in clusterers], dtype=np.int64),
+        'C': np.array([c.C for c in clusterers], dtype=np.int64),
+    }
+    write_model_file(filename, 'phad', features, arrays)
+
+
+def load_phad_model(filename, features=None):
+    """Load a model saved with save_phad_model.
+
+    Inputs:
+      - filename : model file
+      - features : if given, the list of features the model must hold
+
+    Returns:
+      - dictionary of feature -> Clusterer
+    """
+    arrays, _, features = read_model_file(filename, 'phad', features)
+    model = {}
+    for i, feature in enumerate(features):
+        rows = slice(arrays['offsets'][i], arrays['offsets'][i + 1])
+        clusterer = Clusterer(int(arrays['C'][i]))
+        clusterer.N = int(arrays['N'][i])
+        clusterer.R = int(arrays['R'][i])
+        clusterer.lows = _bounds(arrays['lows'][rows])
+        clusterer.highs = _bounds(arrays['highs'][rows])
+        clusterer.counts = arrays['counts'][rows].tolist()
+        clusterer._rebuildGaps()
+        model[feature] = clusterer
+    return model
+
+
+def save_gmm_model(filename, gmm, scaler=None):
+    """Save the parameters of a fitted GaussianMixture.
+
+    Inputs:
+      - filename : file to write
+      - gmm : GaussianMixture fitted on all of the FEATURES
+      - scaler : optional fitted RobustScaler applied to the packets first
+    """
+    arrays = {'weights': gmm.weights_, 'means': gmm.means_,
+              'precisions_cholesky': gmm.precisions_cholesky_}
+    meta = {'covariance_type': gmm.covariance_type,
+            'n_components': gmm.n_components}
+    if scaler is not None:
+        arrays['scaler_center'] = scaler.center_
+        arrays['scaler_scale'] = scaler.scale_
+    write_model_file(filename, 'gmm', FEATURES, arrays, meta)
+
+
+def load_gmm_model(filename):
+    """Load a model saved with save_gmm_model.
+
+    Returns:
+      - a GaussianMixture that can predict on scaled packets
+      - the RobustScaler saved with it, or None
+    """
+    from sklearn.mixture import GaussianMixture
+    from sklearn.preprocessing import RobustScaler
+
+    arrays, meta, _ = read_model_file(filename, 'gmm', FEATURES)
+    gmm = GaussianMixture(n_components=meta['n_components'],
+                          covariance_type=meta['covariance_type'])
+    gmm.weights_ = arrays['weights']
+    gmm.means_ = arrays['means']
+    gmm.precisions_cholesky_ = arrays['precisions_cholesky']
+    scaler = None
+    if 'scaler_center' in arrays:
+        scaler = RobustScaler()
+        scaler.center_ = arrays['scaler_center']
+        scaler.scale_ = arrays['scaler_scale']
+    return gmm, scaler
+
+
+def _aligned(n):
+    """Round n up to a multiple of ALIGN."""
+    return -(-n // ALIGN) * ALIGN
+
+
+def _bounds(values):
+    """Return range bounds as a list, using ints when they are whole."""
+    if np.all(np.mod(values, 1) == 0):
+        return values.astype(np.int64).tolist()
+    return values.tolist()
@@ -0,0 +1,336 @@
+"""Columnar on-disk store of parsed packet headers.
+
+Each day (one pcap file) is stored as one .npy file per column under
+<root>/<day>/, so any column of any day can be memory mapped on its own.
+Columns are the FEATURES plus 'time', the packet timestamp in integer
+microseconds, and 'valid', the PacketTable bitmask of present fields. Every
+column is saved with the narrowest integer dtype that holds its values and,
+optionally, dictionary or run-length encoded when that is smaller. A
+manifest.json in the root records the layout. New days are parsed in
+parallel, one process per pcap.
+"""
+from __future__ import print_function
+import json
+import os
+import numpy as np
+from multiprocessing import Pool, cpu_count
+from pcap_parser import np_decode_fields, eprint, FEATURES, BLOCK_SIZE
+from diagnostics import ParseDiagnostics
+from pcap_reader import iter_records
+from packet_table import PacketTable, FEATURE_DTYPES, usec_to_seconds
+
+STORE_VERSION = 2
+STORE_DIR = "data/store"
+TIME_COLUMN = 'time'
+VALID_COLUMN = 'valid'
+
+# Candidate column dtypes, narrowest first
+INT_DTYPES = [np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32,
+              np.int64]
+
+
+class PacketStore(object):
+    """Lazily opened columns of parsed packet headers, one day at a time."""
+
+    def __init__(self, root=STORE_DIR):
+        """Open (or create) the store rooted at the given directory."""
+        self.root = root
+        self._open = {}
+        try:
+            with open(self._manifest_file()) as f:
+                self.manifest = json.load(f)
+        except IOError:
+            self.manifest = {'version': STORE_VERSION, 'features': FEATURES,
+                             'days': {}}
+        if self.manifest['version'] != STORE_VERSION:
+            raise ValueError("unsupported packet store version {}".format(
+                self.manifest['version']))
+        if self.manifest['features'] != FEATURES:
+            raise ValueError("packet store features do not match FEATURES")
+
+    def days(self):
+        """Return the names of the days in the store."""
+        return sorted(self.manifest['days'].keys())
+
+    def num_packets(self, day):
+        """Return the number of packets stored for day."""
+        return self.manifest['days'][day]['packets']
+
+    def add_pcaps(self, pcap_list, encode=True, block_size=BLOCK_SIZE,
+                  processes=None):
+        """Parse any pcaps in pcap_list whose day is not yet stored.
+
+        The day of a pcap is the basename of its filename. The new days are
+        parsed in parallel, one process per day, and the manifest is saved
+        once they are all stored. Packets that could not be fully parsed are
+        summarized on stderr once at the end.
+        """
+        tasks = []
+        added = []
+        for filename in pcap_list:
+            day = os.path.basename(filename)
+            if day not in self.manifest['days'] and day not in added:
+                tasks.append((self.root, filename, day, encode, block_size))
+                added.append(day)
+        if not tasks:
+            return
+        p = Pool(max(1, min(processes or cpu_count(), len(tasks))))
+        try:
+            entries = p.map(_parse_day, tasks)
+        finally:
+            p.close()
+            p.join()
+        for day, entry in zip(added, entries):
+            self.manifest['days'][day] = entry
+        self._save_manifest()
+        summary = "\n".join(self.diagnostics(day).summary(day)
+                            for day in added
+                            if self.diagnostics(day).total() > 0)
+        if summary:
+            eprint(summary)
+
+    def add_pcap(self, filename, day=None, encode=True,
+                 block_size=BLOCK_SIZE):
+        """Parse a capture file and store each of its columns.
+
+        Headers are decoded a block at a time and appended to temporary raw
+        column files, which are then narrowed and encoded one column at a
+        time, so memory use is bounded by a single column. The capture may
+        be compressed or pcapng, see iter_records. Packets that could not
+        be fully parsed are counted in the day's diagnostics.
+        """
+        if day is None:
+            day = os.path.basename(filename)
+        self.manifest['days'][day] = _parse_day((self.root, filename, day,
+                                                 encode, block_size))
+        self._save_manifest()
+
+    def diagnostics(self, day):
+        """Return the ParseDiagnostics recorded when day was parsed."""
+        saved = self.manifest['days'][day].get('diagnostics')
+        if saved is None:
+            return ParseDiagnostics()
+        return ParseDiagnostics.from_dict(saved)
+
+    def column(self, day, name, start=0, stop=None):
+        """Return rows [start, stop) of one column of one day.
+
+        Plain columns are returned as read-only memmap slices. Encoded
+        columns are decoded for just the requested rows.
+        """
+        if stop is None:
+            stop = self.num_packets(day)
+        stop = max(start, stop)
+        meta = self.manifest['days'][day]['columns'][name]
+        if meta['encoding'] == 'plain':
+            return self._load(day, name)[start:stop]
+        values = self._load(day, name + '.values')
+        if meta['encoding'] == 'dict':
+            return values[self._load(day, name + '.codes')[start:stop]]
+        ends = self._load(day, name + '.ends')
+        if start == stop:
+            return values[:0]
+        first = np.searchsorted(ends, start, 'right')
+        last = np.searchsorted(ends, stop, 'left') + 1
+        run_ends = np.minimum(ends[first:last], stop)
+        run_starts = np.maximum(np.concatenate(([0], ends[:-1]))[first:last],
+                                start)
+        return np.repeat(values[first:last], run_ends - run_starts)
+
+    def times(self, day, start=0, stop=None):
+        """Return the float timestamp of each packet of day."""
+        return usec_to_seconds(self.column(day, TIME_COLUMN, start, stop))
+
+    def read(self, days, columns=None):
+        """Read whole days into memory.
+
+        Inputs:
+          - days : list of day names
+          - columns : list of FEATURES to read, defaults to all of them
+
+        Returns:
+          - a numpy matrix where each row is a packet and each column is one
+            of the requested features, -1 where a field is not present
+          - a numpy column array containing the time of each packet
+        """
+        table = self.read_table(days, columns)
+        return (table.to_design_matrix(columns),
+                table.times().reshape(-1, 1))
+
+    def read_table(self, days, features=None):
+        """Read whole days into a single PacketTable."""
+        return next(self.iter_tables(days, features, block_size=None))
+
+    def iter_blocks(self, days, columns=None, block_size=BLOCK_SIZE):
+        """Iterate over the packets of days in timestamp order.
+
+        Only the requested columns are read, a block at a time, so this
+        works like np_parse_pcap_iter without touching the pcap files.
+
+        Yields:
+          - 2 element tuples: (design_matrix, time_vector) for each block
+        """
+        for table in self.iter_tables(days, columns, block_size):
+            yield (table.to_design_matrix(columns),
+                   table.times().reshape(-1, 1))
+
+    def iter_tables(self, days, features=None, block_size=BLOCK_SIZE):
+        """Iterate over the packets of days in timestamp order.
+
+        Inputs:
+          - days : list of day names
+          - features : list of FEATURES to read, defaults to all of them
+          - block_size : maximum number of packets per table, or None for a
+            single table
+
+        Yields:
+          - a PacketTable for each block of packets
+        """
+        if features is None:
+            features = FEATURES
+        usec = np.concatenate([self.column(day, TIME_COLUMN) for day in days]
+                              + [np.zeros(0, dtype=np.int64)])
+        day_ids = np.repeat(np.arange(len(days)),
+                            [self.num_packets(day) for day in days])
+        records = np.concatenate([np.arange(self.num_packets(day))
+                                  for day in days] + [np.zeros(0, dtype=int)])
+        order = np.argsort(usec, kind='mergesort')
+        if block_size is None:
+            starts = [0]
+            block_size = len(order)
+        else:
+            starts = range(0, len(order), block_size)
+
+        for start in starts:
+            block = order[start:start + block_size]
+            columns = {f: np.empty(len(block), dtype=FEATURE_DTYPES[f])
+                       for f in features}
+            valid = np.empty(len(block), dtype=np.uint64)
+            block_days = day_ids[block]
+            for day_id in np.unique(block_days):
+                rows = np.nonzero(block_days == day_id)[0]
+                recs = records[block[rows]]
+                lo, hi = recs.min(), recs.max() + 1
+                for name in features:
+                    values = self.column(days[day_id], name, lo, hi)
+                    columns[name][rows] = values[recs - lo]
+                values = self.column(days[day_id], VALID_COLUMN, lo, hi)
+                valid[rows] = values[recs - lo]
+            yield PacketTable(usec[block], columns, valid)
+
+    def _load(self, day, name):
+        key = (day, name)
+        if key not in self._open:
+            path = os.path.join(self.root, day, name + '.npy')
+            self._open[key] = np.load(path, mmap_mode='r')
+        return self._open[key]
+
+    def _manifest_file(self):
+        return os.path.join(self.root, 'manifest.json')
+
+    def _save_manifest(self):
+        with open(self._manifest_file(), 'w') as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+
+
+def open_packet_store(pcap_list, root=STORE_DIR, encode=True,
+                      processes=None):
+    """Open the store at root, adding any of the pcaps it does not have."""
+    store = PacketStore(root)
+    store.add_pcaps(pcap_list, encode=encode, processes=processes)
+    return store
+
+
+def _parse_day(task):
+    """Parse one capture file into the columns of a day, see add_pcap.
+
+    Inputs:
+      - task : (store root, filename, day, encode, block size) tuple
+
+    Returns:
+      - the manifest entry of the day
+    """
+    root, filename, day, encode, block_size = task
+    day_dir = os.path.join(root, day)
+    if not os.path.exists(day_dir):
+        os.makedirs(day_dir)
+
+    names = [TIME_COLUMN] + FEATURES + [VALID_COLUMN]
+    dtypes = ([np.int64] + [FEATURE_DTYPES[f] for f in FEATURES] +
+              [np.uint64])
+    tmp_files = [os.path.join(day_dir, name + '.tmp') for name in names]
+    num_pkts = 0
+    diagnostics = ParseDiagnostics()
+    outs = [open(f, 'wb') for f in tmp_files]
+    try:
+        for block in iter_records(filename, block_size):
+            values, present = np_decode_fields(block.buf, block.offsets,
+                                               block.caplens, block.wirelens,
+                                               diagnostics, num_pkts)
+            usec = block.sec*1000000 + block.usec
+            table = PacketTable.from_fields(usec, values, present)
+            table.time.tofile(outs[0])
+            for name, out in zip(FEATURES, outs[1:-1]):
+                table.column(name).tofile(out)
+            table.valid.tofile(outs[-1])
+            num_pkts += len(table)
+    finally:
+        for out in outs:
+            out.close()
+    tmp_cols = [np.fromfile(f, dtype=dtype) if num_pkts == 0 else
+                np.memmap(f, mode='r', dtype=dtype, shape=(num_pkts,))
+                for f, dtype in zip(tmp_files, dtypes)]
+
+    columns = {}
+    for name, col in zip(names, tmp_cols):
+        columns[name] = _write_column(day_dir, name, col,
+                                      encode and name != TIME_COLUMN)
+    del tmp_cols, col
+    for f in tmp_files:
+        os.remove(f)
+
+    return {'source': filename, 'packets': num_pkts, 'columns': columns,
+            'diagnostics': diagnostics.to_dict()}
+
+
+def narrow_dtype(values):
+    """Return the smallest integer dtype that holds every value."""
+    if len(values) == 0:
+        return np.dtype(np.uint8)
+    lo, hi = int(values.min()), int(values.max())
+    for dtype in INT_DTYPES:
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def _write_column(day_dir, name, values, encode=True):
+    """Save one column, encoded if that makes it smaller.
+
+    Returns:
+      - the manifest entry describing how the column was saved
+    """
+    values = np.asarray(values)
+    dtype = narrow_dtype(values)
+    path = os.path.join(day_dir, name)
+    sizes = {'plain': len(values) * dtype.itemsize}
+    if encode and len(values) > 0:
+        uniques, codes = np.unique(values, return_inverse=True)
+        code_dtype = narrow_dtype(np.array([len(uniques) - 1]))
+        sizes['dict'] = (len(uniques) * dtype.itemsize +
+                         len(values) * code_dtype.itemsize)
+        ends = np.append(np.nonzero(values[1:] != values[:-1])[0] + 1,
+                         len(values))
+        sizes['rle'] = len(ends) * (dtype.itemsize + ends.itemsize)
+    encoding = min(sizes, key=lambda e: (sizes[e], e != 'plain'))
+
+    if encoding == 'plain':
+        np.save(path + '.npy', values.astype(dtype))
+    elif encoding == 'dict':
+        np.save(path + '.values.npy', uniques.astype(dtype))
+        np.save(path + '.codes.npy', codes.astype(code_dtype))
+    else:
+        np.save(path + '.values.npy', values[ends - 1].astype(dtype))
+        np.save(path + '.ends.npy', ends)
+    return {'dtype': dtype.name, 'encoding': encoding}
@@ -0,0 +1,142 @@
+"""Typed, column-oriented table of parsed packet headers.
+
+A design matrix from np_parse_pcap is int64 with -1 for missing fields, and
+hstacking its float64 time vector onto it upcasts every field to float64.
+A PacketTable instead keeps each field at its natural width, timestamps as
+int64 microseconds, and which fields are present as one bit per feature.
+"""
+import numpy as np
+from pcap_parser import np_decode_fields, FEATURES, FIELD_LAYOUT
+from pcap_reader import iter_records
+
+# Natural width of each feature's values
+_WIDTH_DTYPES = {1: np.uint8, 2: np.uint16, 3: np.uint32, 4: np.uint32}
+FEATURE_DTYPES = {feature: np.dtype(_WIDTH_DTYPES[width])
+                  for feature, (_, width, _, _) in FIELD_LAYOUT.items()}
+FEATURE_DTYPES['Ethernet_size'] = np.dtype(np.uint32)
+
+# Bit of the validity mask that marks each feature as present
+FEATURE_BITS = {feature: np.uint64(1 << i) for i, feature in
+                enumerate(FEATURES)}
+
+
+class PacketTable(object):
+    """Packet header fields stored column by column.
+
+    Attributes:
+      - time : int64 timestamp of each packet in microseconds
+      - columns : dictionary of feature -> numpy array of FEATURE_DTYPES.
+        This may hold only a subset of FEATURES.
+      - valid : uint64 bitmask per packet, bit i is set when FEATURES[i]
+        is present in the packet
+    """
+
+    def __init__(self, time, columns, valid):
+        self.time = np.asarray(time, dtype=np.int64)
+        self.columns = columns
+        self.valid = np.asarray(valid, dtype=np.uint64)
+
+    def __len__(self):
+        return len(self.time)
+
+    def features(self):
+        """Return the features held by the table, in FEATURES order."""
+        return [f for f in FEATURES if f in self.columns]
+
+    def column(self, feature):
+        """Return the values of one feature (0 where it is not present)."""
+        return self.columns[feature]
+
+    def present(self, feature):
+        """Return a boolean mask of the packets that have the feature."""
+        return (self.valid & FEATURE_BITS[feature]) != 0
+
+    def times(self):
+        """Return the float timestamp of each packet in seconds."""
+        return usec_to_seconds(self.time)
+
+    def take(self, rows):
+        """Return a new table with only the selected rows."""
+        return PacketTable(self.time[rows],
+                           {f: c[rows] for f, c in self.columns.items()},
+                           self.valid[rows])
+
+    def to_design_matrix(self, features=None):
+        """Return the int64 design matrix of the table, -1 where absent.
+
+        Inputs:
+          - features : list of features to use as columns, defaults to
+            every feature held by the table
+        """
+        if features is None:
+            features = self.features()
+        design_mat = -1*np.ones((len(self), len(features)), dtype=int)
+        for i, feature in enumerate(features):
+            rows = self.present(feature)
+            design_mat[rows, i] = self.columns[feature][rows]
+        return design_mat
+
+    @property
+    def nbytes(self):
+        """Total number of bytes held by the table's arrays."""
+        return (self.time.nbytes + self.valid.nbytes +
+                sum(c.nbytes for c in self.columns.values()))
+
+    @classmethod
+    def from_fields(cls, usec, values, present, features=None):
+        """Build a table from the output of np_decode_fields."""
+        if features is None:
+            features = FEATURES
+        valid = np.zeros(len(usec), dtype=np.uint64)
+        for feature in FEATURES:
+            valid[present[feature]] |= FEATURE_BITS[feature]
+        columns = {f: values[f].astype(FEATURE_DTYPES[f]) for f in features}
+        return cls(usec, columns, valid)
+
+    @classmethod
+    def from_design_matrix(cls, design_mat, time_arr, features=None):
+        """Build a table from a design matrix and float time vector."""
+        if features is None:
+            features = FEATURES
+        valid = np.zeros(design_mat.shape[0], dtype=np.uint64)
+        columns = {}
+        for i, feature in enumerate(features):
+            rows = design_mat[:, i] != -1
+            valid[rows] |= FEATURE_BITS[feature]
+            col = np.zeros(design_mat.shape[0], dtype=FEATURE_DTYPES[feature])
+            col[rows] = design_mat[rows, i]
+            columns[feature] = col
+        usec = np.round(np.asarray(time_arr).ravel() * 1e6).astype(np.int64)
+        return cls(usec, columns, valid)
+
+    @classmethod
+    def from_pcap(cls, filename, features=None):
+        """Parse a whole capture file into a table."""
+        tables = []
+        for block in iter_records(filename):
+            values, present = np_decode_fields(block.buf, block.offsets,
+                                               block.caplens, block.wirelens)
+            usec = block.sec*1000000 + block.usec
+            tables.append(cls.from_fields(usec, values, present, features))
+        if not tables:
+            return cls(np.zeros(0, dtype=np.int64),
+                       {f: np.zeros(0, dtype=FEATURE_DTYPES[f])
+                        for f in (features or FEATURES)},
+                       np.zeros(0, dtype=np.uint64))
+        return cls.concatenate(tables)
+
+    @staticmethod
+    def concatenate(tables):
+        """Stack the rows of several tables holding the same features."""
+        features = tables[0].features()
+        return PacketTable(
+            np.concatenate([t.time for t in tables]),
+            {f: np.concatenate([t.columns[f] for t in tables])
+             for f in features},
+            np.concatenate([t.valid for t in tables]))
+
+
+def usec_to_seconds(usec):
+    """Convert integer microsecond timestamps to float seconds."""
+    usec = np.asarray(usec, dtype=np.int64)
+    return (usec // 1000000).astype(float) + (usec % 1000000).astype(float)*1e-6
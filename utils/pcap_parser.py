@@ -1,6 +1,8 @@
 from __future__ import print_function
-import sys, os
+import sys, os, shutil, tempfile
 from scapy_patch import *
+from pcap_reader import PcapReader, is_mappable, iter_records
+from diagnostics import ParseDiagnostics
 import types
 import re, csv, struct, socket
 import numpy as np
@@ -11,6 +13,21 @@ PROTO_ICMP = 1
 PROTO_TCP = 6
 PROTO_UDP = 17
 
+# End offsets of the Ethernet and IPv4 headers. IPv4 options are not parsed,
+# so the transport header is always expected right after ETH_END + 20 bytes.
+ETH_END = 14
+IPV4_END = ETH_END + 20
+# Leading bytes of a packet needed to decode every feature: Ethernet, IPv4,
+# a 20 byte TCP header and the first word of TCP options.
+HDR_LEN = IPV4_END + 24
+
+# Default number of packets decoded at a time by np_parse_pcap_iter
+BLOCK_SIZE = 1 << 18
+
+# Chunks of packets np_parse_pcap hands out per core, so that cores which
+# finish early can pick up more work
+CHUNKS_PER_CPU = 4
+
 FEATURES = [
     'Ethernet_size',
     'Ethernet_dstHi',
@@ -47,16 +64,54 @@ FEATURES = [
     'UDP_chksum',
 ]
 
+# Location of each header field within a packet for np_decode_headers:
+# feature -> (byte offset, width in bytes, right shift, bit mask)
+FIELD_LAYOUT = {
+    'Ethernet_dstHi': (0, 3, 0, None),
+    'Ethernet_dstLow': (3, 3, 0, None),
+    'Ethernet_srcHi': (6, 3, 0, None),
+    'Ethernet_srcLow': (9, 3, 0, None),
+    'Ethernet_type': (12, 2, 0, None),
+    'IPv4_ihl': (14, 1, 0, 0b00001111),
+    'IPv4_tos': (15, 1, 0, None),
+    'IPv4_length': (16, 2, 0, None),
+    'IPv4_id': (18, 2, 0, None),
+    'IPv4_offset': (20, 2, 0, 0b0001111111111111),
+    'IPv4_ttl': (22, 1, 0, None),
+    'IPv4_proto': (23, 1, 0, None),
+    'IPv4_chksum': (24, 2, 0, None),
+    'IPv4_src': (26, 4, 0, None),
+    'IPv4_dst': (30, 4, 0, None),
+    'ICMP_type': (34, 1, 0, None),
+    'ICMP_code': (35, 1, 0, None),
+    'ICMP_chksum': (36, 2, 0, None),
+    'TCP_sport': (34, 2, 0, None),
+    'TCP_dport': (36, 2, 0, None),
+    'TCP_seqNo': (38, 4, 0, None),
+    'TCP_ackNo': (42, 4, 0, None),
+    'TCP_dataOffset': (46, 1, 4, None),
+    'TCP_flags': (47, 1, 0, None),
+    'TCP_window': (48, 2, 0, None),
+    'TCP_chksum': (50, 2, 0, None),
+    'TCP_urgPtr': (52, 2, 0, None),
+    'TCP_options': (54, 4, 0, None),
+    'UDP_sport': (34, 2, 0, None),
+    'UDP_dport': (36, 2, 0, None),
+    'UDP_length': (38, 2, 0, None),
+    'UDP_chksum': (40, 2, 0, None),
+}
+
 def eprint(*args, **kwargs):
     """Print to stderr."""
     print(*args, file=sys.stderr, **kwargs)
 
 
-def parse_pcap(filename):
+def parse_pcap(filename, diagnostics=None):
     """Parse a pcap file into a list of packets.
 
     Inputs:
       - filename : a pcap file that contains packets to parse
+      - diagnostics : optional ParseDiagnostics to count bad packets in
 
     Returns:
       - a list of dictionaries representing the parsed packets
@@ -64,37 +119,315 @@ def parse_pcap(filename):
     pkts = rdpcap_raw(filename)
     plist = []
     for p_bytes, _ in pkts:
-        pkt = parse_pkt(p_bytes)
-        pkts.append(pkt)
+        pkt = parse_pkt(p_bytes, diagnostics)
+        plist.append(pkt)
     return plist
 
 
-def np_parse_pcap(pcap_list, outDir=None):
+def np_parse_pcap(pcap_list, outDir=None, chunks_per_cpu=CHUNKS_PER_CPU,
+                  diagnostics=False, columns=None, predicate=None):
     """Parse all of the provided pcap files
+
+    Work is split by packet count rather than by file: every file is cut
+    into record-aligned chunks of about the same number of packets, the
+    chunks are decoded on all cores, and each worker writes its rows
+    straight into memory-mapped output arrays that the parent preallocated
+    (in shared memory when /dev/shm is available), so no results are
+    pickled back through the pool. Compressed (gzip/zstd) and pcapng files
+    can't be split and are streamed by one worker each.
+
+    Packets that could not be fully parsed are counted per file and
+    summarized on stderr once all of the files are parsed.
+
+    Only the requested columns are decoded, and a predicate drops packets
+    from the raw header bytes before anything else is decoded (see
+    np_decode_block and utils.predicates).
+
     Inputs:
       - list of pcap filenames
+      - chunks_per_cpu : number of chunks to split the packets into per core
+      - diagnostics : also return the ParseDiagnostics of each file
+      - columns : list of FEATURES to decode, defaults to all of them
+      - predicate : optional picklable function of a RawHeaders returning a
+        boolean mask of the packets to keep
 
     Returns:
       - A list of 2 element tuples: (design_matrix, time_vector). One for each
-        pcap file
+        pcap file, with a column for each of the requested features
+      - if diagnostics is True, a list of ParseDiagnostics, one for each pcap
+        file
     """
 
     # Catch cases where the caller only passes a single filename
     if isinstance(pcap_list, types.StringTypes):
         pcap_list = [pcap_list]
+    if columns is None:
+        columns = FEATURES
+    width = len(columns)
 
     p = Pool(cpu_count())
-    data_list = p.map(np_parse_pcap_worker, pcap_list)
+    mappable = [is_mappable(filename) for filename in pcap_list]
+    mapped_ids = [i for i, m in enumerate(mappable) if m]
+    streamed_ids = [i for i, m in enumerate(mappable) if not m]
+    # Build (or load) the record index of every mappable file in parallel
+    counts = p.map(_count_packets, [pcap_list[i] for i in mapped_ids])
+    chunks = split_records([pcap_list[i] for i in mapped_ids], counts,
+                           cpu_count() * chunks_per_cpu)
+
+    tmpdir = tempfile.mkdtemp(prefix='np_parse_pcap_', dir=_shm_dir())
+    try:
+        out_files = [(os.path.join(tmpdir, '{}_pkts.npy'.format(i)),
+                      os.path.join(tmpdir, '{}_times.npy'.format(i)))
+                     for i in range(len(pcap_list))]
+
+        # Compressed and pcapng files can't be split, so one worker streams
+        # each of them into raw output files while the chunks are decoded
+        streamed = p.map_async(_np_parse_pcap_stream,
+                               [(pcap_list[i],) + out_files[i] +
+                                (columns, predicate) for i in streamed_ids])
+
+        data_list = [None] * len(pcap_list)
+        diag_list = [ParseDiagnostics() for _ in pcap_list]
+        if predicate is None:
+            for i, count in zip(mapped_ids, counts):
+                data_list[i] = (_open_output(out_files[i][0], (count, width),
+                                             int),
+                                _open_output(out_files[i][1], (count, 1),
+                                             float))
+
+        # Chunks are in file order and each file's first chunk starts at 0
+        tasks = []
+        task_ids = []
+        file_num = -1
+        for chunk_num, (filename, start, stop) in enumerate(chunks):
+            if start == 0:
+                file_num += 1
+            if stop <= start:
+                continue
+            i = mapped_ids[file_num]
+            if predicate is None:
+                outputs = out_files[i]
+            else:
+                # The number of packets kept isn't known up front, so each
+                # chunk gets its own raw output files
+                outputs = tuple(os.path.join(tmpdir, '{}_{}_{}'.format(
+                    i, chunk_num, name)) for name in ('pkts', 'times'))
+            tasks.append((filename, start, stop) + outputs +
+                         (columns, predicate))
+            task_ids.append(i)
+        kept = p.map(_np_parse_pcap_chunk, tasks)
+        for i, (_, diag) in zip(task_ids, kept):
+            diag_list[i].update(diag)
+        if predicate is not None:
+            for i in mapped_ids:
+                parts = [(task[3], task[4], count) for task, j, (count, _) in
+                         zip(tasks, task_ids, kept) if j == i]
+                data_list[i] = _join_outputs(out_files[i], parts, width)
+
+        for i, (count, diag) in zip(streamed_ids, streamed.get()):
+            data_list[i] = (_map_output(out_files[i][0], (count, width), int),
+                            _map_output(out_files[i][1], (count, 1), float))
+            diag_list[i] = diag
+    finally:
+        p.close()
+        p.join()
+        # The parent's mappings stay valid once the files are unlinked
+        shutil.rmtree(tmpdir)
+
+    summary = "\n".join(diag.summary(filename) for filename, diag in
+                        zip(pcap_list, diag_list) if diag.total() > 0)
+    if summary:
+        eprint(summary)
+
     if outDir is not None:
         # save the results
         write_results(outDir, data_list, pcap_list)
+    if diagnostics:
+        return data_list, diag_list
     return data_list
 
 
-def np_parse_pcap_worker(filename):
+def _shm_dir():
+    """Return /dev/shm if it can hold temporary files, otherwise None."""
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return None
+
+
+def _open_output(filename, shape, dtype):
+    """Create a writable .npy memmap that worker processes can fill in."""
+    if shape[0] == 0:
+        # Empty files can't be memory mapped
+        return np.empty(shape, dtype=dtype)
+    return np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                     shape=shape)
+
+
+def split_records(pcap_list, counts, num_chunks):
+    """Split the records of several files into balanced chunks.
+
+    Inputs:
+      - list of pcap filenames
+      - counts : number of packets in each file
+      - num_chunks : target number of chunks across all of the files
+
+    Returns:
+      - list of (filename, start, stop) record ranges, in file order. Every
+        file gets at least one (possibly empty) range.
+    """
+    chunk_size = max(1, -(-sum(counts) // max(1, num_chunks)))
+    chunks = []
+    for filename, count in zip(pcap_list, counts):
+        chunks.append((filename, 0, min(count, chunk_size)))
+        for start in range(chunk_size, count, chunk_size):
+            chunks.append((filename, start, min(count, start + chunk_size)))
+    return chunks
+
+
+def _count_packets(filename):
+    """Return the number of packets in a pcap, building its index."""
+    return len(PcapReader(filename))
+
+
+def _map_output(filename, shape, dtype):
+    """Map a raw output file written by _np_parse_pcap_stream."""
+    if shape[0] == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(filename, mode='r+', dtype=dtype, shape=shape)
+
+
+def _join_outputs(out_files, parts, width):
+    """Concatenate the raw outputs of a file's chunks into .npy memmaps.
+
+    Inputs:
+      - out_files : (pkts_file, time_file) tuple of the joined outputs
+      - parts : list of (pkts_file, time_file, count) tuples, in file order
+      - width : number of columns of the design matrix
+    """
+    total = sum(count for _, _, count in parts)
+    pkts = _open_output(out_files[0], (total, width), int)
+    times = _open_output(out_files[1], (total, 1), float)
+    row = 0
+    for pkts_file, time_file, count in parts:
+        pkts[row:row + count] = _map_output(pkts_file, (count, width), int)
+        times[row:row + count] = _map_output(time_file, (count, 1), float)
+        row += count
+    return pkts, times
+
+
+def _np_parse_pcap_stream(task):
+    """Decode a compressed or pcapng file as a stream into raw outputs.
+
+    Inputs:
+      - task : (filename, pkts_file, time_file, columns, predicate) tuple.
+        The design matrix and times of the kept packets are appended to the
+        output files one block at a time.
+
+    Returns:
+      - the number of packets kept
+      - the ParseDiagnostics of the file
+    """
+    filename, pkts_file, time_file, columns, predicate = task
+    count = 0
+    kept = 0
+    diagnostics = ParseDiagnostics()
+    with open(pkts_file, 'wb') as pkts, open(time_file, 'wb') as times:
+        for block in iter_records(filename):
+            design_mat, rows = np_decode_block(block.buf, block.offsets,
+                                               block.caplens, block.wirelens,
+                                               columns, predicate,
+                                               diagnostics, count)
+            design_mat.astype(int).tofile(pkts)
+            _block_times(block)[rows].tofile(times)
+            count += len(block.offsets)
+            kept += len(rows)
+    return kept, diagnostics
+
+
+def _np_parse_pcap_chunk(task):
+    """Parse a range of records of a pcap file into the output memmaps.
+
+    Inputs:
+      - task : (filename, start, stop, pkts_file, time_file, columns,
+        predicate) tuple. Without a predicate, records [start, stop) are
+        written to the same rows of the .npy files. With one, the kept
+        packets are written to raw files of their own.
+
+    Returns:
+      - the number of packets kept
+      - the ParseDiagnostics of the records
+    """
+    filename, start, stop, pkts_file, time_file, columns, predicate = task
+    reader = PcapReader(filename)
+    diagnostics = ParseDiagnostics()
+    design_mat, rows = np_decode_block(reader.data,
+                                       reader.offsets[start:stop],
+                                       reader.caplens[start:stop],
+                                       reader.wirelens[start:stop],
+                                       columns, predicate, diagnostics, start)
+    time_arr = reader.times()[start:stop][rows]
+    if predicate is not None:
+        design_mat.astype(int).tofile(pkts_file)
+        time_arr.tofile(time_file)
+        return len(rows), diagnostics
+
+    pkts = np.load(pkts_file, mmap_mode='r+')
+    pkts[start:stop] = design_mat
+    times = np.load(time_file, mmap_mode='r+')
+    times[start:stop, 0] = time_arr
+    pkts.flush()
+    times.flush()
+    return len(rows), diagnostics
+
+
+def np_parse_pcap_iter(pcap_list, block_size=BLOCK_SIZE):
+    """Parse the provided pcap files a block of packets at a time.
+
+    Packets from all of the files are merged in timestamp order (ties keep
+    the order of pcap_list), so only one block is ever decoded in memory.
+
+    Inputs:
+      - list of pcap filenames
+      - block_size : maximum number of packets in each block
+
+    Yields:
+      - 2 element tuples: (design_matrix, time_vector) for each block
+    """
+
+    # Catch cases where the caller only passes a single filename
+    if isinstance(pcap_list, types.StringTypes):
+        pcap_list = [pcap_list]
+
+    for filename in pcap_list:
+        if not is_mappable(filename):
+            raise ValueError("np_parse_pcap_iter needs uncompressed libpcap "
+                             "files, add {} to a PacketStore "
+                             "instead".format(filename))
+    readers = [PcapReader(filename) for filename in pcap_list]
+    times = np.concatenate([r.times() for r in readers])
+    file_ids = np.repeat(np.arange(len(readers)), [len(r) for r in readers])
+    records = np.concatenate([np.arange(len(r)) for r in readers])
+    order = np.argsort(times, kind='mergesort')
+
+    for start in range(0, len(order), block_size):
+        block = order[start:start + block_size]
+        design_mat = np.empty((len(block), len(FEATURES)), dtype=int)
+        block_files = file_ids[block]
+        for file_id in np.unique(block_files):
+            rows = np.nonzero(block_files == file_id)[0]
+            recs = records[block[rows]]
+            r = readers[file_id]
+            design_mat[rows] = np_decode_headers(r.data, r.offsets[recs],
+                                                 r.caplens[recs],
+                                                 r.wirelens[recs])
+        yield design_mat, times[block].reshape(-1, 1)
+
+
+def np_parse_pcap_worker(filename, t0=None, t1=None):
     """Parse a pcap file into a numpy matrix.
     Inputs:
       - filename : a pcap file that contains packets to parse
+      - t0, t1 : optionally only parse packets with t0 <= time < t1
 
     Returns:
       - a numpy matrix where each row is a packet and each column is a
@@ -102,45 +435,268 @@ def np_parse_pcap_worker(filename):
       - a numpy column array containing the corresponding time of each packet
     """
 
-    pkts = rdpcap_raw(filename)
-    design_mat = -1*np.ones((len(pkts), len(FEATURES)), dtype=int)
-    time_arr = np.zeros((len(pkts), 1))
-    count = 0
-    for pkt_bytes, (sec, usec, wirelen, caplen) in pkts:
-        time_arr[count] = float(sec) + float(usec)*1e-6
-        ind = FEATURES.index('Ethernet_size')
-        design_mat[count, ind] = wirelen
-        pkt = parse_pkt(pkt_bytes)
-        for header in pkt.keys():
-            for field in pkt[header].keys():
-                key = header + '_' + field
-                ind = FEATURES.index(key)
-                design_mat[count, ind] = pkt[header][field]
-        count += 1
+    if not is_mappable(filename):
+        # Compressed and pcapng files are decoded as a stream
+        blocks = [(np_decode_headers(b.buf, b.offsets, b.caplens, b.wirelens),
+                   _block_times(b)) for b in iter_records(filename)]
+        design_mat = np.vstack([d for d, _ in blocks] +
+                               [np.empty((0, len(FEATURES)), dtype=int)])
+        time_arr = np.concatenate([t for _, t in blocks] + [np.empty(0)])
+        keep = np.ones(len(time_arr), dtype=bool)
+        if t0 is not None:
+            keep &= time_arr >= t0
+        if t1 is not None:
+            keep &= time_arr < t1
+        return design_mat[keep], time_arr[keep].reshape(-1, 1)
+
+    reader = PcapReader(filename)
+    if t0 is None and t1 is None:
+        records = slice(None)
+    else:
+        records = reader.between(t0, t1)
+
+    design_mat = np_decode_headers(reader.data, reader.offsets[records],
+                                   reader.caplens[records],
+                                   reader.wirelens[records])
+    time_arr = reader.times()[records].reshape(-1, 1)
     return design_mat, time_arr
 
 
-def parse_pkt(pkt_bytes):
-    """Parse the given packet byte string into a dictionary."""
+def _block_times(block):
+    """Return the float timestamps of a RecordBlock."""
+    return block.sec.astype(float) + block.usec.astype(float)*1e-6
+
+
+def np_decode_headers(buf, offsets, caplens, wirelens, diagnostics=None,
+                      first=0):
+    """Decode the headers of a block of packets into a design matrix.
+    Inputs:
+      - buf : 1-D uint8 numpy array containing the raw packet bytes
+      - offsets : offset in buf of the first byte of each packet
+      - caplens : number of captured bytes of each packet
+      - wirelens : original length of each packet on the wire
+      - diagnostics, first : see np_decode_fields
+
+    Returns:
+      - a numpy matrix where each row is a packet and each column is a
+        different field, with -1 for fields that are not present
+    """
+    return np_decode_block(buf, offsets, caplens, wirelens,
+                           diagnostics=diagnostics, first=first)[0]
+
+
+def np_decode_block(buf, offsets, caplens, wirelens, columns=None,
+                    predicate=None, diagnostics=None, first=0):
+    """Decode the selected packets and fields of a block into a matrix.
+
+    The predicate is evaluated on the raw header bytes, so only the packets
+    it keeps and the requested columns are decoded.
+
+    Inputs:
+      - buf, offsets, caplens, wirelens : see np_decode_fields
+      - columns : list of FEATURES to decode, defaults to all of them
+      - predicate : optional function of a RawHeaders returning a boolean
+        mask of the packets to keep, e.g. from utils.predicates
+      - diagnostics, first : see np_decode_fields
+
+    Returns:
+      - a numpy matrix where each row is a kept packet and each column is
+        one of the requested fields, with -1 for fields that are not present
+      - the indices of the kept packets within the block
+    """
+    if columns is None:
+        columns = FEATURES
+    headers = RawHeaders(buf, offsets, caplens, wirelens)
+    if diagnostics is not None:
+        _np_diagnose(diagnostics, first, headers)
+    if predicate is None:
+        rows = np.arange(len(headers))
+    else:
+        rows = np.flatnonzero(predicate(headers))
+        headers = headers.take(rows)
+
+    design_mat = -1*np.ones((len(rows), len(columns)), dtype=int)
+    for i, feature in enumerate(columns):
+        present = headers.present(feature)
+        design_mat[present, i] = headers.field(feature)[present]
+    return design_mat, rows
+
+
+def np_decode_fields(buf, offsets, caplens, wirelens, diagnostics=None,
+                     first=0, features=None):
+    """Decode every header field of a block of packets.
+
+    Every field lives at a fixed offset from the start of the packet (IPv4
+    options are not skipped, matching parse_pkt), so the first HDR_LEN bytes
+    of each packet are gathered into a matrix and each feature column is
+    extracted with shifts and masks. Which headers are present is tracked
+    with boolean masks instead of branching per packet.
+
+    Inputs:
+      - buf : 1-D uint8 numpy array containing the raw packet bytes
+      - offsets : offset in buf of the first byte of each packet
+      - caplens : number of captured bytes of each packet
+      - wirelens : original length of each packet on the wire
+      - diagnostics : optional ParseDiagnostics to count bad packets in
+      - first : packet index of the first packet of the block, used for the
+        diagnostics samples
+      - features : list of FEATURES to decode values for, defaults to all
+
+    Returns:
+      - dictionary of feature -> int64 array of field values, with 0 for
+        packets where the field is not present
+      - dictionary of feature -> boolean array, True where the field is
+        present. This always holds every feature.
+    """
+    if features is None:
+        features = FEATURES
+    headers = RawHeaders(buf, offsets, caplens, wirelens)
+    if diagnostics is not None:
+        _np_diagnose(diagnostics, first, headers)
+    values = {feature: headers.field(feature) for feature in features}
+    present = {feature: headers.present(feature) for feature in FEATURES}
+    return values, present
+
+
+class RawHeaders(object):
+    """The leading HDR_LEN bytes of each packet of a block.
+
+    Which headers each packet has is worked out up front, but field values
+    are only extracted when asked for, so predicates can look at a few
+    fields before the rest of the packet is decoded.
+
+    Attributes:
+      - hdr : (packets, HDR_LEN) uint8 matrix, zero past each caplen
+      - caplens : number of captured bytes of each packet
+      - wirelens : original length of each packet on the wire
+      - headers : dictionary of header name -> boolean mask of the packets
+        that have it ('Ethernet', 'IPv4', 'ICMP', 'TCP', 'UDP' and
+        'TCP_options')
+    """
+
+    def __init__(self, buf, offsets, caplens, wirelens):
+        offsets = np.asarray(offsets, dtype=int)
+        caplens = np.asarray(caplens, dtype=int)
+        # Gather the leading bytes of every packet, zeroing anything past
+        # caplen
+        pos = np.arange(HDR_LEN)
+        if len(offsets) == 0:
+            hdr = np.zeros((0, HDR_LEN), dtype=np.uint8)
+        else:
+            idx = np.minimum(offsets[:, None] + pos, len(buf) - 1)
+            hdr = np.take(buf, idx)
+            hdr[pos >= caplens[:, None]] = 0
+        self._set(hdr, caplens, np.asarray(wirelens, dtype=np.int64))
+
+    def _set(self, hdr, caplens, wirelens):
+        self.hdr = hdr
+        self.caplens = caplens
+        self.wirelens = wirelens
+        self.eth_type = _np_field(hdr, 12, 2)
+        self.proto = _np_field(hdr, 23, 1)
+        headers = {}
+        headers['Ethernet'] = caplens >= ETH_END
+        headers['IPv4'] = (headers['Ethernet'] &
+                           (self.eth_type == TYPE_IPV4) &
+                           (caplens >= IPV4_END))
+        headers['ICMP'] = (headers['IPv4'] & (self.proto == PROTO_ICMP) &
+                           (caplens >= IPV4_END + 4))
+        headers['TCP'] = (headers['IPv4'] & (self.proto == PROTO_TCP) &
+                          (caplens >= IPV4_END + 20))
+        headers['UDP'] = (headers['IPv4'] & (self.proto == PROTO_UDP) &
+                          (caplens >= IPV4_END + 8))
+        # The first options word is only parsed if the data offset says so
+        headers['TCP_options'] = (headers['TCP'] &
+                                  ((_np_field(hdr, 46, 1) >> 4) > 5) &
+                                  (caplens >= HDR_LEN))
+        self.headers = headers
+
+    def __len__(self):
+        return len(self.caplens)
+
+    def present(self, feature):
+        """Return a boolean mask of the packets that have the feature."""
+        if feature == 'Ethernet_size':
+            return np.ones(len(self), dtype=bool)
+        return self.headers.get(feature,
+                                self.headers[feature.split('_')[0]])
+
+    def field(self, feature):
+        """Return the int64 values of a feature, 0 where it is not present."""
+        if feature == 'Ethernet_size':
+            return self.wirelens.copy()
+        start, width, shift, mask = FIELD_LAYOUT[feature]
+        col = _np_field(self.hdr, start, width) >> shift
+        if mask is not None:
+            col &= mask
+        col[~self.present(feature)] = 0
+        return col
+
+    def take(self, rows):
+        """Return the headers of only the selected packets."""
+        taken = RawHeaders.__new__(RawHeaders)
+        taken._set(self.hdr[rows], self.caplens[rows], self.wirelens[rows])
+        return taken
+
+
+def _np_diagnose(diagnostics, first, headers):
+    """Record the packets of a RawHeaders that can't be fully decoded."""
+    has = headers.headers
+    ipv4 = has['Ethernet'] & (headers.eth_type == TYPE_IPV4)
+    diagnostics.record('truncated_ethernet', ~has['Ethernet'], first)
+    diagnostics.record('truncated_ipv4', ipv4 & ~has['IPv4'], first)
+    diagnostics.record('ipv4_options',
+                       has['IPv4'] & (headers.field('IPv4_ihl') > 5), first)
+    for name, proto_num in [('ICMP', PROTO_ICMP), ('TCP', PROTO_TCP),
+                            ('UDP', PROTO_UDP)]:
+        diagnostics.record('truncated_' + name.lower(),
+                           has['IPv4'] & (headers.proto == proto_num) &
+                           ~has[name], first)
+    diagnostics.record('truncated_tcp_options',
+                       has['TCP'] & (headers.field('TCP_dataOffset') > 5) &
+                       ~has['TCP_options'], first)
+
+
+def _np_field(hdr, start, width):
+    """Read a big-endian unsigned field from every row of a header matrix."""
+    col = np.zeros(hdr.shape[0], dtype=np.int64)
+    for i in range(start, start + width):
+        col <<= 8
+        col |= hdr[:, i]
+    return col
+
+
+def parse_pkt(pkt_bytes, diagnostics=None):
+    """Parse the given packet byte string into a dictionary.
+
+    Packets that can't be fully parsed are counted in diagnostics (a
+    ParseDiagnostics), if given.
+    """
     pkt = {}
-    pkt['Ethernet'], pkt_bytes = parse_ethernet(pkt_bytes)
+    pkt['Ethernet'], pkt_bytes = parse_ethernet(pkt_bytes, diagnostics)
     if pkt['Ethernet']['type'] == TYPE_IPV4:
-        pkt['IPv4'], pkt_bytes = parse_ipv4(pkt_bytes)
+        pkt['IPv4'], pkt_bytes = parse_ipv4(pkt_bytes, diagnostics)
         if pkt['IPv4']['proto'] == PROTO_ICMP:
-            pkt['ICMP'], pkt_bytes = parse_icmp(pkt_bytes)
+            pkt['ICMP'], pkt_bytes = parse_icmp(pkt_bytes, diagnostics)
         elif pkt['IPv4']['proto'] == PROTO_TCP:
-            pkt['TCP'], pkt_bytes = parse_tcp(pkt_bytes)
+            pkt['TCP'], pkt_bytes = parse_tcp(pkt_bytes, diagnostics)
         elif pkt['IPv4']['proto'] == PROTO_UDP:
-            pkt['UDP'], pkt_bytes = parse_udp(pkt_bytes)
+            pkt['UDP'], pkt_bytes = parse_udp(pkt_bytes, diagnostics)
     return pkt
 
 
-def parse_ethernet(pkt_bytes):
+def _count(diagnostics, condition):
+    """Count a bad packet if the caller is collecting diagnostics."""
+    if diagnostics is not None:
+        diagnostics.add(condition)
+
+
+def parse_ethernet(pkt_bytes, diagnostics=None):
     """Parse the Ethernet header out of the given bytes."""
     total_len = 14
     eth = {}
     if len(pkt_bytes) < total_len:
-        eprint("ERROR: not enough bytes to parse Ethernet header")
+        _count(diagnostics, 'truncated_ethernet')
         return eth, pkt_bytes
     eth['dstHi'] = struct.unpack(">L", '\x00' + pkt_bytes[0:3])[0]
     eth['dstLow'] = struct.unpack(">L", '\x00' + pkt_bytes[3:6])[0]
@@ -150,16 +706,16 @@ def parse_ethernet(pkt_bytes):
     return eth, pkt_bytes[total_len:]
 
 
-def parse_ipv4(pkt_bytes):
+def parse_ipv4(pkt_bytes, diagnostics=None):
     total_len = 20
     ipv4 = {}
     if len(pkt_bytes) < total_len:
-        eprint("ERROR: not enough bytes to parse IPv4 header")
+        _count(diagnostics, 'truncated_ipv4')
         return ipv4, pkt_bytes
     # only want least significant bits
     ipv4['ihl'] = struct.unpack(">B", pkt_bytes[0:1])[0] & 0b00001111
     if (ipv4['ihl'] > 5):
-        eprint("WARNING: did not parse ipv4 options from packet")
+        _count(diagnostics, 'ipv4_options')
     ipv4['tos'] = struct.unpack(">B", pkt_bytes[1:2])[0]
     ipv4['length'] = struct.unpack(">H", pkt_bytes[2:4])[0]
     ipv4['id'] = struct.unpack(">H", pkt_bytes[4:6])[0]
@@ -175,11 +731,11 @@ def parse_ipv4(pkt_bytes):
     return ipv4, pkt_bytes[total_len:]
 
 
-def parse_icmp(pkt_bytes):
+def parse_icmp(pkt_bytes, diagnostics=None):
     total_len = 4
     icmp = {}
     if len(pkt_bytes) < total_len:
-        eprint("ERROR: not enough bytes to parse ICMP header")
+        _count(diagnostics, 'truncated_icmp')
         return icmp, pkt_bytes
     icmp['type'] = struct.unpack(">B", pkt_bytes[0:1])[0]
     icmp['code'] = struct.unpack(">B", pkt_bytes[1:2])[0]
@@ -187,11 +743,11 @@ def parse_icmp(pkt_bytes):
     return icmp, pkt_bytes[total_len:]
 
 
-def parse_tcp(pkt_bytes):
+def parse_tcp(pkt_bytes, diagnostics=None):
     total_len = 20
     tcp = {}
     if len(pkt_bytes) < total_len:
-        eprint("ERROR: not enough bytes to parse TCP header")
+        _count(diagnostics, 'truncated_tcp')
         return tcp, pkt_bytes
     tcp['sport'] = struct.unpack(">H", pkt_bytes[0:2])[0]
     tcp['dport'] = struct.unpack(">H", pkt_bytes[2:4])[0]
@@ -210,11 +766,11 @@ def parse_tcp(pkt_bytes):
     return tcp, pkt_bytes[total_len:]
 
 
-def parse_udp(pkt_bytes):
+def parse_udp(pkt_bytes, diagnostics=None):
     total_len = 8
     udp = {}
     if len(pkt_bytes) < total_len:
-        eprint("ERROR: not enough bytes to parse UDP header")
+        _count(diagnostics, 'truncated_udp')
         return udp, pkt_bytes
     udp['sport'] = struct.unpack(">H", pkt_bytes[0:2])[0]
     udp['dport'] = struct.unpack(">H", pkt_bytes[2:4])[0]
@@ -0,0 +1,392 @@
+"""Memory-mapped access to classic libpcap files.
+
+Instead of reading every packet into a Python list, the capture file is
+mapped into memory and a single pass over the record headers builds an index
+of record offsets, lengths and timestamps. The index is saved next to the
+capture (as <filename>.idx.npz), or under the temp directory when the
+capture's directory is read-only, so later runs and every parser worker
+skip straight to decoding.
+
+Captures that can't be mapped (gzip or zstd compressed files and pcapng
+files) are read as a stream instead, see iter_records.
+"""
+from __future__ import print_function
+import gzip
+import hashlib
+import os
+import struct
+import tempfile
+from collections import namedtuple
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+PCAP_GLOBAL_HDR_LEN = 24
+PCAP_RECORD_HDR_LEN = 16
+
+# magic number -> (struct byte order, timestamp fraction units per second)
+PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1000000),
+    b'\xa1\xb2\xc3\xd4': ('>', 1000000),
+    b'\x4d\x3c\xb2\xa1': ('<', 1000000000),
+    b'\xa1\xb2\x3c\x4d': ('>', 1000000000),
+}
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+PCAPNG_IDB = 0x00000001
+PCAPNG_PB = 0x00000002
+PCAPNG_EPB = 0x00000006
+PCAPNG_OPT_TSRESOL = 9
+
+# Bytes read from a compressed or pcapng stream at a time
+READ_SIZE = 1 << 24
+
+# A block of packet records. buf holds the raw bytes and offsets/caplens
+# locate each packet within it, as taken by np_decode_headers.
+RecordBlock = namedtuple('RecordBlock', ['buf', 'offsets', 'caplens',
+                                         'wirelens', 'sec', 'usec'])
+
+# Bump whenever the layout of the cached index changes
+INDEX_VERSION = 1
+INDEX_FIELDS = ['offsets', 'caplens', 'wirelens', 'sec', 'usec']
+# Directory under the temp dir for indexes of captures in read-only dirs
+INDEX_CACHE_DIR = 'pcap_index'
+
+
+class PcapReader(object):
+    """Zero-copy reader for a libpcap file backed by a record index.
+
+    Attributes:
+      - data : uint8 memmap of the whole capture file
+      - offsets : offset in data of the first byte of each packet
+      - caplens : number of captured bytes of each packet
+      - wirelens : original length of each packet on the wire
+      - sec, usec : timestamp of each packet
+    """
+
+    def __init__(self, filename, use_cache=True):
+        """Map the file and load (or build and save) its record index."""
+        self.filename = filename
+        self.data = np.memmap(filename, dtype=np.uint8, mode='r')
+        index = None
+        if use_cache:
+            index = self._load_index()
+        if index is None:
+            index = build_pcap_index(self.data)
+            if use_cache:
+                self._save_index(index)
+        for field in INDEX_FIELDS:
+            setattr(self, field, index[field])
+
+        self._times = None
+        self._order = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def packet(self, i):
+        """Return a read-only view of the bytes of packet i."""
+        return self.data[self.offsets[i]:self.offsets[i] + self.caplens[i]]
+
+    def times(self):
+        """Return the float timestamp of each packet."""
+        if self._times is None:
+            self._times = (self.sec.astype(float) +
+                           self.usec.astype(float)*1e-6)
+        return self._times
+
+    def between(self, t0=None, t1=None):
+        """Return the indices of the packets with t0 <= time < t1.
+
+        Either bound may be None to leave that side open. The lookup is a
+        binary search over the index timestamps.
+        """
+        times = self.times()
+        if self._order is None:
+            if np.all(times[1:] >= times[:-1]):
+                self._order = slice(None)
+            else:
+                self._order = np.argsort(times, kind='mergesort')
+        sorted_times = times[self._order]
+        lo = 0 if t0 is None else np.searchsorted(sorted_times, t0, 'left')
+        hi = len(times) if t1 is None else np.searchsorted(sorted_times, t1,
+                                                           'left')
+        if isinstance(self._order, slice):
+            return np.arange(lo, hi)
+        return np.sort(self._order[lo:hi])
+
+    def _index_files(self):
+        """Return the places the index may be cached, in order of preference.
+
+        The index goes next to the capture when its directory is writable,
+        otherwise into a cache directory under the temp dir, named by the
+        capture's absolute path.
+        """
+        key = hashlib.sha1(os.path.abspath(self.filename)).hexdigest()
+        return [self.filename + '.idx.npz',
+                os.path.join(tempfile.gettempdir(), INDEX_CACHE_DIR,
+                             key + '.idx.npz')]
+
+    def _load_index(self):
+        """Load the first cached index that is still valid for the capture."""
+        stat = os.stat(self.filename)
+        for index_file in self._index_files():
+            try:
+                with np.load(index_file) as cached:
+                    meta = cached['meta']
+                    if (meta[0] == INDEX_VERSION and
+                            meta[1] == stat.st_size and
+                            meta[2] == int(stat.st_mtime)):
+                        return {field: cached[field]
+                                for field in INDEX_FIELDS}
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+        return None
+
+    def _save_index(self, index):
+        """Save the index to the first place that can be written."""
+        stat = os.stat(self.filename)
+        meta = np.array([INDEX_VERSION, stat.st_size, int(stat.st_mtime)],
+                        dtype=np.int64)
+        for index_file in self._index_files():
+            try:
+                if not os.path.isdir(os.path.dirname(index_file) or '.'):
+                    os.makedirs(os.path.dirname(index_file))
+                with open(index_file, 'wb') as f:
+                    np.savez(f, meta=meta, **index)
+                return
+            except (IOError, OSError):
+                continue
+
+
+def build_pcap_index(data):
+    """Walk the record headers of a pcap file.
+
+    Inputs:
+      - data : buffer (e.g. a uint8 memmap) holding the whole pcap file
+
+    Returns:
+      - a dictionary of numpy arrays keyed by INDEX_FIELDS. A truncated
+        final record is left out of the index.
+    """
+    magic = data[0:4].tobytes()
+    if magic not in PCAP_MAGIC:
+        raise ValueError("not a libpcap file (bad magic number)")
+    order, units = PCAP_MAGIC[magic]
+    record = struct.Struct(order + 'IIII')
+    raw = data[:].data if isinstance(data, np.ndarray) else data
+
+    n_bytes = len(data)
+    offsets, sec, frac, caplens, wirelens = [], [], [], [], []
+    pos = PCAP_GLOBAL_HDR_LEN
+    while pos + PCAP_RECORD_HDR_LEN <= n_bytes:
+        ts_sec, ts_frac, caplen, wirelen = record.unpack_from(raw, pos)
+        pos += PCAP_RECORD_HDR_LEN
+        if pos + caplen > n_bytes:
+            break
+        offsets.append(pos)
+        sec.append(ts_sec)
+        frac.append(ts_frac)
+        caplens.append(caplen)
+        wirelens.append(wirelen)
+        pos += caplen
+
+    usec = np.array(frac, dtype=np.int64)
+    if units != 1000000:
+        usec //= units // 1000000
+    return {
+        'offsets': np.array(offsets, dtype=np.int64),
+        'caplens': np.array(caplens, dtype=np.int64),
+        'wirelens': np.array(wirelens, dtype=np.int64),
+        'sec': np.array(sec, dtype=np.int64),
+        'usec': usec,
+    }
+
+
+def is_mappable(filename):
+    """Return True if filename is an uncompressed classic libpcap file."""
+    with open(filename, 'rb') as f:
+        return f.read(4) in PCAP_MAGIC
+
+
+def open_capture(filename):
+    """Open a capture file, transparently decompressing gzip and zstd."""
+    with open(filename, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.open(filename, 'rb')
+    if magic == ZSTD_MAGIC:
+        if zstandard is None:
+            raise ImportError("reading .zst captures needs the zstandard "
+                              "package")
+        return zstandard.ZstdDecompressor().stream_reader(
+            open(filename, 'rb'))
+    return open(filename, 'rb')
+
+
+def iter_records(filename, block_size=None, read_size=READ_SIZE):
+    """Iterate over the packet records of any supported capture file.
+
+    Uncompressed libpcap files are served from their PcapReader index in
+    blocks of block_size packets (all at once if None). Compressed files and
+    pcapng files are decompressed and parsed as a stream, read_size bytes
+    at a time.
+
+    Yields:
+      - a RecordBlock for each block of packets, in file order
+    """
+    if is_mappable(filename):
+        reader = PcapReader(filename)
+        if block_size is None:
+            block_size = max(len(reader), 1)
+        for start in range(0, len(reader), block_size):
+            rows = slice(start, start + block_size)
+            yield RecordBlock(reader.data, reader.offsets[rows],
+                              reader.caplens[rows], reader.wirelens[rows],
+                              reader.sec[rows], reader.usec[rows])
+        return
+
+    f = open_capture(filename)
+    try:
+        magic = f.read(4)
+        if magic in PCAP_MAGIC:
+            records = _iter_pcap_stream(f, magic, read_size)
+        elif len(magic) == 4 and struct.unpack('<I', magic)[0] == PCAPNG_SHB:
+            records = _iter_pcapng_stream(f, magic, read_size)
+        else:
+            raise ValueError("{} is not a pcap or pcapng file".format(
+                filename))
+        for block in records:
+            yield block
+    finally:
+        f.close()
+
+
+def _read_chunks(f, data, read_size):
+    """Yield growing buffers of stream bytes.
+
+    Each time the consumer sends back how many bytes it used, the unused
+    tail is kept and more of the stream is appended. The last buffer is
+    yielded with eof True.
+    """
+    while True:
+        chunk = f.read(read_size)
+        data += chunk
+        used = yield data, not chunk
+        if not chunk:
+            return
+        data = data[used:]
+
+
+def _record_block(buf, offsets, caplens, wirelens, sec, frac, units):
+    """Build a RecordBlock, converting timestamp fractions to usec."""
+    frac = np.array(frac, dtype=np.int64)
+    units = np.asarray(units, dtype=np.int64)
+    return RecordBlock(np.frombuffer(buf, dtype=np.uint8),
+                       np.array(offsets, dtype=np.int64),
+                       np.array(caplens, dtype=np.int64),
+                       np.array(wirelens, dtype=np.int64),
+                       np.array(sec, dtype=np.int64),
+                       frac * 1000000 // units)
+
+
+def _iter_pcap_stream(f, magic, read_size):
+    """Parse the records of a classic libpcap stream."""
+    order, units = PCAP_MAGIC[magic]
+    record = struct.Struct(order + 'IIII')
+    f.read(PCAP_GLOBAL_HDR_LEN - 4)
+
+    chunks = _read_chunks(f, b'', read_size)
+    buf, eof = next(chunks)
+    while True:
+        offsets, sec, frac, caplens, wirelens = [], [], [], [], []
+        pos = 0
+        while pos + PCAP_RECORD_HDR_LEN <= len(buf):
+            ts_sec, ts_frac, caplen, wirelen = record.unpack_from(buf, pos)
+            if pos + PCAP_RECORD_HDR_LEN + caplen > len(buf):
+                break
+            offsets.append(pos + PCAP_RECORD_HDR_LEN)
+            sec.append(ts_sec)
+            frac.append(ts_frac)
+            caplens.append(caplen)
+            wirelens.append(wirelen)
+            pos += PCAP_RECORD_HDR_LEN + caplen
+        if offsets:
+            yield _record_block(buf, offsets, caplens, wirelens, sec, frac,
+                                units)
+        if eof:
+            return
+        buf, eof = chunks.send(pos)
+
+
+def _iter_pcapng_stream(f, magic, read_size):
+    """Parse the packet blocks of a pcapng stream.
+
+    Enhanced and (obsolete) Packet Blocks are returned; every other block
+    is skipped apart from the section and interface headers, which set the
+    byte order and each interface's timestamp resolution.
+    """
+    order = '<'
+    tsresol = []
+
+    chunks = _read_chunks(f, magic, read_size)
+    buf, eof = next(chunks)
+    while True:
+        offsets, sec, frac, units, caplens, wirelens = [], [], [], [], [], []
+        pos = 0
+        while pos + 12 <= len(buf):
+            if struct.unpack_from('<I', buf, pos)[0] == PCAPNG_SHB:
+                bom = struct.unpack_from('<I', buf, pos + 8)[0]
+                order = '<' if bom == PCAPNG_BYTE_ORDER_MAGIC else '>'
+                tsresol = []
+            block_type, block_len = struct.unpack_from(order + 'II', buf, pos)
+            if pos + block_len > len(buf):
+                break
+            if block_type == PCAPNG_IDB:
+                tsresol.append(_pcapng_tsresol(buf, pos, block_len, order))
+            elif block_type in (PCAPNG_EPB, PCAPNG_PB):
+                if block_type == PCAPNG_EPB:
+                    iface, ts_hi, ts_lo, caplen, wirelen = \
+                        struct.unpack_from(order + 'IIIII', buf, pos + 8)
+                else:
+                    iface, _, ts_hi, ts_lo, caplen, wirelen = \
+                        struct.unpack_from(order + 'HHIIII', buf, pos + 8)
+                ts_units = tsresol[iface]
+                ts = (ts_hi << 32) | ts_lo
+                offsets.append(pos + 28)
+                sec.append(ts // ts_units)
+                frac.append(ts % ts_units)
+                units.append(ts_units)
+                caplens.append(caplen)
+                wirelens.append(wirelen)
+            pos += block_len
+        if offsets:
+            yield _record_block(buf, offsets, caplens, wirelens, sec, frac,
+                                units)
+        if eof:
+            return
+        buf, eof = chunks.send(pos)
+
+
+def _pcapng_tsresol(buf, pos, block_len, order):
+    """Return the timestamp units per second of an Interface Description."""
+    opt = pos + 16
+    end = pos + block_len - 4
+    while opt + 4 <= end:
+        code, length = struct.unpack_from(order + 'HH', buf, opt)
+        if code == 0:
+            break
+        if code == PCAPNG_OPT_TSRESOL:
+            resol = struct.unpack_from('B', buf, opt + 4)[0]
+            if resol & 0x80:
+                return 2 ** (resol & 0x7F)
+            return 10 ** resol
+        opt += 4 + ((length + 3) & ~3)
+    return 1000000
@@ -0,0 +1,417 @@
+"""PHAD-C training and model lookup shared by the PHAD experiments.
+
+Each feature's Clusterer only ever sees its own column, so the features are
+trained in parallel, one process per feature. Workers read their column
+straight from the PacketStore's memory-mapped files, so nothing but the
+fitted Clusterers is pickled through the pool. Models can also be
+trained per day and merged afterwards, so new days are folded into an
+existing model without retraining the old ones.
+
+For scoring, compile_model turns each trained Clusterer into the fastest
+membership index for its field: a lookup table for 8 and 16 bit fields and
+sorted bound arrays for wider ones. score_fields then scores every field of
+a block of test packets at once, and score_packets splits the test days
+into chunks of rows that are scored in parallel, each worker reading its
+rows from the PacketStore like the training workers. The only state that
+crosses a chunk boundary is the time of each feature's last anomaly, so
+only the first anomaly of each feature in a chunk is fixed up afterwards.
+"""
+import numpy as np
+from multiprocessing import Pool, cpu_count
+from clusterer import Clusterer
+from packet_store import PacketStore, VALID_COLUMN
+from packet_table import FEATURE_BITS, FEATURE_DTYPES
+from pcap_parser import FEATURES
+from field_scores import FieldScores, _row_totals
+
+# Rows of test data scored at a time by score_packets
+SCORE_CHUNK = 1 << 18
+
+
+def train_clusters(store, days, features=None, C=32, processes=None):
+    """Fit a Clusterer to each feature of the packets of days.
+
+    Values are added one day after another, each in the order its packets
+    were stored, as the original experiments added the training files one
+    after another and as score_packets scores the test days. Days that
+    cover the same hours, like week3_monday_inside and
+    week3_monday_extra_inside, are not interleaved by timestamp, since the
+    order changes which ranges get merged and so the model.
+
+    Inputs:
+      - store : PacketStore holding the days
+      - days : list of day names to train on
+      - features : list of FEATURES to train, defaults to all of them
+      - C : maximum number of clusters per feature
+      - processes : size of the process pool, defaults to one per core
+
+    Returns:
+      - dictionary of feature -> trained Clusterer
+    """
+    return _train_models(store, [days], features, C, processes)[0]
+
+
+def train_day_models(store, days, features=None, C=32, processes=None):
+    """Fit a separate model to each day, to be combined with merge_models.
+
+    Every (day, feature) pair is trained in parallel. Models of days that
+    were trained before can be kept and merged with the new ones instead of
+    retraining over every day.
+
+    Returns:
+      - dictionary of day -> dictionary of feature -> trained Clusterer
+    """
+    models = _train_models(store, [[day] for day in days], features, C,
+                           processes)
+    return dict(zip(days, models))
+
+
+def merge_models(models, C=None):
+    """Merge models trained on separate shards of the data.
+
+    Inputs:
+      - models : list of dictionaries of feature -> Clusterer
+      - C : maximum number of clusters of the merged model, defaults to the
+        C of the first model
+
+    Returns:
+      - a new dictionary of feature -> merged Clusterer
+    """
+    merged = {}
+    for model in models:
+        for feature, clusterer in model.items():
+            if feature not in merged:
+                merged[feature] = Clusterer(clusterer.C if C is None else C)
+            merged[feature].merge(clusterer)
+    return merged
+
+
+def compile_model(model):
+    """Compile each feature's Clusterer into a membership index.
+
+    Returns:
+      - dictionary of feature -> TableIndex for fields of up to 16 bits, or
+        BoundsIndex for wider fields
+    """
+    compiled = {}
+    for feature, clusterer in model.items():
+        if FEATURE_DTYPES[feature].itemsize <= 2:
+            compiled[feature] = TableIndex(clusterer,
+                                           FEATURE_DTYPES[feature])
+        else:
+            compiled[feature] = BoundsIndex(clusterer)
+    return compiled
+
+
+def score_fields(model, features, times, anomalous, lastAnomaly):
+    """Score the anomalous fields of a block of test packets.
+
+    A field that is anomalous at time t scores (t - t') * N / R, where t' is
+    the time of the previous anomaly of the same feature. Within a column
+    t' is the time of the previous anomalous row, so the whole block is
+    scored with one gather and one subtraction instead of a loop over the
+    packets. A feature whose Clusterer saw no values (R == 0) has no ranges
+    to judge a field by, so its fields score 0.
+
+    Inputs:
+      - model : dictionary of feature -> trained Clusterer
+      - features : list of the features of the columns of anomalous
+      - times : timestamp of each packet, in increasing order
+      - anomalous : boolean matrix with a row per packet and a column per
+        feature, True where the field is scored
+      - lastAnomaly : float array with the time of the last anomaly of each
+        feature before the block. It is updated in place, so the next block
+        carries on from this one.
+
+    Returns:
+      - float matrix with the score of each field, 0 where not anomalous
+    """
+    times = np.asarray(times, dtype=float)
+    anomalous = np.asarray(anomalous, dtype=bool)
+    # Column-major, so each feature's anomalies are contiguous and in time
+    # order. A column-major anomalous matrix is walked without a copy.
+    scores = np.zeros(anomalous.shape, order='F')
+    flat = np.flatnonzero(anomalous.T)
+    if len(flat) == 0:
+        return scores
+    cols, rows = np.divmod(flat, len(times))
+    hit = times[rows]
+    starts = np.flatnonzero(np.r_[True, cols[1:] != cols[:-1]])
+    ends = np.r_[starts[1:], len(cols)] - 1
+    previous = np.empty_like(hit)
+    previous[1:] = hit[:-1]
+    previous[starts] = lastAnomaly[cols[starts]]
+    total, distinct = _model_counts(model, features)
+    scores.T.reshape(-1)[flat] = ((hit - previous) * total[cols] /
+                                  distinct[cols])
+    lastAnomaly[cols[ends]] = hit[ends]
+    return scores
+
+
+def score_packets(model, features, store, days, lastAnomaly,
+                  checkFeatures=None, processes=None, chunk_size=SCORE_CHUNK):
+    """Score the test packets of days in chunks, one process per chunk.
+
+    The days are scored one after another, each in the order its packets
+    were stored. Every chunk is a range of rows of one day, which its worker
+    reads straight from the PacketStore's memory-mapped columns at their
+    natural widths. Each chunk is scored as if no feature had an anomaly
+    before it. Then the first anomaly of each feature in a chunk is scored
+    again from the last anomaly of the chunks before it, which gives the
+    same scores as one pass of score_fields over all of the packets.
+
+    Inputs:
+      - model : dictionary of feature -> trained Clusterer
+      - features : list of the features to score
+      - store : PacketStore holding the days
+      - days : list of day names to score, in order
+      - lastAnomaly : float array with the time of the last anomaly of each
+        feature before the packets, updated in place
+      - checkFeatures : for each feature, the feature that must be present
+        for it to be scored, or None to always score it. Defaults to the
+        feature itself. A scored field that is not present is never in a
+        cluster, so it is anomalous.
+      - processes : number of worker processes, defaults to one per core
+      - chunk_size : maximum number of rows per chunk
+
+    Returns:
+      - FieldScores of the packets of all of the days, in order
+    """
+    if checkFeatures is None:
+        checkFeatures = features
+    checkFeatures = list(checkFeatures)
+    processes = processes or cpu_count()
+    model = {f: model[f] for f in features}
+    tasks = [(store.root, day, start, stop, model, features, checkFeatures)
+             for day, start, stop in _chunks(store, days, chunk_size)]
+    if processes == 1 or len(tasks) <= 1:
+        # Only one chunk's dense scores are held at a time
+        index = compile_model(model)
+        parts = _ScoreParts(features)
+        for _, day, start, stop, _, _, _ in tasks:
+            _, scores, _ = _score_rows(model, index, features, checkFeatures,
+                                       store, day, start, stop, lastAnomaly)
+            parts.append(FieldScores.from_dense(features, scores))
+        return parts.join()
+
+    total, distinct = _model_counts(model, features)
+    parts = _ScoreParts(features)
+    p = Pool(min(processes, len(tasks)))
+    try:
+        # Chunks are fixed up in order as they arrive
+        for part, firstRows, firstTimes, lastTimes in p.imap(_score_chunk,
+                                                              tasks):
+            cols = np.flatnonzero(firstRows >= 0)
+            rows = firstRows[cols]
+            entries = np.searchsorted(part.rows * len(features) + part.ids,
+                                      rows * len(features) + cols)
+            part.scores[entries] = ((firstTimes[cols] - lastAnomaly[cols]) *
+                                    total[cols] / distinct[cols])
+            fixed = np.unique(rows)
+            part.total[fixed] = _row_totals(part.dense(fixed))
+            lastAnomaly[cols] = lastTimes[cols]
+            # Anomalies at the time of the previous one score 0
+            keep = part.scores != 0
+            parts.append(FieldScores(features, part.total, part.rows[keep],
+                                     part.ids[keep], part.scores[keep]))
+    finally:
+        p.close()
+        p.join()
+    return parts.join()
+
+
+class BoundsIndex(object):
+    """Cluster membership by binary search over sorted bound arrays."""
+
+    def __init__(self, clusterer):
+        self.lows = np.array(clusterer.lows, dtype=float)
+        self.highs = np.array(clusterer.highs, dtype=float)
+
+    def contains_many(self, values):
+        """Return a boolean mask of the values that fall into a cluster."""
+        values = np.asarray(values)
+        if len(self.lows) == 0:
+            return np.zeros(values.shape, dtype=bool)
+        i = np.searchsorted(self.lows, values, 'right')
+        return (i > 0) & (values <= self.highs[i - 1])
+
+
+class TableIndex(object):
+    """Cluster membership of a narrow field by table lookup.
+
+    The table has an entry for every value of the field's dtype, so a
+    column of that dtype is looked up with a single fancy index.
+    """
+
+    def __init__(self, clusterer, dtype):
+        self.dtype = np.dtype(dtype)
+        size = np.iinfo(self.dtype).max + 1
+        self.table = np.zeros(size, dtype=bool)
+        for low, high in zip(clusterer.lows, clusterer.highs):
+            low = max(int(np.ceil(low)), 0)
+            high = min(int(np.floor(high)), size - 1)
+            self.table[low:high + 1] = True
+
+    def contains_many(self, values):
+        """Return a boolean mask of the values that fall into a cluster.
+
+        Values must be whole numbers. Values outside the field's domain,
+        like the -1 of missing fields in a design matrix, are never
+        contained.
+        """
+        values = np.asarray(values)
+        if values.dtype.kind == 'u' and values.itemsize <= self.dtype.itemsize:
+            return self.table[values]
+        inside = (values >= 0) & (values < len(self.table))
+        found = np.zeros(values.shape, dtype=bool)
+        found[inside] = self.table[values[inside].astype(np.intp)]
+        return found
+
+
+def _model_counts(model, features):
+    """Return the N and R of each feature's Clusterer as float arrays.
+
+    A feature with R == 0 gets N = 0 and R = 1, so its fields score 0
+    rather than 0 / 0.
+    """
+    total = np.array([model[f].getTotal() for f in features], dtype=float)
+    distinct = np.array([model[f].getDistinct() for f in features],
+                        dtype=float)
+    unseen = distinct == 0
+    total[unseen] = 0
+    distinct[unseen] = 1
+    return total, distinct
+
+
+class _ScoreParts(object):
+    """The sparse scores of consecutive chunks, joined once at the end.
+
+    Each of the arrays is joined and its chunks dropped before the next one,
+    so joining holds little more than one copy of the scores.
+    """
+
+    def __init__(self, features):
+        self.features = features
+        self.chunks = [[np.zeros(0)], [np.zeros(0, dtype=np.int64)],
+                       [np.zeros(0, dtype=np.int16)], [np.zeros(0)]]
+        self.size = 0
+
+    def append(self, part):
+        """Add the FieldScores of the next chunk."""
+        arrays = [part.total, part.rows + self.size, part.ids, part.scores]
+        for chunks, values in zip(self.chunks, arrays):
+            chunks.append(values)
+        self.size += len(part)
+
+    def join(self):
+        """Return the FieldScores of all of the chunks, in order."""
+        joined = []
+        while self.chunks:
+            joined.append(np.concatenate(self.chunks.pop(0)))
+        return FieldScores(self.features, *joined)
+
+
+def _train_models(store, day_groups, features, C, processes):
+    """Fit one model per group of days, training every feature in parallel.
+
+    Returns:
+      - list of dictionaries of feature -> trained Clusterer, one for each
+        group of days
+    """
+    if features is None:
+        features = FEATURES
+    tasks = [(store.root, days, feature, C)
+             for days in day_groups for feature in features]
+    p = Pool(max(1, min(processes or cpu_count(), len(tasks))))
+    try:
+        fitted = p.map(_train_feature, tasks)
+    finally:
+        p.close()
+        p.join()
+    return [dict(zip(features, fitted[i:i + len(features)]))
+            for i in range(0, len(fitted), len(features))]
+
+
+def _train_feature(task):
+    """Fit the Clusterer of a single feature.
+
+    Inputs:
+      - task : (store root, days, feature, C) tuple
+    """
+    root, days, feature, C = task
+    store = PacketStore(root)
+    clusterer = Clusterer(C)
+    for day in days:
+        values = store.column(day, feature).astype(FEATURE_DTYPES[feature])
+        valid = store.column(day, VALID_COLUMN).astype(np.uint64)
+        clusterer.add_many(values[(valid & FEATURE_BITS[feature]) != 0])
+    return clusterer
+
+
+def _chunks(store, days, chunk_size):
+    """Split the rows of each day into nearly equal ranges.
+
+    Returns:
+      - list of (day, start row, stop row) tuples, in scoring order
+    """
+    chunks = []
+    for day in days:
+        n = store.num_packets(day)
+        bounds = np.linspace(0, n, -(-n // chunk_size) + 1).astype(int)
+        chunks += [(day, start, stop)
+                   for start, stop in zip(bounds, bounds[1:])]
+    return chunks
+
+
+def _score_rows(model, index, features, checkFeatures, store, day, start,
+                stop, lastAnomaly):
+    """Look up and score rows [start, stop) of one day with score_fields.
+
+    Returns:
+      - the float timestamp of each row
+      - the score matrix of the rows
+      - the boolean matrix of the anomalous fields
+    """
+    times = store.times(day, start, stop)
+    valid = store.column(day, VALID_COLUMN, start, stop).astype(np.uint64)
+    # Column-major, so score_fields walks each feature's column in order
+    anomalous = np.empty((stop - start, len(features)), dtype=bool, order='F')
+    for i, feature in enumerate(features):
+        values = store.column(day, feature, start, stop)
+        anomalous[:, i] = ~index[feature].contains_many(
+            values.astype(FEATURE_DTYPES[feature], copy=False))
+        anomalous[:, i] |= (valid & FEATURE_BITS[feature]) == 0
+        if checkFeatures[i] is not None:
+            anomalous[:, i] &= (valid & FEATURE_BITS[checkFeatures[i]]) != 0
+    return (times, score_fields(model, features, times, anomalous,
+                                lastAnomaly), anomalous)
+
+
+def _score_chunk(task):
+    """Score one chunk of score_packets.
+
+    Inputs:
+      - task : (store root, day, start row, stop row, model, features,
+        checkFeatures) tuple
+
+    Returns:
+      - the FieldScores of the chunk
+      - the row of the first anomaly of each feature in the chunk, -1 for
+        none
+      - the time of the first anomaly of each feature
+      - the time of the last anomaly of each feature
+    """
+    root, day, start, stop, model, features, checkFeatures = task
+    store = PacketStore(root)
+    index = compile_model(model)
+    # The chunk doesn't know the anomalies before it. The first anomaly of
+    # each feature scores NaN until score_packets fixes it up.
+    lastAnomaly = np.full(len(features), np.nan)
+    times, scores, anomalous = _score_rows(model, index, features,
+                                           checkFeatures, store, day, start,
+                                           stop, lastAnomaly)
+    found = anomalous.any(axis=0)
+    firstRows = np.where(found, anomalous.argmax(axis=0), -1)
+    firstTimes = times[np.maximum(firstRows, 0)]
+    return (FieldScores.from_dense(features, scores), firstRows, firstTimes,
+            lastAnomaly)
@@ -0,0 +1,84 @@
+"""Vectorized packet predicates for np_parse_pcap.
+
+A predicate is called with the RawHeaders of a block of packets and returns
+a boolean mask of the packets to keep. Predicates run in the parser's worker
+processes, so they must be picklable: use these classes or a module level
+function rather than a lambda.
+"""
+import socket
+import struct
+import numpy as np
+from pcap_parser import FEATURES, PROTO_ICMP, PROTO_TCP, PROTO_UDP
+
+
+class FieldIn(object):
+    """Keep packets that have the feature with one of the given values."""
+
+    def __init__(self, feature, values):
+        if feature not in FEATURES:
+            raise ValueError("unknown feature {}".format(feature))
+        self.feature = feature
+        self.values = np.unique(np.asarray(list(values), dtype=np.int64))
+
+    def __call__(self, headers):
+        return (headers.present(self.feature) &
+                np.in1d(headers.field(self.feature), self.values))
+
+
+class InSubnet(object):
+    """Keep packets whose IPv4 address is in a subnet like '172.16.0.0/16'.
+
+    Inputs:
+      - subnet : address and prefix length in CIDR notation
+      - feature : 'IPv4_dst' or 'IPv4_src'
+    """
+
+    def __init__(self, subnet, feature='IPv4_dst'):
+        if feature not in ('IPv4_src', 'IPv4_dst'):
+            raise ValueError("{} is not an IPv4 address".format(feature))
+        address, _, prefix = subnet.partition('/')
+        prefix = int(prefix or 32)
+        self.feature = feature
+        self.mask = (0xFFFFFFFF << (32 - prefix)) & 0xFFFFFFFF
+        self.network = (struct.unpack('!L', socket.inet_aton(address))[0] &
+                        self.mask)
+
+    def __call__(self, headers):
+        return (headers.present(self.feature) &
+                ((headers.field(self.feature) & self.mask) == self.network))
+
+
+class Protocol(FieldIn):
+    """Keep IPv4 packets of the named protocols, e.g. Protocol('TCP')."""
+
+    NUMBERS = {'ICMP': PROTO_ICMP, 'TCP': PROTO_TCP, 'UDP': PROTO_UDP}
+
+    def __init__(self, *names):
+        FieldIn.__init__(self, 'IPv4_proto',
+                         [self.NUMBERS[name] for name in names])
+
+
+class AllOf(object):
+    """Keep packets that pass every one of the predicates."""
+
+    def __init__(self, *predicates):
+        self.predicates = predicates
+
+    def __call__(self, headers):
+        mask = np.ones(len(headers), dtype=bool)
+        for predicate in self.predicates:
+            mask &= predicate(headers)
+        return mask
+
+
+class AnyOf(object):
+    """Keep packets that pass at least one of the predicates."""
+
+    def __init__(self, *predicates):
+        self.predicates = predicates
+
+    def __call__(self, headers):
+        mask = np.zeros(len(headers), dtype=bool)
+        for predicate in self.predicates:
+            mask |= predicate(headers)
+        return mask
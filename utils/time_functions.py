@@ -1,6 +1,7 @@
 
 import sys, os, re
 from datetime import datetime
+import numpy as np
 
 # num seconds to convert from EST to PST
 ADJUSTMENT_TIME = 3*3600
@@ -44,6 +45,80 @@ def tstamp_to_datetime(tstamp):
     result = datetime.fromtimestamp(tstamp + ADJUSTMENT_TIME).strftime('%m/%d/%Y %H:%M:%S')
     return result.split()
 
+def tstamps_to_datetime(tstamps):
+    """Converts pcap timestamps to dates and times, as tstamp_to_datetime does
+    Input:
+      - array of float timestamps
+
+    Returns:
+      - array of date strings: MM/DD/YYYY
+      - array of time strings: HH:MM:SS
+    """
+    shifted = np.asarray(tstamps, dtype=float) + ADJUSTMENT_TIME
+    seconds = _whole_seconds(shifted).astype(np.int64)
+
+    local = (seconds + _utc_offsets(seconds)).astype('datetime64[s]')
+    days = local.astype('datetime64[D]')
+    months = days.astype('datetime64[M]')
+    years = months.astype('datetime64[Y]').astype(np.int64) + 1970
+    daySeconds = (local - days).astype(np.int64)
+
+    dates = _fixed_width([_digits(months.astype(np.int64) % 12 + 1, 2), '/',
+                          _digits((days - months).astype(np.int64) + 1, 2), '/',
+                          _digits(years, 4)])
+    times = _fixed_width([_digits(daySeconds // 3600, 2), ':',
+                          _digits(daySeconds // 60 % 60, 2), ':',
+                          _digits(daySeconds % 60, 2)])
+    return dates, times
+
+def tstamps_to_seconds(tstamps):
+    """Truncates pcap timestamps to the whole seconds tstamps_to_datetime
+    writes them as, so that they match the timestamps datetime_to_tstamp
+    reads back from a results file
+    Input:
+      - array of float timestamps
+
+    Returns:
+      - array of float timestamps
+    """
+    shifted = np.asarray(tstamps, dtype=float) + ADJUSTMENT_TIME
+    return _whole_seconds(shifted) - ADJUSTMENT_TIME
+
+def _whole_seconds(shifted):
+    """Whole seconds of timestamps, as fromtimestamp gives them
+    """
+    # fromtimestamp rounds to the microsecond, which can carry into the
+    # next second
+    seconds = np.floor(shifted)
+    seconds += np.floor((shifted - seconds) * 1e6 + 0.5) >= 1e6
+    return seconds
+
+def _utc_offsets(seconds):
+    """Offset in seconds of the local time zone from UTC at each timestamp
+    """
+    # Time zone offsets, and the times they change at, are whole quarter
+    # hours, so one lookup covers every timestamp of a quarter hour
+    quarters, inverse = np.unique(seconds // 900, return_inverse=True)
+    offsets = [datetime.fromtimestamp(q * 900) - datetime.utcfromtimestamp(q * 900)
+               for q in quarters.tolist()]
+    return np.array([o.days * 86400 + o.seconds for o in offsets],
+                    dtype=np.int64)[inverse]
+
+def _digits(values, width):
+    """Zero padded ASCII digits of non-negative ints, one row per value
+    """
+    powers = 10 ** np.arange(width - 1, -1, -1)
+    return (values.reshape(-1, 1) // powers % 10 + ord('0')).astype(np.uint8)
+
+def _fixed_width(parts):
+    """Join columns of ASCII digits and separator characters into strings
+    """
+    rows = len(parts[0])
+    columns = [np.full((rows, 1), ord(part), dtype=np.uint8)
+               if isinstance(part, str) else part for part in parts]
+    chars = np.hstack(columns)
+    return chars.view('S%d' % chars.shape[1]).reshape(rows)
+
 def dur_to_sec(dur):
     """Convert duration string with format HH:MM:SS to float
     """